@@ -2,23 +2,41 @@ import gc
 from psychopy import visual, logging, core, event, monitors, data, gui
 from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
                                 STOPPED, FINISHED, PRESSED, RELEASED, FOREVER, priority)
-from psychopy.tools import environmenttools
 from numpy import sin, cos, pi
 import psychopy
 import matplotlib
 matplotlib.use('Qt5Agg')  # change this to control the plotting 'back end'
 import os.path as op
+import sys
 import os
 import numpy as np
 from numpy.random import random, randint
-import random
 # for markers
-import socket
 from subprocess import Popen, PIPE
 from pylsl import StreamInfo, StreamOutlet
 import json
 
-import time
+# The modules both paradigms use are in ../shared
+from shared_modules import use_shared
+use_shared()
+
+from flash_count import FlashCountRoutine
+from frame_schedule import FLICKER_CONDITIONS, play_schedule
+from stimulus_renderers import create_renderer
+from frame_cache import FrameCache
+from flip_timing import FlipTimer
+from block_gc import BlockGC
+from marker_dispatch import MarkerDispatcher
+from incremental_writer import IncrementalWriter
+from session_plan import (ODDBALL_CONDITIONS, compile_session_plan, condition_seed, load_session_plan, make_stimuli_map,
+                          plan_filename)
+from asset_cache import AssetCache, list_images, resolve_path, deg_to_pix
+from labrecorder_client import LabRecorderClient
+from input_monitor import InputMonitor
+from monitor_calibration import calibrate, check_refresh_rate, load_profile, profile_filename, profile_matches
+from frequency_planner import plan_frequencies, planned_freqs
+from erp_decoder import ERPDecoder, ERPModel, OnlineERP
+from online_streams import MarkerParser, eeg_channels, open_inlet
 
 #######################################
 # Define functions for this experiment
@@ -159,8 +177,17 @@ def endExperiment(thisExp, win=None):
     thisExp.status = FINISHED
     
     # Cleanup and Exit
-    labrecorder.sendall(b"stop\n")
-    core.wait(15.) # Wait for LabRecorder to finish saving data
+    input_monitor.stop()
+    marker_dispatcher.close() # Send any queued markers before the recording stops
+    if online_erp is not None:
+        online_erp.stop()
+        print(online_erp.report())
+    data_writer.close() # Write the rows and markers still queued
+    print(data_writer.report())
+    print(block_gc.report())
+    print(flash_count.report())
+    labrecorder.stop(watch_dir=labrecorder_root, timeout=labrecorder_stop_timeout) # Returns once LabRecorder has finished saving data
+    labrecorder.close()
     pid.terminate() 
     pid.wait()
     logging.flush()
@@ -168,65 +195,6 @@ def endExperiment(thisExp, win=None):
     win.close()
     core.quit()
     
-def generate_randomized_list(image_stims, repeats=10):
-    """
-    Generate a list where each stimulus is repeated exactly `repeats` times.
-    The list is randomized such that no stimulus repeats consecutively.
-    
-    Parameters:
-    - image_stims: List of stimuli to choose from.
-    - repeats: Number of times each stimulus should appear in the list.
-    
-    Returns:
-    - stim_list: A randomized list of stimuli with no consecutive repetitions.
-    """
-    # Create a list with each stimulus repeated `repeats` times
-    stim_list = image_stims * repeats
-    random.shuffle(stim_list)  # Initial shuffle
-    
-    # Ensure no consecutive duplicates
-    for i in range(1, len(stim_list)):
-        if stim_list[i] == stim_list[i - 1]:
-            # Find an index to swap that doesn't create consecutive duplicates
-            swap_idx = i
-            while swap_idx < len(stim_list) and (stim_list[swap_idx] == stim_list[i] or stim_list[swap_idx] == stim_list[i - 1]):
-                swap_idx += 1
-            if swap_idx < len(stim_list):
-                # Swap elements to avoid consecutive duplicates
-                stim_list[i], stim_list[swap_idx] = stim_list[swap_idx], stim_list[i]
-    
-    return stim_list
-
-def generate_randomized_list_with_flicker(image_stims, flicker_frames_per_cycle, repeats=10):
-    """
-    Generate a list of randomized stimuli where each stimulus appears `repeats` times, 
-    with no consecutive repetitions, and ensure the flicker period for each stimulus is attached.
-
-    Parameters:
-    - image_stims: List of PsychoPy stimuli (ImageStim objects).
-    - flicker_frames_per_cycle: List of corresponding flicker periods for each stimulus.
-    - repeats: Number of times each stimulus should appear.
-    
-    Returns:
-    - stim_flicker_list: A randomized list of tuples (stimulus, flicker_period) with no consecutive repetitions.
-    """
-    # Create a list of tuples [(stim1, flicker1), (stim2, flicker2), ...] repeated `repeats` times
-    stim_flicker_list = [(stim, flicker) for stim, flicker in zip(image_stims, flicker_frames_per_cycle)] * repeats
-    
-    # Shuffle the list while ensuring no consecutive duplicates
-    random.shuffle(stim_flicker_list)
-    
-    for i in range(1, len(stim_flicker_list)):
-        if stim_flicker_list[i][0] == stim_flicker_list[i - 1][0]:
-            swap_idx = i
-            while swap_idx < len(stim_flicker_list) and (stim_flicker_list[swap_idx][0] == stim_flicker_list[i][0] or stim_flicker_list[swap_idx][0] == stim_flicker_list[i - 1][0]):
-                swap_idx += 1
-            if swap_idx < len(stim_flicker_list):
-                # Swap to avoid consecutive duplicates
-                stim_flicker_list[i], stim_flicker_list[swap_idx] = stim_flicker_list[swap_idx], stim_flicker_list[i]
-    
-    return stim_flicker_list
-
 def create_form(name, items):
     return visual.Form(win=win, name=name,
         items=items,
@@ -242,7 +210,7 @@ def create_form(name, items):
 def create_button_stim(name, image):
     return visual.ImageStim(win=win,
                             name=name, 
-                            image=image, 
+                            image=asset_cache.load(image, size=(0.15 * win.size[1], 0.2 * win.size[1])), 
                             anchor='bottom-right',
                             units='height',
                             pos=(0.75, -0.35), size=(0.15,0.2),
@@ -250,9 +218,10 @@ def create_button_stim(name, image):
                             )
 
 def load_stimuli(win, path, locations, size=5):
-    files = os.listdir(path)
-    images = [os.path.join(path, f) for f in files if os.path.isfile(os.path.join(path, f))]
-    return [visual.ImageStim(win, image=images[n], pos=locations[n], size=size, autoLog=False) for n in range(len(locations))]
+    # One image per location, in natural order (image n always goes to location n)
+    images = list_images(path, n_images=len(locations))
+    size_pix = deg_to_pix(size, monitor_width, monitor_res, view_dist)
+    return [visual.ImageStim(win, image=asset_cache.load(images[n], size=(size_pix, size_pix)), pos=locations[n], size=size, autoLog=False) for n in range(len(locations))]
 
 ############################################
 # Setup LabRecorder & LSL Basics
@@ -263,17 +232,21 @@ expt_root = op.dirname(op.abspath(__file__))
 
 print(f"Experiment Root: {expt_root}")
 
-markers = StreamInfo('BCIMarkerStream', 'Markers', 1, 0, 'string', 'BCIPsychoPy')
+marker_mode = 'string'  # 'string' (e.g. 'Flicker/block_0/block_start') or 'int' (codes from marker_codebook, decoded with the _markers.json sidecar)
+markers = StreamInfo('BCIMarkerStream', 'Markers', 1, 0, 'int32' if marker_mode == 'int' else 'string', 'BCIPsychoPy')
 lsl_outlet = StreamOutlet(markers)
 logging.console.setLevel(logging.WARNING)
 # BIDS-compliant data directory
-data_root = op.join(expt_root, 'data')
+data_root = os.environ.get('PARADIGM_DATA_ROOT') or op.join(expt_root, 'data') # the dry run writes to a temporary folder
+labrecorder_root = data_root # StudyRoot in LabRecorder's config - the newest .xdf below it is watched when recording stops
+labrecorder_stop_timeout = 15. # Longest wait (seconds) for LabRecorder to finish saving
+labrecorder_start_timeout = 5. # Longest wait (seconds) for the new .xdf to appear once a recording is started ('Session')
 
 ############################################
 # GUI for user input
 ############################################
 expInfo = {'participant': 'sub-' + f'{randint(200, 999):03.0f}', # Empty participant ID field
-            'condition': ['Flicker', 'Oddball', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball'], 
+            'condition': ['Flicker', 'Oddball', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball', 'Session'], 
             'monitor_name': ['Alienware', 'testMonitor', 'testMonitor144Hz'],
             'session' : ['ses-001'],
             'date': data.getDateStr(),  # Timestamp of run
@@ -281,6 +254,9 @@ expInfo = {'participant': 'sub-' + f'{randint(200, 999):03.0f}', # Empty partici
             'psychopyVersion': psychopyVersion, # Psychopy version - defined above
             }
 
+# Conditions run back to back, in one window and one LabRecorder session, when 'Session' is chosen
+session_conditions = ['Flicker', 'Oddball', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball']
+
 screens = {'Alienware': {'width': 58.8, 'resolution': [2560, 1440], 'monitor_num': 1, 'useRetina': False, 'flicker_freqs': [12.63, 10, 12, 10.43, 11.43, 10.91], 'refresh_rate': 240}, # Monitor num 2 = Alienware in recording room
             'testMonitor': {'width': 30, 'resolution': [1920, 1080], 'monitor_num': 0, 'useRetina': False, 'flicker_freqs': [6, 12, 6.67, 10, 7.5, 8.57], 'refresh_rate': 60}, # Default psychopy monitor - assumes 60Hz screen
             'testMonitor144Hz': {'width': 30, 'resolution': [1920, 1080], 'monitor_num': 0, 'useRetina': False, 'flicker_freqs': [7.2, 12, 8.47, 11.08, 9.6, 10.29], 'refresh_rate': 144},
@@ -290,8 +266,8 @@ screens = {'Alienware': {'width': 58.8, 'resolution': [2560, 1440], 'monitor_num
 # Get Info From GUI
 ################################
 expInfo = showExpInfoDlg(expInfo=expInfo, gui=gui)
-thisExp, data_dir = setupData(expInfo=expInfo, data_dir=data_root)
-logFile = setupLogging(filename=thisExp.dataFileName)
+session_mode = expInfo['condition'] == 'Session'
+conditions = session_conditions if session_mode else [expInfo['condition']]
 
 monitor_name = expInfo['monitor_name']
 monitor_num = screens[monitor_name]['monitor_num']
@@ -303,17 +279,15 @@ monitor_res = screens[monitor_name]['resolution']
 # launch LabRecorder
 ################################
 pid = Popen(['./LabRecorder/LabRecorder.exe'], stdin=PIPE)
-# open connection to LabRecorder
+# open connection to LabRecorder (retried while it starts up)
 try:
-    labrecorder = socket.create_connection(("localhost", 22347))
-except:
+    labrecorder = LabRecorderClient("localhost", 22347).connect()
+except ConnectionError:
     print('Please launch Lab Recorder application and then restart the experiment')
     exit()  
     
-expt_mode = expInfo['condition']
 subj_id = expInfo['participant'][-3:]
 ses = expInfo['session'][-3:]
-labrecorder.sendall(b"filename {task:%s} {participant:%s} {session:%s} \n" % (expt_mode.encode(), subj_id.encode(), ses.encode()))
 
 ############################################  
 # Parameters user might want to change
@@ -322,6 +296,7 @@ labrecorder.sendall(b"filename {task:%s} {participant:%s} {session:%s} \n" % (ex
 # "trial" is the highlighting of a single location (Oddball) or flickering of all locations (Flicker)
 # "block" is the set of trials after a single target location has been highlighted
 flicker_freqs = screens[monitor_name]['flicker_freqs']  # The provided alpha-band frequencies for the chosen monitor -> see `screens`
+flicker_band = None  # (low, high) Hz: plan the frequencies in this band for the measured refresh rate instead (frequency_planner.py)
 bg_color = 'black'
 num_locations = 6 # Number of locations at which possible targets can appear
 dist_from_ctr = 8 # degrees
@@ -330,6 +305,7 @@ target_marker_size = img_size * 1.5 # degrees
 target_id_color = 'magenta' # color that indicates the target identity
 num_blocks = num_locations * 1 # num blocks should be multiple of num_locations
 num_trials = 10 # 10 trials per block
+sequence_seed = None # int to reproduce the target order and trial sequences of a session; None draws a new seed (saved in the plan)
 
 #######
 # General Condition Vars
@@ -349,12 +325,36 @@ danny_flicker_inter_trial_time = 1. # Number of seconds the non-flickering sihou
 danny_flicker_repeats = 10 # Number of start/stop flicker cycles before the next target is selected (i.e., block ends)
 danny_flickeroddball_flicker_time = 0.500 # Number of seconds the stim flickers in DannyFlickerOddball
 
+# Timing of the conditions, used to compile the frame schedules
+schedule_timing = {'flicker_trial_time': flicker_trial_time,
+                   'highlight_duration': highlight_duration,
+                   'flickeroddball_flicker_time': flickeroddball_flicker_time,
+                   'between_trial_duration': between_trial_duration,
+                   'danny_flicker_trial_time': danny_flicker_trial_time,
+                   'danny_flicker_inter_trial_time': danny_flicker_inter_trial_time,
+                   'danny_flicker_repeats': danny_flicker_repeats,
+                   'danny_flickeroddball_flicker_time': danny_flickeroddball_flicker_time,
+                   }
+
+#######
+# Online decoding
+#######
+online_erp_model = None # trained ERP model (.npz from `python erp_decoder.py --train`): oddball blocks end once the target is decoded from the EEG
+online_erp_threshold = 0.95 # posterior probability of a location that ends the block
+online_erp_min_repeats = 2 # flashes of every location before a block can end early
+eeg_stream_type = 'EEG' # LSL type of the amplifier stream the decoder reads
+
 ################################################
 # Parameters that could improve performance
 ################################################
 visual.useFBO = True  # if available (try without for comparison)
 disable_gc = False  # disable python garbage collection (try without for comparison)
+freeze_gc = True  # collect before each block, then freeze the collector until the block ends (no GC pauses while stimuli are shown)
+render_backend = 'autodraw'  # 'autodraw' (one ImageStim per location) or 'elementarray' (all locations in one draw call)
+use_frame_cache = False  # pre-render every on/off combination of a block into a texture at block start
+frame_cache_max_mb = 512  # memory cap for the pre-rendered frames (lower it for high resolution monitors)
 process_priority = 'realtime'  # 'high' or 'realtime'
+keyboard_backend = 'ptb'  # keyboard polled by the input monitor thread: 'ptb' (Psychtoolbox), 'iohub' or 'event' (polled from the frame loop)
 
 if process_priority == 'normal':
     pass
@@ -370,9 +370,70 @@ else:
 if disable_gc:
     gc.disable()
 
+############################################
+# Monitor calibration
+############################################
+# The refresh rate in `screens` is nominal. The actual rate is measured once per monitor (a few seconds of flips
+# in a window of its own) and kept in calibration/<monitor>.json; frame counts and flicker periods use it.
+calibration_max_age_days = 90  # measure again after this many days (None keeps a profile until it is deleted)
+calibration_file = profile_filename(op.join(expt_root, 'calibration'), monitor_name)
+monitor_profile = load_profile(calibration_file, monitor_name, monitor_res, max_age_days=calibration_max_age_days)
+# Only a monitor without a valid profile is measured, in a window of its own; a stored profile is loaded as it is
+# and checked on the experiment window once it is open
+profile_measured = monitor_profile is None
+if profile_measured:
+    calibration_win = visual.Window(monitor=monitors.Monitor(monitor_name), screen=monitor_num, size=monitor_res,
+                                    units='deg', winType='pyglet', fullscr=True, allowGUI=False, waitBlanking=True,
+                                    color=bg_color, useRetina=screens[monitor_name]['useRetina'])
+    calibration_win.mouseVisible = False
+    monitor_profile = calibrate(calibration_win, calibration_file, monitor_name, monitor_res,
+                                nominal_refresh_rate=screens[monitor_name]['refresh_rate'])
+    calibration_win.close()
+check_refresh_rate(monitor_profile)
+refresh_rate = monitor_profile['refresh_rate']
+
+if flicker_band is not None:
+    planned_frames, planned_min_sep = plan_frequencies(refresh_rate, flicker_band, num_locations)
+    flicker_freqs = planned_freqs(refresh_rate, planned_frames)
+    print(f"Planned flicker frequencies: {flicker_freqs} (minimum separation {planned_min_sep:.3f} Hz)")
+
+# Frames per flicker cycle and the frequency they give at the measured rate, kept next to the profile
+stimuli_map = make_stimuli_map(flicker_freqs, refresh_rate, num_locations, dist_from_ctr)
+with open(op.splitext(calibration_file)[0] + '_stimuli_map.json', 'w') as f:
+    json.dump(stimuli_map, f, indent=1)
+
+############################################
+# Session plan
+############################################
+# Target order, trial sequences, frame schedules and markers of every block of every condition are
+# compiled before the window opens, or loaded if the plan was compiled beforehand (`python session_plan.py`)
+plans = {}
+for expt_mode in conditions:
+    plan_file = plan_filename(data_root, expInfo['participant'], expInfo['session'], expt_mode)
+    if op.exists(plan_file):
+        plan = load_session_plan(plan_file, marker_mode=marker_mode)
+        # A plan compiled at a slightly different rate is kept as long as every flicker period is the same
+        if (plan.condition != expt_mode or abs(plan.info['refresh_rate'] - refresh_rate) > 0.5
+                or [plan.stimuli_map[loc]['frames'] for loc in range(num_locations)]
+                != [stimuli_map[loc]['frames'] for loc in range(num_locations)]):
+            raise ValueError(f"{plan_file} was compiled for {plan.condition} at {plan.info['refresh_rate']} Hz, "
+                             f"the monitor runs at {refresh_rate} Hz")
+        print(f"Loaded session plan: {plan_file}")
+    else:
+        plan = compile_session_plan(expt_mode, stimuli_map, refresh_rate, schedule_timing, num_blocks, num_trials,
+                                    seed=condition_seed(sequence_seed, expt_mode), marker_mode=marker_mode,
+                                    info={'participant': expInfo['participant'], 'session': expInfo['session'],
+                                          'monitor_name': monitor_name})
+        os.makedirs(op.dirname(plan_file), exist_ok=True)
+        plan.save(plan_file)
+    plans[expt_mode] = plan
+
 #######################
 # Set up the window
 #######################
+# Decoded images, pre-scaled to the size they are drawn at, are memory-mapped from here on later launches
+asset_cache = AssetCache(op.join(expt_root, 'asset_cache'))
+
 mon = monitors.Monitor(monitor_name) #, width=monitor_width, distance=view_dist)
     
 win = visual.Window(monitor = mon,
@@ -389,6 +450,14 @@ win = visual.Window(monitor = mon,
                     allowStencil = True
                     )
 
+# A stored profile is checked against the rate the monitor runs at now (60 flips). A display switched to another
+# rate since would get the wrong frame counts, so the profile is deleted and the next launch measures it again.
+if not profile_measured and not profile_matches(win, monitor_profile):
+    os.remove(calibration_file)
+    win.close()
+    raise RuntimeError(f"{monitor_name} no longer runs at the rate of its profile, which was deleted. "
+                       "Start the experiment again to measure the monitor.")
+
 ############################################
 # Setup Flash Counter Form
 ############################################
@@ -405,9 +474,6 @@ flash_q_items = [{'itemText': flash_questions[0],
                 }]
     
 continue_button = create_button_stim('continue', 'images/buttons/button_next.png')
-end_button = create_button_stim('end', 'images/buttons/button_finish.png')
-
-clickable_buttons = [continue_button, end_button]
 
 ############################################
 # define the locations of the stimuli
@@ -422,10 +488,7 @@ locations = [(round(dist_from_ctr * sin(2 * pi * n / num_locations), 4),
 ###############################################################################
 win.mouseVisible = False
 
-refresh_rate = screens[monitor_name]['refresh_rate']
-
-# If refresh_rate isn't supplied, measure it.
-refresh_rate = refresh_rate if refresh_rate else round(win.getActualFrameRate(nIdentical=10, nWarmUpFrames=50), 1)
+# refresh_rate is the measured one -> see Monitor calibration
 
 # print('Monitor refresh rate: %10.3f Hz' % refresh_rate)
 
@@ -458,19 +521,12 @@ flicker_frames_per_cycle = [round(refresh_rate / freq, 0) for freq in flicker_fr
 grey_path = os.path.join('images', 'sil_grey')
 grey_sil = load_stimuli(win, grey_path, locations)
 
-# Load White Faces or Gray Silhouettes depending on the experiment mode
-stim_path = os.path.join('images', 'white_faces') if expt_mode in ['Oddball', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball'] else os.path.join('images', 'sil_grey')
-image_stims = load_stimuli(win, stim_path, locations)
-
 # Load Gray Silhouettes
 sil_path = os.path.join('images', 'sil_grey')
 silhouettes = load_stimuli(win, sil_path, locations)
 
-# Mapping the number (0-6), with the coordinates, frequency, and frames on/off of that stimulus.
-    # Results in a dictionary with structure of "0: {'coordinates': (x1, y1), 'frequency': freq1, 'frames' : frames1},"
-stimuli_map = {i: {'coordinates': locations[i], 'frequency': flicker_freqs[i], 'frames': flicker_frames_per_cycle[i]} for i in range(num_locations)}
-
-# print(json.dumps(stimuli_map, indent=1)) # Makes the output more legible for debugging
+# Condition stimuli (white faces or grey silhouettes) by folder, loaded the first time a condition needs them
+condition_stims = {}
 
 #######################
 # Create Purple Highlight Box
@@ -496,572 +552,249 @@ fixation = visual.TextStim(win=win, name='fixation',
     languageStyle='LTR',
     depth=0.0)
 
-#######################
-# Set Instructions by Condition
-#######################
-if expt_mode == 'Oddball':
-    image='images/instructions/oddball_instruct.png'
-elif expt_mode == 'FlickerOddball':
-    image='images/instructions/flicker_oddball_instruct.png'
-elif expt_mode == 'Flicker':
-    image='images/instructions/flicker_instruct.png'
-elif expt_mode == 'DannyFlicker':
-    image='images/instructions/danny_flicker_instruct.png'
-elif expt_mode == 'DannyFlickerOddball':
-    image='images/instructions/danny_flicker_oddball_instruct.png'
-else:
-    image='images/instructions/instruct_0.png'
-
-instruct = visual.ImageStim(win = win,
-                            image = image,
-                            size = win.size,
-                            units = 'pix',
-                            pos = (0, 0)
-                            ) 
-
-# Show instructions
-instruct.setAutoDraw(True)
-while not event.getKeys(keyList=["space"]):
-        win.flip()
-instruct.setAutoDraw(False)
-win.flip() 
-
-print(f"\nStarting Condition: {expt_mode}")
-
 # start the clock
 routine_timer = core.Clock() 
 
-# Determine order of targets
-target_order = np.random.permutation(num_locations)
-
-#############################
-# Main Loop 
-##############################
+# The keyboard is polled on a background thread; the loops read its abort flag on every frame
+input_monitor = InputMonitor(backend=keyboard_backend, keys=('escape',)).start()
+abort_check_interval = 1
+
+# Markers are stamped with the flip that shows their event and pushed to LSL from a background thread
+marker_dispatcher = MarkerDispatcher(win, lsl_outlet)
+
+# Garbage is collected between blocks only
+block_gc = BlockGC(enabled=freeze_gc)
+
+# Oddball blocks end early once the target is decoded from the EEG (only with a trained model)
+online_erp = None
+if online_erp_model is not None:
+    erp_model = ERPModel.load(online_erp_model)
+    eeg_inlet = open_inlet(stream_type=eeg_stream_type)
+    n_eeg_channels, eeg_sfreq = eeg_channels(eeg_inlet)
+    if eeg_sfreq != erp_model.sfreq:
+        raise ValueError(f"The EEG stream runs at {eeg_sfreq} Hz, the ERP model was trained at {erp_model.sfreq} Hz")
+    erp_decoder = ERPDecoder(erp_model, num_locations, len(erp_model.channels or range(n_eeg_channels)),
+                             threshold=online_erp_threshold, min_repeats=online_erp_min_repeats)
+    online_erp = OnlineERP(erp_decoder, eeg_inlet, parser=MarkerParser(plans[conditions[0]].codebook)).start()
+
+def check_abort():
+    # Exit early once escape has been pressed (only reads a flag set by the input monitor thread)
+    if input_monitor.check():
+        print(f"Escape pressed, noticed {input_monitor.abort_latency() * 1000:.1f} ms after the key press")
+        thisExp.status = FINISHED
+        endExperiment(thisExp, win=win)
+
+# The flash count form is built once and reset for each block
+flash_count = FlashCountRoutine(win, create_form('flash', flash_q_items), continue_button, check_abort=check_abort)
 
-# Send the frequencies at the beginning, and only once
-if expt_mode in ['Flicker', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball']:
-    
-    # Iterate over the stimuli_mapping to push the frequency for each stimulus
-    for loc_index, details in stimuli_map.items():
-        frequency = details['frequency']  # Get the frequency for this stimulus
-        marker = f'loc_{loc_index}/freq_{frequency}'
-        
-        # Push the marker to the LSL outlet
-        # print(f"Pushing Marker: {marker}")
-        lsl_outlet.push_sample([marker])
+###############################################################################
+# Condition loop -> a single condition, or all `session_conditions` in 'Session' mode
+###############################################################################
+for condition_n, expt_mode in enumerate(conditions):
+    
+    expInfo['condition'] = expt_mode
+    thisExp, data_dir = setupData(expInfo=expInfo, data_dir=data_root)
+    logFile = setupLogging(filename=thisExp.dataFileName)
+    plan = plans[expt_mode]
+    thisExp.extraInfo['sequence_seed'] = plan.info['seed']
+    
+    # Rows and markers are also appended to <file>_rows.jsonl / <file>_markers.bin at every block boundary,
+    # so a crash loses at most the current block (`python incremental_writer.py <file>` rebuilds the csv)
+    data_writer = IncrementalWriter(thisExp.dataFileName, info=thisExp.extraInfo)
+    marker_dispatcher.mirror = data_writer.add_marker
+    if online_erp is not None:
+        # The ERP decoder epochs the EEG at the flips the markers were stamped with
+        def mirror_marker(timestamp, source, marker):
+            data_writer.add_marker(timestamp, source, marker)
+            online_erp.add_marker(timestamp, source, marker)
+        marker_dispatcher.mirror = mirror_marker
+    
+    # Integer marker codes are decoded with the codebook saved next to the data
+    if marker_mode == 'int':
+        plan.write_marker_sidecar(thisExp.dataFileName + '_markers.json')
+    
+    # Name the recording after the condition. In 'Session' mode each condition is recorded to its own file,
+    # so the previous recording is stopped (once saved) and a new one started.
+    if session_mode and condition_n > 0:
+        labrecorder.stop(watch_dir=labrecorder_root, timeout=labrecorder_stop_timeout)
+    labrecorder.set_filename(task=expt_mode, participant=subj_id, session=ses) # Waits for LabRecorder's answer
+    if session_mode:
+        # The condition isn't run without a recording: stop if no new .xdf appears
+        if labrecorder.start(watch_dir=labrecorder_root, timeout=labrecorder_start_timeout) is None:
+            print(f"LabRecorder didn't start recording {expt_mode}, ending the session")
+            endExperiment(thisExp, win=win)
+    
+    # Load White Faces or Gray Silhouettes depending on the experiment mode
+    stim_path = os.path.join('images', 'white_faces') if expt_mode in ['Oddball', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball'] else os.path.join('images', 'sil_grey')
+    if stim_path not in condition_stims:
+        condition_stims[stim_path] = load_stimuli(win, stim_path, locations)
+    image_stims = condition_stims[stim_path]
+    
+    # Mapping the number (0-6), with the coordinates, frequency, and frames on/off of that stimulus.
+        # Results in a dictionary with structure of "0: {'coordinates': (x1, y1), 'frequency': freq1, 'frames' : frames1},"
+    stimuli_map = plan.stimuli_map # Same as {i: {'coordinates': locations[i], 'frequency': flicker_freqs[i], 'frames': flicker_frames_per_cycle[i]}}
+    
+    # print(json.dumps(stimuli_map, indent=1)) # Makes the output more legible for debugging
+    
+    #######################
+    # Set Instructions by Condition
+    #######################
+    if expt_mode == 'Oddball':
+        image='images/instructions/oddball_instruct.png'
+    elif expt_mode == 'FlickerOddball':
+        image='images/instructions/flicker_oddball_instruct.png'
+    elif expt_mode == 'Flicker':
+        image='images/instructions/flicker_instruct.png'
+    elif expt_mode == 'DannyFlicker':
+        image='images/instructions/danny_flicker_instruct.png'
+    elif expt_mode == 'DannyFlickerOddball':
+        image='images/instructions/danny_flicker_oddball_instruct.png'
+    else:
+        image='images/instructions/instruct_0.png'
+
+    instruct = visual.ImageStim(win = win,
+                                image = asset_cache.load(resolve_path(image), size=win.size),
+                                size = win.size,
+                                units = 'pix',
+                                pos = (0, 0)
+                                ) 
+    print(asset_cache.report())
+
+    # Show instructions
+    instruct.setAutoDraw(True)
+    while not event.getKeys(keyList=["space"]):
+            check_abort()
+            win.flip()
+    instruct.setAutoDraw(False)
+    win.flip() 
 
-# Outer Block loop
-for block in range(num_blocks): # 6 blocks
-    
-    win.mouseVisible = False # Make mouse invisible after showing flash_q_form
-    
-    print(f"Starting Block: {block}")
-    
-    marker_prefix = expt_mode + '/block_' + str(block) + '/'
-    t = routine_timer.getTime()
-    cue_started = False    
-    target_loc = target_order[block]
-    
-    # Draw the target highlight for 2 seconds
-    for n in range(num_locations):
-        grey_sil[n].setAutoDraw(True)  # Set the silhouette to auto draw
-        
-        if n == target_loc:
-            target_markers[n].setAutoDraw(True)  # Set the target marker to auto draw
-            marker = marker_prefix + 'target_marker/' + 'loc_' + str(n) 
-            # print(f"Pushing Marker: {marker}")
-            lsl_outlet.push_sample([marker])
+    print(f"\nStarting Condition: {expt_mode}")
 
-    while routine_timer.getTime() - t <= target_id_duration:
-        win.flip()  # Flip the window to show the silhouettes and target markers
+    # Stimuli drawn for each layer of a frame schedule -> layers[layer][location]
+    schedule_layers = (silhouettes, image_stims)
+    renderer = create_renderer(render_backend, win, schedule_layers)
+    frame_cache = FrameCache(win, schedule_layers, max_bytes=frame_cache_max_mb * 2 ** 20) if use_frame_cache else None
 
-    # After the duration, set the silhouettes and target markers to not auto draw
-    for n in range(num_locations):
-        grey_sil[n].setAutoDraw(False)
-        target_markers[n].setAutoDraw(False)
+    # Order of targets and the on/off table of every block, from the session plan
+    target_order = plan.target_order
+    block_schedules = plan.block_schedules()
 
-    marker = marker_prefix + 'block_start'
-    # print(f"Pushing Marker: {marker}")
-    lsl_outlet.push_sample([marker])    
-        
-###########
-# Flicker
-###########
+    # Record every flip so each block can be checked for dropped frames and the delivered flicker frequencies
+    flip_timer = FlipTimer(win, refresh_rate, thisExp.dataFileName,
+                           capacity=max(schedule.n_frames for schedule in block_schedules) + int(refresh_rate))
 
-    if expt_mode == 'Flicker':
-        
-        frame_count = 0
-        
-        # This loop executes each frame for the duration of the flicker cycle -> Speed of code here is key
-        for _ in range(int(refresh_rate * flicker_trial_time)): 
-            
-            # Check for key presses to exit early
-            if 'escape' in event.getKeys():
-                thisExp.status = FINISHED
-                if thisExp.status == FINISHED:
-                    endExperiment(thisExp, win=win)                    
-                    
-            # Increment frame count
-            frame_count += 1
-            
-            # Loop through the flickering stimuli 
-            for image_stim, flicker_period in zip(image_stims, flicker_frames_per_cycle):
-                                
-                # Determine whether to show or hide the stimulus based on frame count
-                if (frame_count % flicker_period) < (flicker_period / 2):
-                    image_stim.setAutoDraw(True)  # Show the stimulus
-                else:
-                    image_stim.setAutoDraw(False)  # Hide the stimulus
-
-            # Flip the window to update the display
-            win.flip()
+    #############################
+    # Main Loop 
+    ##############################
 
-        marker =  marker_prefix + 'block_end'
-        # print(f"Pushing Marker: {marker}")
-        lsl_outlet.push_sample([marker])
-        
-###########
-# Oddball
-###########
+    # Send the frequencies at the beginning, and only once
+    if expt_mode in FLICKER_CONDITIONS:
+    
+        # Push the frequency for each stimulus -> 'loc_<n>/freq_<frequency>'
+        for marker in plan.freq_marker_list():
+            # print(f"Pushing Marker: {marker}")
+            marker_dispatcher.push_now(marker)
 
-    elif expt_mode == 'Oddball':    
-        
-        randomized_stim_list = generate_randomized_list(image_stims, repeats=num_trials)
+    # Outer Block loop
+    for block in range(num_blocks): # 6 blocks
+    
+        win.mouseVisible = False # Make mouse invisible after showing flash_q_form
+    
+        print(f"Starting Block: {block}")
     
-        for image_stim in randomized_stim_list:
+        # Render the composite frames of the block before anything is shown
+        composites = frame_cache.prepare(block_schedules[block]) if frame_cache is not None else None
+        block_gc.begin_block()
+    
+        t = routine_timer.getTime()
+        cue_started = False    
+        target_loc = target_order[block]
+    
+        # Draw the target highlight for 2 seconds
+        for n in range(num_locations):
+            grey_sil[n].setAutoDraw(True)  # Set the silhouette to auto draw
         
-            if 'escape' in event.getKeys():
-                thisExp.status = FINISHED
-                if thisExp.status == FINISHED:
-                    endExperiment(thisExp, win=win)  
-            
-            # Determine the location of the current stimulus and push target/non-target marker
-            for loc_n, location in enumerate(locations):
-                
-                if np.array_equal(location, image_stim.pos):  # Check the position of the stimulus
-                    
-                    if loc_n == target_loc:
-                        marker = marker_prefix  + 'target/' + 'loc_' + str(loc_n)
-                    else:
-                        marker = marker_prefix + 'nontarget/' + 'loc_' + str(loc_n)
-                        
-                    # print(f"Pushing Marker: {marker}")
-                    lsl_outlet.push_sample([marker])
-
-                silhouettes[loc_n].draw()
-            
-            # Draw the image
-            image_stim.draw()
-
-            # Flip the window to show the image
-            win.flip()
-
-            # Show the white stim for 500ms
-            core.wait(highlight_duration)
-            
-            # Draw all the silhouettes and wait for 250ms before showing next stim
-            for sil in silhouettes:
-                sil.draw()
-            win.flip()
-            core.wait(between_trial_duration)
-
-        marker = marker_prefix + 'block_end'
+            if n == target_loc:
+                target_markers[n].setAutoDraw(True)  # Set the target marker to auto draw
+                marker = plan.block_marker(block, 'target_marker')
+                # print(f"Pushing Marker: {marker}")
+                marker_dispatcher.on_flip(marker)
+
+        while routine_timer.getTime() - t <= target_id_duration:
+            check_abort()
+            win.flip()  # Flip the window to show the silhouettes and target markers
+
+        # After the duration, set the silhouettes and target markers to not auto draw
+        for n in range(num_locations):
+            grey_sil[n].setAutoDraw(False)
+            target_markers[n].setAutoDraw(False)
+
+        marker = plan.block_marker(block, 'block_start')
         # print(f"Pushing Marker: {marker}")
-        lsl_outlet.push_sample([marker])
-
-###########
-# FlickerOddball
-###########
-
-    elif expt_mode == 'FlickerOddball':
+        marker_dispatcher.on_flip(marker) # Stamped with the first frame of the block
         
-        # Generate a randomized list of stimuli, with each stimulus repeated 10 times
-        randomized_stim_list = generate_randomized_list(image_stims, repeats=num_trials)
-        
-        for image_stim in randomized_stim_list:
-            
-            frame_count = 0
-            
-            # Determine the target or non-target marker based on stimulus position
-            loc_index = locations.index(tuple(image_stim.pos))  # Find the index of the stimulus location
-            
-            if loc_index == target_loc:
-                marker = marker_prefix + f'target/loc_{loc_index}'
-            else:
-                marker = marker_prefix + f'nontarget/loc_{loc_index}'
-                
-            # Check for key presses to exit early
-            if 'escape' in event.getKeys():
-                thisExp.status = FINISHED
-                if thisExp.status == FINISHED:
-                    endExperiment(thisExp, win=win)  
-            
-            # print(f"Pushing Marker: {marker}")
-            lsl_outlet.push_sample([marker])
-
-            # Execute the flicker loop for the duration of the flicker time
-            for _ in range(int(refresh_rate * flickeroddball_flicker_time)):
-                # Increment frame count for flickering
-                frame_count += 1
-
-                # Loop through all the locations and flicker both silhouettes and image stimuli
-                for loc_n, flicker_period in enumerate(flicker_frames_per_cycle):
-
-                    # If the current location is where the red face should appear, flicker it
-                    if loc_n == loc_index:
-                        if (frame_count % flicker_period) < (flicker_period / 2):
-                            image_stim.setAutoDraw(True)  # Show the red face
-                        else:
-                            image_stim.setAutoDraw(False)  # Hide the red face
-                    else:
-                        # Flicker the silhouette (white face) at other locations
-                        if (frame_count % flicker_period) < (flicker_period / 2):
-                            silhouettes[loc_n].setAutoDraw(True)  # Show the silhouette
-                        else:
-                            silhouettes[loc_n].setAutoDraw(False)  # Hide the silhouette
-
-                # Flip the window to update the display
-                win.flip()
-            
-            # After the flicker loop, clear the autoDraw for both current_red_face and silhouettes
-
-            #### NEW 250ms PERIOD WHERE ONLY SILHOUETTES FLICKER ####
-            frame_count = 0
-
-            # Clear the autoDraw for both current image_stim and silhouettes
-            image_stim.setAutoDraw(False)
-            for sil in silhouettes:
-                sil.setAutoDraw(False)
-            win.flip(clearBuffer=True) 
-            
-            # Flicker only the silhouettes for 250ms before the next trial                
-            for _ in range(int(refresh_rate * between_trial_duration)):
-                # Increment frame count
-                frame_count += 1
-
-                # Flicker the silhouettes only (red face is turned off during this period)
-                for loc_n, flicker_period in enumerate(flicker_frames_per_cycle):
-                    
-                    # Flicker the silhouette (white face) at other locations
-                    if (frame_count % flicker_period) < (flicker_period / 2):
-                        silhouettes[loc_n].setAutoDraw(True)  # Show the silhouette
-                    else:
-                        silhouettes[loc_n].setAutoDraw(False)  # Hide the silhouette
-
-                # Flip the window to update the display
-                win.flip()            
-            
-            # After the flicker loop, clear the autoDraw for both current image_stim and silhouettes
-            image_stim.setAutoDraw(False)
-            for sil in silhouettes:
-                sil.setAutoDraw(False)
-                
-        # Record the end of the block and push marker to LSL
-        marker = marker_prefix + 'block_end'
+    ###########
+    # Block trials -> Flicker, Oddball, FlickerOddball, DannyFlicker & DannyFlickerOddball
+    ###########
+
+        # Play the precompiled on/off table -> Speed of code here is key
+        decode_erp = online_erp is not None and expt_mode in ODDBALL_CONDITIONS
+        if decode_erp:
+            online_erp.start_block()
+        flip_timer.begin_block()
+        n_played = play_schedule(win, block_schedules[block], renderer, marker_dispatcher.on_flip,
+                                 check_abort=check_abort, check_interval=abort_check_interval, composites=composites,
+                                 stop_early=online_erp.decided if decode_erp else None)
+        flip_timer.end_block(f'block_{block}', on=block_schedules[block].on,
+                             periods=flicker_frames_per_cycle, target_freqs=flicker_freqs)
+        block_gc.end_block()
+
+        marker = plan.block_marker(block, 'block_end')
         # print(f"Pushing Marker: {marker}")
-        lsl_outlet.push_sample([marker])
-
+        marker_dispatcher.push_now(marker)
+        if decode_erp:
+            thisExp.addData('erp.frames_played', n_played)
+            erp_decision = online_erp.decision
+            if erp_decision is not None:
+                print(f"ERP decoder: loc_{erp_decision.location} (p = {erp_decision.posterior:.2f}) after "
+                      f"{erp_decision.n_flashes} flashes, block ended at frame {n_played}")
+                thisExp.addData('erp.decision', erp_decision.location)
+                thisExp.addData('erp.posterior', erp_decision.posterior)
+                thisExp.addData('erp.n_flashes', erp_decision.n_flashes)
+        data_writer.flush() # Written by the writer thread, while the form or the wait is shown
         win.clearBuffer()
 
-######################
-# Danny Conditions 
-######################
-
-###########
-# DannyFlicker
-###########
-
-    if expt_mode == 'DannyFlicker':
-        
-        frame_count = 0
-
-        # This loop repeats the start/stop flickering X times before a new target is selected
-        for repeat_n in range(danny_flicker_repeats):
-            
-            # Draws all the images during the 1s wait
-            for image_stim in image_stims:
-                image_stim.draw()
-            win.flip()
-
-            core.wait(danny_flicker_inter_trial_time) # 1s wait time before all flickering again
-
-            ## Temporary code for if LSL markers are wanted on each repeat
-            marker = marker_prefix + f'repeat_{repeat_n + 1}' # Add one to the repeat_n so that we don't get 0
-            # print(f"Pushing Marker: {marker}")
-            lsl_outlet.push_sample([marker])
-            
-            # Check for key presses to exit early
-            if 'escape' in event.getKeys():
-                thisExp.status = FINISHED
-                if thisExp.status == FINISHED:
-                    endExperiment(thisExp, win=win)  
+    ###########################################
+    # Show Flash Count Form
+    ###########################################
+        if expt_mode in ['Oddball', 'FlickerOddball', 'DannyFlickerOddball']:
         
-            # This loop executes each frame for the duration of the flicker cycle -> Speed of code here is key
-            for _ in range(int(refresh_rate * danny_flicker_trial_time)): # 5 seconds
-
-                # Increment frame count
-                frame_count += 1
-                
-                # Loop through the flickering stimuli
-                for image_stim, flicker_period in zip(image_stims, flicker_frames_per_cycle):
-                    
-                    # Determine whether to show or hide the stimulus based on frame count
-                    if (frame_count % flicker_period) < (flicker_period / 2):
-                        image_stim.setAutoDraw(True)  # Show the stimulus
-                    else:
-                        image_stim.setAutoDraw(False)  # Hide the stimulus
-
-                # Flip the window to update the display
-                win.flip()
-            
-            win.clearBuffer()
-
-        marker =  marker_prefix + 'block_end'
-        # print(f"Pushing Marker: {marker}")
-        lsl_outlet.push_sample([marker])
-
-###########
-# DannyFlickerOddball
-###########
-
-    elif expt_mode == 'DannyFlickerOddball':
-
-        stim_flicker_list = generate_randomized_list_with_flicker(image_stims, flicker_frames_per_cycle, repeats=num_trials)
-
-        frame_count = 0
-
-        for stim, flicker_period in stim_flicker_list:
-            start_time = time.time()  # Record the start time
-
-            # Compare current image_stim position with the target location directly
-            if np.array_equal(stim.pos, locations[target_loc]):
-                marker = marker_prefix + f'target/loc_{target_loc}'
-            else:
-                loc_index = locations.index(tuple(stim.pos))  # Find the index of the current stim location
-                marker = marker_prefix + f'nontarget/loc_{loc_index}'
-            
+            marker = plan.block_marker(block, 'flash_count_start')
             # print(f"Pushing Marker: {marker}")
-            lsl_outlet.push_sample([marker])
-            
-            # This loop draws the silhouettes at non-target locations
-            for loc_n in range(len(locations)):
-                
-                # Reset autoDraw for all the silhouettes
-                silhouettes[loc_n].autoDraw = False
-
-                # Set autoDraw for the silhouettes at non-target locations
-                if not np.array_equal(locations[loc_n], stim.pos):
-                    
-                    silhouettes[loc_n].autoDraw = True
-            
-            if 'escape' in event.getKeys():
-                thisExp.status = FINISHED
-                if thisExp.status == FINISHED:
-                    endExperiment(thisExp, win=win)
-                
-            # This loop executes each frame for the duration of the flicker cycle -> Speed of code here is key            
-            for _ in range(int(refresh_rate * danny_flickeroddball_flicker_time)):
-                
-                # Increment the frame count
-                frame_count += 1
-                
-                if (frame_count % flicker_period) < (flicker_period / 2):
-                    stim.setAutoDraw(True)
-                else:
-                    stim.setAutoDraw(False)  
-
-                win.flip()
-                
-            # After flickering, draw all the silhouettes and wait for 250ms before showing next stim
-            for sil in silhouettes:
-                sil.draw()
-            win.flip()
-            core.wait(between_trial_duration)
-                
-        marker = marker_prefix + 'block_end'
-        # print(f"Pushing Marker: {marker}")
-        lsl_outlet.push_sample([marker])
-        win.clearBuffer()
-
-###########################################
-# Show Flash Count Form
-###########################################
-    if expt_mode in ['Oddball', 'FlickerOddball', 'DannyFlickerOddball']:
-        
-        marker = marker_prefix + 'flash_count_start'
-        # print(f"Pushing Marker: {marker}")
-        lsl_outlet.push_sample([marker])
+            marker_dispatcher.push_now(marker)
         
-        exec = environmenttools.setExecEnvironment(globals())
-        win.mouseVisible = True
-        mouse = event.Mouse(win=win)
-        x, y = [None, None]
-        mouse.mouseClock = core.Clock()
-
-        globalClock = core.Clock() 
-        routineTimer = core.Clock()  # to track time remaining of each (possibly non-slip) routine
-        frameTolerance = 0.001  # how close to onset before 'same' frame
-
-        # Creates the form
-        flash_form = create_form('flash', flash_q_items[:2])
-        flash_forms = [flash_form]
-
-        for f_idx, form in enumerate(flash_forms):
-            continueRoutine = True
-            # update component parameters for each repeat
-            thisExp.addData(form.name + '.started', globalClock.getTime())
-            # setup some python lists for storing info about the mouse
-            mouse.x = []
-            mouse.y = []
-            mouse.leftButton = []
-            mouse.midButton = []
-            mouse.rightButton = []
-            mouse.time = []
-            mouse.clicked_name = []
-            gotValidClick = False  # until a click is received
-            # keep track of which components have finished
-            clickable_img = clickable_buttons[f_idx]
-            questions_Components = [form, mouse, clickable_img]
-            for thisComponent in questions_Components:
-                thisComponent.tStart = None
-                thisComponent.tStop = None
-                thisComponent.tStartRefresh = None
-                thisComponent.tStopRefresh = None
-                if hasattr(thisComponent, 'status'):
-                    thisComponent.status = NOT_STARTED
-            # reset timers
-            t = 0
-            _timeToFirstFrame = win.getFutureFlipTime(clock="now")
-            frameN = -1
-            
-            # --- Run Routine "questions" ---
-            routineForceEnded = not continueRoutine
-            while continueRoutine:
-                # get current time
-                t = routineTimer.getTime()
-                tThisFlip = win.getFutureFlipTime(clock=routineTimer)
-                tThisFlipGlobal = win.getFutureFlipTime(clock=None)
-                frameN = frameN + 1  # number of completed frames (so 0 is the first frame)
-                # update/draw components on each frame
-                
-                # *form* updates
-                
-                # if form is starting this frame...
-                if form.status == NOT_STARTED and tThisFlip >= 0-frameTolerance:
-                    # keep track of start time/frame for later
-                    form.frameNStart = frameN  # exact frame index
-                    form.tStart = t  # local t and not account for scr refresh
-                    form.tStartRefresh = tThisFlipGlobal  # on global time
-                    win.timeOnFlip(form, 'tStartRefresh')  # time at next scr refresh
-                    # add timestamp to datafile
-                    thisExp.timestampOnFlip(win, 'form.started')
-                    # update status
-                    form.status = STARTED
-                    form.setAutoDraw(True)
-                
-                # if form is active this frame...
-                if form.status == STARTED:
-                    # update params
-                    pass
-                # *mouse* updates
-                
-                # if mouse is starting this frame...
-                if mouse.status == NOT_STARTED and t >= 0.0-frameTolerance:
-                    # keep track of start time/frame for later
-                    mouse.frameNStart = frameN  # exact frame index
-                    mouse.tStart = t  # local t and not account for scr refresh
-                    mouse.tStartRefresh = tThisFlipGlobal  # on global time
-                    win.timeOnFlip(mouse, 'tStartRefresh')  # time at next scr refresh
-                    # add timestamp to datafile
-                    thisExp.addData('mouse.started', t)
-                    # update status
-                    mouse.status = STARTED
-                    mouse.mouseClock.reset()
-                    prevButtonState = mouse.getPressed()  # if button is down already this ISN'T a new click
-                if mouse.status == STARTED:  # only update if started and not finished!
-                    buttons = mouse.getPressed()
-                    if buttons != prevButtonState:  # button state changed?
-                        prevButtonState = buttons
-                        if sum(buttons) > 0:  # state changed to a new click
-                            # check if the mouse was inside our 'clickable' objects
-                            gotValidClick = False
-                            clickableList = environmenttools.getFromNames(clickable_img, namespace=locals())
-                            for obj in clickableList:
-                                # is this object clicked on?
-                                if obj.contains(mouse):
-                                    gotValidClick = True
-                                    mouse.clicked_name.append(obj.name)
-                            x, y = mouse.getPos()
-                            mouse.x.append(x)
-                            mouse.y.append(y)
-                            buttons = mouse.getPressed()
-                            mouse.leftButton.append(buttons[0])
-                            mouse.midButton.append(buttons[1])
-                            mouse.rightButton.append(buttons[2])
-                            mouse.time.append(mouse.mouseClock.getTime())
-                            if gotValidClick:
-                                continueRoutine = False  # end routine on response
-                
-                # *clickable_img* updates
-                
-                # if clickable_img is starting this frame...
-                if clickable_img.status == NOT_STARTED and tThisFlip >= 0.0-frameTolerance and form.complete == True:
-                    # keep track of start time/frame for later
-                    clickable_img.frameNStart = frameN  # exact frame index
-                    clickable_img.tStart = t  # local t and not account for scr refresh
-                    clickable_img.tStartRefresh = tThisFlipGlobal  # on global time
-                    win.timeOnFlip(clickable_img, 'tStartRefresh')  # time at next scr refresh
-                    # add timestamp to datafile
-                    thisExp.timestampOnFlip(win, 'clickable_img.started')
-                    # update status
-                    clickable_img.status = STARTED
-                    clickable_img.setAutoDraw(True)
-                
-                # if clickable_img is active this frame...
-                if clickable_img.status == STARTED:
-                    # update params
-                    pass
-                
-                # check for quit (typically the Esc key)
-                if event.getKeys(keyList=["escape"]):
-                    thisExp.status = FINISHED
-                if thisExp.status == FINISHED:
-                    endExperiment(thisExp, win=win)
-                    # return
-                
-                # check if all components have finished
-                if not continueRoutine:  # a component has requested a forced-end of Routine
-                    routineForceEnded = True
-                    break
-                continueRoutine = False  # will revert to True if at least one component still running
-                for thisComponent in questions_Components:
-                    if hasattr(thisComponent, "status") and thisComponent.status != FINISHED:
-                        continueRoutine = True
-                        break  # at least one component has not yet finished
-                
-                # refresh the screen
-                if continueRoutine:  # don't flip if this routine is over or we'll get a blank screen
-                    win.flip()
-            
-            for thisComponent in questions_Components:
-                if hasattr(thisComponent, "setAutoDraw"):
-                    thisComponent.setAutoDraw(False)
-            thisExp.addData(form.name + '.stopped', globalClock.getTime())
-            form.addDataToExp(thisExp, 'rows')
-            form.autodraw = False
-            # store data for thisExp (ExperimentHandler)
-            thisExp.addData('mouse.x', mouse.x)
-            thisExp.addData('mouse.y', mouse.y)
-            thisExp.addData('mouse.leftButton', mouse.leftButton)
-            thisExp.addData('mouse.midButton', mouse.midButton)
-            thisExp.addData('mouse.rightButton', mouse.rightButton)
-            thisExp.addData('mouse.time', mouse.time)
-            thisExp.addData('mouse.clicked_name', mouse.clicked_name)
+            win.mouseVisible = True
+            flash_count.run(thisExp)
             thisExp.nextEntry()
-            # the Routine "flash_count_forms" was not non-slip safe, so reset the non-slip timer
-            routineTimer.reset()
-    else: # Only wait when form isn't shown ('Flicker' condition)
-        core.wait(inter_block_interval)
+            data_writer.add_row(thisExp.entries[-1])
+        else: # Only wait when form isn't shown ('Flicker' condition)
+            wait_start = routine_timer.getTime()
+            while routine_timer.getTime() - wait_start < inter_block_interval:
+                check_abort()
+                core.wait(0.01)
+    
+    # --- Tidy up the condition ---
+    flip_timer.detach()
+    if condition_n < len(conditions) - 1:
+        # Save now; the next condition gets its own data files
+        marker_dispatcher.wait_until_sent()
+        marker_dispatcher.mirror = None
+        data_writer.close()
+        print(data_writer.report())
+        saveData(thisExp)
+        thisExp.abort() # Already saved - don't save again on exit
+        logging.flush()
+        logging.root.removeTarget(logFile)
 
 # --- Tidy up, save, and exit ---
 endExperiment(thisExp, win=win)
@@ -0,0 +1,143 @@
+"""
+Deterministic, cached loading of the experiment images.
+
+Image sets are listed in natural order (`sil_grey_2.png` before `sil_grey_10.png`) rather than in
+whatever order `os.listdir` returns, and are checked to hold one image per location, so a location
+always gets the same image.
+
+Decoded images are kept in `asset_cache/` as RGBA `.npy` files, already downscaled to the size
+they are drawn at on the current monitor. The files are named after a hash of the source image and
+the target size, so an edited image or a different monitor gets a new entry. On later launches
+they are memory-mapped instead of decoding the PNGs again, and the textures uploaded to the GPU
+are no larger than what is drawn.
+"""
+import hashlib
+import os
+import os.path as op
+import re
+import time
+
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+CACHE_VERSION = 1  # bump when the cached format changes
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def list_images(folder, n_images=None):
+    """
+    Image files of `folder` in natural order.
+
+    Parameters
+    ==========
+    folder : str
+        Folder of an image set, e.g. `images/white_faces`.
+    n_images : int or None
+        Number of images the set must have (one per location).
+
+    Returns
+    ==========
+    list of str
+    """
+    files = sorted((f for f in os.listdir(folder)
+                    if op.splitext(f)[1].lower() in IMAGE_EXTENSIONS and op.isfile(op.join(folder, f))),
+                   key=_natural_key)
+    if n_images is not None and len(files) != n_images:
+        raise ValueError(f'{folder} has {len(files)} images, {n_images} are needed (one per location)')
+    return [op.join(folder, f) for f in files]
+
+
+def resolve_path(path):
+    """
+    `path`, or the file in the same folder whose name only differs in case
+    (`oddball_instruct.png` -> `oddball_instruct.PNG` on case-sensitive file systems).
+    """
+    if op.exists(path):
+        return path
+    folder, name = op.split(path)
+    matches = [f for f in os.listdir(folder or '.') if f.lower() == name.lower()]
+    if not matches:
+        raise FileNotFoundError(path)
+    return op.join(folder, matches[0])
+
+
+def deg_to_pix(deg, monitor_width, resolution, view_dist):
+    """Size in pixels of `deg` degrees of visual angle (as PsychoPy's `deg2pix`, without distortion correction)."""
+    return deg * view_dist * np.pi / 180 * resolution[0] / monitor_width
+
+
+class AssetCache:
+    """
+    Decode images once and memory-map them afterwards.
+
+    Parameters
+    ==========
+    cache_dir : str
+        Folder for the cached arrays (created if needed).
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.n_hits = 0
+        self.n_misses = 0
+        self.load_time = 0.0
+
+    def _cache_file(self, path, size):
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:16]
+        stem = op.splitext(op.basename(path))[0].replace(' ', '_')
+        size_tag = 'full' if size is None else f'{size[0]}x{size[1]}'
+        return op.join(self.cache_dir, f'{stem}_{digest}_{size_tag}_v{CACHE_VERSION}.npy')
+
+    def load_array(self, path, size=None):
+        """
+        RGBA pixels of an image.
+
+        Parameters
+        ==========
+        path : str
+            Image file.
+        size : tuple of int or None
+            `(width, height)` in pixels the image is drawn at. Larger images are downscaled to it;
+            smaller ones are kept at their own size (the GPU scales them up just as well).
+
+        Returns
+        ==========
+        np.ndarray of uint8, shape (height, width, 4)
+            Read-only memory map of the cached array.
+        """
+        t = time.perf_counter()
+        size = None if size is None else (int(round(size[0])), int(round(size[1])))
+        cache_file = self._cache_file(path, size)
+        if op.exists(cache_file):
+            self.n_hits += 1
+        else:
+            self.n_misses += 1
+            from PIL import Image
+
+            with Image.open(path) as im:
+                im = im.convert('RGBA')
+                if size is not None and (im.width > size[0] or im.height > size[1]):
+                    im = im.resize((min(size[0], im.width), min(size[1], im.height)), Image.LANCZOS)
+                pixels = np.asarray(im, dtype=np.uint8)
+            # Write to a temporary file first so an interrupted launch never leaves a broken entry
+            tmp_file = cache_file + f'.{os.getpid()}.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.save(f, pixels)
+            os.replace(tmp_file, cache_file)
+        pixels = np.load(cache_file, mmap_mode='r')
+        self.load_time += time.perf_counter() - t
+        return pixels
+
+    def load(self, path, size=None):
+        """Image for `visual.ImageStim(image=...)`, see `load_array`."""
+        from PIL import Image
+
+        return Image.fromarray(self.load_array(path, size))
+
+    def report(self):
+        return (f"Images: {self.n_hits + self.n_misses} loaded ({self.n_hits} from the cache) "
+                f"in {self.load_time * 1000:.0f} ms")
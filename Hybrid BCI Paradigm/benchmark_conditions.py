@@ -0,0 +1,188 @@
+"""
+Headless benchmark of the block loops of all five Hybrid BCI conditions.
+
+Runs one block of each condition through `play_schedule` against the stand-ins in `null_backend`
+(no display, no LSL, no LabRecorder) at the refresh rates of the monitors in the `screens` dict of
+`BCI_Paradigm_24-25.py`, and reports per-frame CPU time percentiles, bytes allocated per frame
+(tracemalloc), garbage collections during the block and draw calls per frame for each render
+backend. Blocks run with the collector frozen (`block_gc.BlockGC`) as in the experiment, unless
+`--no-gc-freeze` is given.
+
+The null window doesn't wait for the refresh, so the per-frame time is the Python cost of a frame
+(playing the schedule, updating the renderer, pushing markers and drawing the autoDraw list).
+
+Usage:
+    python benchmark_conditions.py
+    python benchmark_conditions.py --monitors Alienware --backends autodraw elementarray
+    python benchmark_conditions.py --max-p99-ms 1.0    # exit code 1 if any run is slower
+    python benchmark_conditions.py --no-gc-freeze      # compare with the collector running
+"""
+import argparse
+import gc
+import json
+import os.path as op
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from shared_modules import use_shared
+
+use_shared()  # block_gc and flip_timing are in ../shared
+
+from block_gc import BlockGC
+from flip_timing import FlipTimer
+from frame_schedule import CONDITIONS, compile_block_schedule, play_schedule
+from marker_dispatch import MarkerDispatcher
+from null_backend import NullWindow, NullStim, NullElementArrayStim, NullOutlet
+from session_plan import SCRIPT, TIMING_NAMES, read_script_constants
+from stimulus_renderers import create_renderer
+
+expt_root = op.dirname(op.abspath(__file__))
+
+
+def make_layers(win, locations, size=5):
+    """Null stimuli with the real image files, for `(silhouettes, image_stims)`."""
+    layers = []
+    for folder, stem in [('sil_grey', 'sil_grey'), ('white_faces', 'face_white')]:
+        images = [op.join(expt_root, 'images', folder, f'{stem}_{n}.png') for n in range(len(locations))]
+        layers.append([NullStim(win, image=images[n], pos=locations[n], size=size) for n in range(len(locations))])
+    return tuple(layers)
+
+
+def run_block(expt_mode, refresh_rate, flicker_freqs, timing, backend, trace_alloc=False, freeze_gc=True, seed=0):
+    """
+    Play one block of a condition on a null window.
+
+    Returns
+    ==========
+    dict
+        Frame count, per-frame times (ms), per-frame allocations (bytes) and counters.
+    """
+    num_locations = len(flicker_freqs)
+    locations = [(round(8 * np.sin(2 * np.pi * n / num_locations), 4),
+                  round(8 * np.cos(2 * np.pi * n / num_locations), 4)) for n in range(num_locations)]
+    flicker_frames_per_cycle = [round(refresh_rate / freq, 0) for freq in flicker_freqs]
+
+    rng = np.random.default_rng(seed)
+    trial_locs = rng.permutation(np.tile(np.arange(num_locations), 10)).tolist()
+    schedule = compile_block_schedule(expt_mode, flicker_frames_per_cycle, refresh_rate, timing,
+                                      trial_locs=trial_locs, target_loc=0,
+                                      marker_prefix=expt_mode + '/block_0/')
+
+    win = NullWindow()
+    layers = make_layers(win, locations)
+    renderer = create_renderer(backend, win, layers,
+                               **({'stim_class': NullElementArrayStim} if backend == 'elementarray' else {}))
+    outlet = NullOutlet()
+    dispatcher = MarkerDispatcher(win, outlet, clock=time.perf_counter)
+    flip_timer = FlipTimer(win, refresh_rate, filename=None, capacity=schedule.n_frames)
+    block_gc = BlockGC(enabled=freeze_gc)
+
+    if trace_alloc:
+        tracemalloc.start()
+    block_gc.begin_block()
+    n_collections = sum(stats['collections'] for stats in gc.get_stats())
+    win.start_recording(schedule.n_frames, trace_alloc=trace_alloc)
+    flip_timer.begin_block()
+    play_schedule(win, schedule, renderer, dispatcher.on_flip, check_abort=lambda: None,
+                  check_interval=max(int(refresh_rate / 10), 1))
+    n_collections = sum(stats['collections'] for stats in gc.get_stats()) - n_collections
+    block_gc.end_block()
+    block_gc.close()
+    if trace_alloc:
+        tracemalloc.stop()
+    dispatcher.stop()
+    flip_timer.detach()
+
+    n = min(win.n_flips, schedule.n_frames)
+    return {'n_frames': n,
+            'frame_ms': np.diff(win.flip_times[:n]) * 1000,
+            'frame_alloc': win.frame_alloc[1:n],
+            'draws_per_frame': win.n_draws / n,
+            'autodraw_changes_per_frame': win.n_autodraw_changes / n,
+            'gc_collections': n_collections,
+            'markers': outlet.n_samples}
+
+
+def benchmark(monitors, backends, conditions, repeats=3, freeze_gc=True):
+    screens = read_script_constants(SCRIPT, {'screens'})['screens']
+    timing = read_script_constants(SCRIPT, set(TIMING_NAMES))
+    results = []
+    for monitor in monitors:
+        refresh_rate = screens[monitor]['refresh_rate']
+        flicker_freqs = screens[monitor]['flicker_freqs']
+        for expt_mode in conditions:
+            for backend in backends:
+                # Best of a few timing runs, then one run under tracemalloc for the allocations
+                runs = [run_block(expt_mode, refresh_rate, flicker_freqs, timing, backend, freeze_gc=freeze_gc)
+                        for _ in range(repeats)]
+                frame_ms = min((run['frame_ms'] for run in runs), key=lambda ms: np.percentile(ms, 99))
+                traced = run_block(expt_mode, refresh_rate, flicker_freqs, timing, backend, trace_alloc=True,
+                                   freeze_gc=freeze_gc)
+                results.append({'monitor': monitor,
+                                'refresh_rate': refresh_rate,
+                                'condition': expt_mode,
+                                'backend': backend,
+                                'n_frames': runs[0]['n_frames'],
+                                'budget_ms': 1000 / refresh_rate,
+                                'p50_ms': float(np.percentile(frame_ms, 50)),
+                                'p95_ms': float(np.percentile(frame_ms, 95)),
+                                'p99_ms': float(np.percentile(frame_ms, 99)),
+                                'max_ms': float(frame_ms.max()),
+                                'alloc_mean_bytes': float(traced['frame_alloc'].mean()),
+                                'alloc_max_bytes': float(traced['frame_alloc'].max()),
+                                'alloc_total_bytes': float(traced['frame_alloc'].sum()),
+                                'gc_collections': max(run['gc_collections'] for run in runs),
+                                'draws_per_frame': runs[0]['draws_per_frame'],
+                                'autodraw_changes_per_frame': runs[0]['autodraw_changes_per_frame'],
+                                'markers': runs[0]['markers'],
+                                })
+    return results
+
+
+def print_results(results):
+    header = (f"{'monitor':<18}{'Hz':>5} {'condition':<20}{'backend':<13}{'frames':>7}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'B/frame':>9}{'B max':>8}{'gc':>4}{'draws':>7}{'toggles':>9}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['monitor']:<18}{r['refresh_rate']:>5} {r['condition']:<20}{r['backend']:<13}{r['n_frames']:>7}"
+              f"{r['p50_ms']:>9.4f}{r['p95_ms']:>9.4f}{r['p99_ms']:>9.4f}{r['max_ms']:>9.3f}"
+              f"{r['alloc_mean_bytes']:>9.0f}{r['alloc_max_bytes']:>8.0f}{r['gc_collections']:>4}"
+              f"{r['draws_per_frame']:>7.2f}{r['autodraw_changes_per_frame']:>9.3f}")
+
+
+def main(argv=None):
+    screens = read_script_constants(SCRIPT, {'screens'})['screens']
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--monitors', nargs='+', default=list(screens), choices=list(screens))
+    parser.add_argument('--backends', nargs='+', default=['autodraw', 'elementarray'],
+                        choices=['autodraw', 'elementarray'])
+    parser.add_argument('--conditions', nargs='+', default=list(CONDITIONS), choices=list(CONDITIONS))
+    parser.add_argument('--repeats', type=int, default=3, help='timing runs per condition (best is kept)')
+    parser.add_argument('--no-gc-freeze', action='store_true', help='let the garbage collector run during the blocks')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--max-p99-ms', type=float,
+                        help='fail (exit code 1) if any 99th percentile frame time is above this')
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.monitors, args.backends, args.conditions, repeats=args.repeats,
+                        freeze_gc=not args.no_gc_freeze)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.max_p99_ms is not None:
+        slow = [r for r in results if r['p99_ms'] > args.max_p99_ms]
+        for r in slow:
+            print(f"FAIL {r['monitor']} {r['condition']} {r['backend']}: p99 {r['p99_ms']:.4f} ms > {args.max_p99_ms} ms")
+        return 1 if slow else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
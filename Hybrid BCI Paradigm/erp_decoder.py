@@ -0,0 +1,495 @@
+"""
+Online ERP (P300) decoder with dynamic stopping for the oddball conditions.
+
+`Oddball`, `FlickerOddball` and `DannyFlickerOddball` flash every location `num_trials` times per
+block. With a trained model, the experiment script (`online_erp_model`) ends a block as soon as the
+attended location is known from the EEG instead.
+
+The EEG is read from LSL on a background thread, low-pass filtered (the streaming FIR filter of
+`ssvep_decoder.py`) into a ring buffer. Each flash marker (`target`/`nontarget`, stamped with the
+flip that showed it) is queued as an epoch. Once the EEG up to the end of the epoch has arrived, the
+epoch is baseline-corrected and reduced to windowed means, then scored with the linear model. The
+log-likelihood ratio of the score (target vs non-target score distributions of the model) is added
+to the evidence for the flashed location. The posterior over locations is a softmax of the
+evidence; when one location reaches `threshold` (after `min_repeats` flashes of every location), the
+decision is set and `play_schedule` ends the block before the next trial. The marker status is not
+used for decoding, only to report the accuracy.
+
+A model is a shrinkage-LDA on windowed means, fitted with `ERPModel.fit` and saved as `.npz`. The
+epochs exported from the analysis notebook (`np.savez(file, data=epochs.get_data(), labels=...,
+sfreq=..., tmin=...)`) can be used to train one:
+    python erp_decoder.py --train sub-123_epochs.npz --out sub-123_erp_model.npz
+    python erp_decoder.py --simulate
+"""
+import argparse
+import os.path as op
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+from online_streams import LatencyLog, MarkerParser, itr_bits_per_min
+from ring_buffer import RingBuffer
+from session_plan import ODDBALL_CONDITIONS
+from ssvep_decoder import FilterBank
+
+ERPDecision = namedtuple('ERPDecision', ['location', 'posterior', 'n_flashes', 'timestamp'])
+
+
+class ERPModel:
+    """
+    Linear ERP classifier on windowed means.
+
+    Parameters
+    ==========
+    weights : np.ndarray
+        Weights of the features (n_windows x n_channels, window-major).
+    bias : float
+        Added to the weighted features.
+    sfreq : float
+        Sampling rate the model was trained at (Hz).
+    tmin, tmax : float
+        Epoch start and end relative to the flash (s); the part before 0 is the baseline.
+    n_windows : int
+        Number of windows the part after 0 is averaged in.
+    score_stats : tuple of float
+        Mean and SD of the scores of target and non-target epochs (out-of-fold),
+        `(target_mean, target_sd, nontarget_mean, nontarget_sd)`.
+    channels : list of int or None
+        Channels of the stream the model uses (all if None).
+    """
+    def __init__(self, weights, bias, sfreq, tmin=-0.1, tmax=0.8, n_windows=9, score_stats=(1.0, 1.0, -1.0, 1.0),
+                 channels=None):
+        self.weights = np.asarray(weights, dtype=float)
+        self.bias = float(bias)
+        self.sfreq = float(sfreq)
+        self.tmin, self.tmax = float(tmin), float(tmax)
+        self.n_windows = int(n_windows)
+        self.score_stats = tuple(float(s) for s in score_stats)
+        self.channels = None if channels is None else [int(c) for c in channels]
+        self.n_baseline = int(round(-self.tmin * self.sfreq))
+        self.n_samples = int(round((self.tmax - self.tmin) * self.sfreq))
+
+    def features(self, epochs):
+        """
+        Windowed means of baseline-corrected epochs, shape (n_epochs, n_samples, n_channels) ->
+        (n_epochs, n_windows x n_channels).
+        """
+        epochs = np.asarray(epochs, dtype=float)
+        if self.n_baseline:
+            epochs = epochs - epochs[:, :self.n_baseline].mean(axis=1, keepdims=True)
+        post = epochs[:, self.n_baseline:]
+        width = post.shape[1] // self.n_windows
+        post = post[:, :width * self.n_windows]
+        return post.reshape(post.shape[0], self.n_windows, width, post.shape[2]).mean(axis=2).reshape(post.shape[0], -1)
+
+    def score(self, epochs):
+        return self.features(epochs) @ self.weights + self.bias
+
+    def log_likelihood_ratio(self, scores):
+        """log p(score | target) - log p(score | non-target), with Gaussian score distributions."""
+        m1, s1, m0, s0 = self.score_stats
+        scores = np.asarray(scores, dtype=float)
+        return (np.log(s0 / s1) - 0.5 * ((scores - m1) / s1) ** 2 + 0.5 * ((scores - m0) / s0) ** 2)
+
+    @classmethod
+    def fit(cls, epochs, labels, sfreq, tmin=-0.1, n_windows=9, shrinkage=0.1, n_folds=5, channels=None, seed=0):
+        """
+        Fit a shrinkage LDA.
+
+        Parameters
+        ==========
+        epochs : np.ndarray, shape (n_epochs, n_samples, n_channels)
+            Epochs starting at `tmin` (s) relative to the flash.
+        labels : array_like of bool
+            True for target epochs.
+        shrinkage : float
+            Weight (0-1) of the scaled identity mixed into the feature covariance.
+        n_folds : int
+            Folds used to estimate the score distributions on epochs the model wasn't fitted on.
+
+        Returns
+        ==========
+        ERPModel
+        """
+        epochs = np.asarray(epochs, dtype=float)
+        labels = np.asarray(labels, dtype=bool)
+        tmax = tmin + epochs.shape[1] / sfreq
+        model = cls(np.zeros(0), 0.0, sfreq, tmin, tmax, n_windows, channels=channels)
+        features = model.features(epochs)
+
+        def lda(x, y):
+            mean1, mean0 = x[y].mean(axis=0), x[~y].mean(axis=0)
+            centred = np.concatenate([x[y] - mean1, x[~y] - mean0])
+            cov = centred.T @ centred / max(centred.shape[0] - 2, 1)
+            cov = (1 - shrinkage) * cov + shrinkage * np.trace(cov) / cov.shape[0] * np.eye(cov.shape[0])
+            w = np.linalg.solve(cov, mean1 - mean0)
+            return w, -w @ (mean1 + mean0) / 2
+
+        folds = np.random.default_rng(seed).permutation(labels.shape[0]) % n_folds
+        scores = np.empty(labels.shape[0])
+        for fold in range(n_folds):
+            test = folds == fold
+            w, b = lda(features[~test], labels[~test])
+            scores[test] = features[test] @ w + b
+        model.weights, model.bias = lda(features, labels)
+        model.score_stats = (scores[labels].mean(), scores[labels].std(), scores[~labels].mean(), scores[~labels].std())
+        return model
+
+    def save(self, filename):
+        np.savez(filename, weights=self.weights, bias=self.bias, sfreq=self.sfreq, tmin=self.tmin, tmax=self.tmax,
+                 n_windows=self.n_windows, score_stats=self.score_stats,
+                 channels=np.array(self.channels if self.channels is not None else [], dtype=int))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            channels = f['channels'].tolist() or None
+            return cls(f['weights'], f['bias'], f['sfreq'], f['tmin'], f['tmax'], f['n_windows'],
+                       tuple(f['score_stats']), channels)
+
+
+class ERPDecoder:
+    """
+    Epoch, score and accumulate the evidence of the flashes of one block.
+
+    Parameters
+    ==========
+    model : ERPModel
+    n_locations : int
+        Number of locations.
+    n_channels : int
+        Channels pushed (after `model.channels` is applied).
+    threshold : float
+        Posterior probability of a location that ends the block.
+    min_repeats : int
+        Flashes of every location scored before a decision can be made.
+    lowpass : float
+        Cut-off of the low-pass filter (Hz).
+    filter_length : float
+        Length of the low-pass filter (s). Epochs are complete half of it later.
+    buffer_duration : float
+        Seconds of filtered EEG kept (must cover the marker delay and an epoch).
+    """
+    def __init__(self, model, n_locations, n_channels, threshold=0.95, min_repeats=2, lowpass=15.0,
+                 filter_length=0.2, buffer_duration=10.0):
+        self.model = model
+        self.n_locations = n_locations
+        self.threshold = threshold
+        self.min_repeats = min_repeats
+        sfreq = model.sfreq
+        n_taps = int(filter_length * sfreq) // 2 * 2 + 1
+        self.filters = FilterBank([(0.0, lowpass)], sfreq, n_channels, n_taps)
+        self.filter_delay = self.filters.delay / sfreq
+        self.buffer = RingBuffer(n_channels, int(buffer_duration * sfreq))
+        self.pending = deque()  # (onset, location, is_target) of flashes not scored yet
+        self.n_scored = 0
+        self.score_time = LatencyLog()
+        self.start_block()
+
+    def start_block(self):
+        self.evidence = np.zeros(self.n_locations)
+        self.n_flashes = np.zeros(self.n_locations, dtype=int)
+        self.pending.clear()
+        self.decision = None
+        self.flash_labels = []  # (location, is_target) of the flashes scored, for the report
+
+    def add_flash(self, onset, location, is_target=None):
+        """Queue the epoch of a flash at `onset` (EEG stream time)."""
+        if self.decision is None:
+            self.pending.append((onset, location, is_target))
+
+    def posterior(self):
+        p = np.exp(self.evidence - self.evidence.max())
+        return p / p.sum()
+
+    def push(self, samples, timestamps):
+        """
+        Add a chunk of EEG, shape (n_samples, n_channels), and score the epochs it completes.
+
+        Returns
+        ==========
+        ERPDecision or None
+            The decision, on the chunk that reaches the threshold.
+        """
+        filtered = self.filters.process(np.asarray(samples, dtype=float))[:, 0]
+        self.buffer.write(filtered, np.asarray(timestamps) - self.filter_delay)
+        if self.decision is not None or not self.pending:
+            return None
+        newest = self.buffer.times[(self.buffer.n_written - 1) % self.buffer.capacity]
+        model = self.model
+        epochs, flashes = [], []
+        while self.pending and self.pending[0][0] + model.tmax <= newest:
+            onset, location, is_target = self.pending.popleft()
+            start = self.buffer.index_at(onset + model.tmin)
+            if start < self.buffer.first_index or start + model.n_samples > self.buffer.n_written:
+                continue  # no longer (or not entirely) in the buffer
+            epochs.append(self.buffer.read(start, start + model.n_samples)[0])
+            flashes.append((location, is_target))
+        if not epochs:
+            return None
+
+        t = time.perf_counter()
+        llr = model.log_likelihood_ratio(model.score(np.stack(epochs)))
+        for (location, is_target), value in zip(flashes, llr):
+            self.evidence[location] += value
+            self.n_flashes[location] += 1
+        self.flash_labels.extend(flashes)
+        self.n_scored += len(flashes)
+        self.score_time.add(time.perf_counter() - t)
+
+        p = self.posterior()
+        best = int(np.argmax(p))
+        if p[best] >= self.threshold and self.n_flashes.min() >= self.min_repeats:
+            self.decision = ERPDecision(best, float(p[best]), int(self.n_flashes.sum()),
+                                        float(timestamps[-1]))
+            self.pending.clear()
+        return self.decision
+
+
+class OnlineERP:
+    """
+    Run an `ERPDecoder` on an LSL EEG stream from a background thread.
+
+    The flashes come from the markers the experiment sends: pass `add_marker` the markers as they
+    are pushed (it has the signature of `MarkerDispatcher.mirror`).
+
+    Parameters
+    ==========
+    decoder : ERPDecoder
+    eeg_inlet : pylsl.StreamInlet
+        EEG inlet (see `online_streams.open_inlet`).
+    parser : MarkerParser or None
+        Needed for an 'int' marker stream (with the codebook).
+    max_chunk : int
+        Most samples pulled at once.
+    clock : callable or None
+        LSL clock, `pylsl.local_clock` by default.
+    """
+    def __init__(self, decoder, eeg_inlet, parser=None, max_chunk=64, clock=None):
+        if clock is None:
+            from pylsl import local_clock
+            clock = local_clock
+        self.decoder = decoder
+        self.eeg_inlet = eeg_inlet
+        self.parser = parser or MarkerParser()
+        self.max_chunk = max_chunk
+        self.clock = clock
+        self.channels = decoder.model.channels
+
+        self._commands = deque()  # ('start', block_n) or ('flash', onset, location, is_target)
+        self._block_n = 0
+        self._decision = (0, None)  # written by the thread only
+        self.decisions = []  # (decision, target location) of every block
+        self.latency = LatencyLog()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='OnlineERP', daemon=True)
+        self._thread.start()
+        return self
+
+    def start_block(self):
+        """Forget the evidence of the previous block (call before the block is played)."""
+        self._block_n += 1
+        self._commands.append(('start', self._block_n))
+
+    @property
+    def decision(self):
+        """ERPDecision of the current block, or None."""
+        block_n, decision = self._decision
+        return decision if block_n == self._block_n else None
+
+    def decided(self):
+        return self.decision is not None
+
+    def add_marker(self, timestamp, source, marker):
+        parts = self.parser.parse(marker)
+        if parts['condition'] in ODDBALL_CONDITIONS and parts['status'] in ('target', 'nontarget'):
+            self._commands.append(('flash', timestamp, parts['location'], parts['status'] == 'target'))
+
+    def _run(self):
+        decoder = self.decoder
+        block_n = 0
+        while self._running:
+            while self._commands:
+                command = self._commands.popleft()
+                if command[0] == 'start':
+                    block_n = command[1]
+                    decoder.start_block()
+                else:
+                    decoder.add_flash(*command[1:])
+            samples, timestamps = self.eeg_inlet.pull_chunk(timeout=0.02, max_samples=self.max_chunk)
+            if not timestamps:
+                continue
+            samples = np.asarray(samples)
+            if self.channels is not None:
+                samples = samples[:, self.channels]
+            was_decided = decoder.decision is not None
+            decision = decoder.push(samples, timestamps)
+            if decision is not None and not was_decided:
+                self.latency.add(self.clock() - decision.timestamp)
+                targets = [location for location, is_target in decoder.flash_labels if is_target]
+                self.decisions.append((decision, targets[0] if targets else None))
+                self._decision = (block_n, decision)
+
+    def stop(self, timeout=1.0):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def report(self):
+        return decision_report(self.decisions, self.decoder, self.latency)
+
+
+def decision_report(decisions, decoder, latency, n_flashes_full=None):
+    """Accuracy, flashes per selection and ITR of `(decision, target)` pairs."""
+    if not decisions:
+        return 'ERP decoder: no decisions'
+    scored = [(d, target) for d, target in decisions if target is not None]
+    flashes = np.array([d.n_flashes for d, _ in decisions])
+    line = f'ERP decoder: {len(decisions)} decisions after median {np.median(flashes):.0f} flashes'
+    if n_flashes_full:
+        line += f' (of {n_flashes_full})'
+    lines = [line]
+    if scored:
+        accuracy = np.mean([d.location == target for d, target in scored])
+        lines.append(f'  accuracy {accuracy:.0%} of {len(scored)}')
+    line = f'  scoring {decoder.score_time.summary()} ({decoder.n_scored} epochs)'
+    if latency.n:
+        line += f', decision latency {latency.summary()}'
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+def p300_template(sfreq, duration=0.8):
+    """P300-like waveform: a positive peak at 300 ms and a smaller negative one at 200 ms."""
+    t = np.arange(int(duration * sfreq)) / sfreq
+    return np.exp(-0.5 * ((t - 0.3) / 0.06) ** 2) - 0.4 * np.exp(-0.5 * ((t - 0.2) / 0.03) ** 2)
+
+
+def simulate_block(rng, sfreq, n_channels, trial_locs, target, soa, amplitude, gains):
+    """
+    Synthetic EEG of one oddball block: 1/f noise plus a P300 after every flash of the target.
+
+    Returns
+    ==========
+    eeg : np.ndarray, shape (n_samples, n_channels)
+    onsets : np.ndarray
+        Time of each flash from the start of the block (s).
+    """
+    onsets = 0.5 + np.arange(len(trial_locs)) * soa
+    n_samples = int((onsets[-1] + 1.5) * sfreq)
+    freqs = np.fft.rfftfreq(n_samples, 1 / sfreq)
+    spectrum = (rng.standard_normal((freqs.shape[0], n_channels))
+                + 1j * rng.standard_normal((freqs.shape[0], n_channels))) / np.sqrt(np.maximum(freqs, 1.0))[:, None]
+    eeg = np.fft.irfft(spectrum, n_samples, axis=0)
+    eeg /= eeg.std(axis=0)
+    template = p300_template(sfreq)
+    for onset, loc in zip(onsets, trial_locs):
+        if loc == target:
+            start = int(round(onset * sfreq))
+            eeg[start:start + template.shape[0]] += amplitude * template[:, None] * gains
+    return eeg, onsets
+
+
+def simulate(n_blocks=30, n_locations=6, n_trials=10, sfreq=250.0, n_channels=8, amplitude=1.0, soa=0.75,
+             threshold=0.95, chunk=0.04, seed=0):
+    """
+    Train a model on synthetic calibration blocks, then decode synthetic blocks chunk by chunk.
+
+    Returns
+    ==========
+    decisions : list of tuple
+        `(decision, target)` per block (decision None if the block ended undecided).
+    decoder : ERPDecoder
+    """
+    from trial_sequences import block_sequences
+
+    rng = np.random.default_rng(seed)
+    gains = rng.uniform(0.3, 1.0, n_channels)
+
+    # Calibration: 12 blocks with the epochs cut offline
+    tmin = -0.1
+    epochs, labels = [], []
+    for locs in block_sequences(12, n_locations, n_trials, seed=rng.integers(2 ** 32)):
+        target = int(rng.integers(n_locations))
+        eeg, onsets = simulate_block(rng, sfreq, n_channels, locs, target, soa, amplitude, gains)
+        for onset, loc in zip(onsets, locs):
+            start = int(round((onset + tmin) * sfreq))
+            epochs.append(eeg[start:start + int(0.9 * sfreq)])
+            labels.append(loc == target)
+    model = ERPModel.fit(np.stack(epochs), labels, sfreq, tmin=tmin)
+
+    decoder = ERPDecoder(model, n_locations, n_channels, threshold=threshold)
+    chunk_size = int(chunk * sfreq)
+    t0 = 0.0
+    decisions = []
+    for locs in block_sequences(n_blocks, n_locations, n_trials, seed=rng.integers(2 ** 32)):
+        target = int(rng.integers(n_locations))
+        eeg, onsets = simulate_block(rng, sfreq, n_channels, locs, target, soa, amplitude, gains)
+        timestamps = t0 + np.arange(eeg.shape[0]) / sfreq
+        decoder.start_block()
+        decision, n_queued = None, 0
+        for start in range(0, eeg.shape[0], chunk_size):
+            # Flashes are queued as their markers would arrive: once they have been shown
+            while n_queued < len(locs) and t0 + onsets[n_queued] <= timestamps[start]:
+                decoder.add_flash(t0 + onsets[n_queued], int(locs[n_queued]), locs[n_queued] == target)
+                n_queued += 1
+            decision = decoder.push(eeg[start:start + chunk_size], timestamps[start:start + chunk_size])
+            if decision is not None:
+                break
+        decisions.append((decision, target))
+        t0 = timestamps[-1] + 1 / sfreq
+    return decisions, decoder
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train or simulate the online ERP decoder')
+    parser.add_argument('--train', help=".npz with 'data' (epochs, channels, times), 'labels', 'sfreq' and 'tmin'")
+    parser.add_argument('--out', help='model file to write (default: <epochs>_erp_model.npz)')
+    parser.add_argument('--channels', type=int, nargs='+', help='channels of the stream to use (default: all)')
+    parser.add_argument('--windows', type=int, default=9)
+    parser.add_argument('--shrinkage', type=float, default=0.1)
+    parser.add_argument('--simulate', action='store_true', help='train and decode synthetic oddball blocks')
+    parser.add_argument('--threshold', type=float, default=0.95)
+    parser.add_argument('--amplitude', type=float, default=1.0, help='P300 amplitude of --simulate (noise SD = 1)')
+    args = parser.parse_args(argv)
+
+    if args.train:
+        with np.load(args.train) as f:
+            epochs = f['data'].transpose(0, 2, 1)  # MNE order -> (epochs, times, channels)
+            labels, sfreq, tmin = f['labels'].astype(bool), float(f['sfreq']), float(f['tmin'])
+        if args.channels:
+            epochs = epochs[:, :, args.channels]
+        model = ERPModel.fit(epochs, labels, sfreq, tmin=tmin, n_windows=args.windows, shrinkage=args.shrinkage,
+                             channels=args.channels)
+        out = args.out or op.splitext(args.train)[0] + '_erp_model.npz'
+        model.save(out)
+        m1, s1, m0, s0 = model.score_stats
+        print(f'{labels.sum()} target and {(~labels).sum()} non-target epochs, {epochs.shape[2]} channels: '
+              f"out-of-fold d' {(m1 - m0) / np.sqrt((s1 ** 2 + s0 ** 2) / 2):.2f} -> {out}")
+        return 0
+
+    if args.simulate:
+        n_locations, n_trials, soa = 6, 10, 0.75
+        decisions, decoder = simulate(threshold=args.threshold, amplitude=args.amplitude, soa=soa)
+        decided = [(d, target) for d, target in decisions if d is not None]
+        print(f'{len(decisions)} simulated blocks, {len(decided)} ended early')
+        print(decision_report(decided, decoder, LatencyLog(), n_flashes_full=n_locations * n_trials))
+        if decided:
+            accuracy = np.mean([d.location == target for d, target in decided])
+            selection_time = np.mean([d.n_flashes for d, _ in decided]) * soa
+            print(f'  {selection_time:.1f} s per selection instead of {n_locations * n_trials * soa:.0f} s: ITR '
+                  f'{itr_bits_per_min(n_locations, accuracy, selection_time):.1f} bits/min')
+        return 0
+
+    parser.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,169 @@
+"""
+Event-driven flash count response.
+
+The flash count question used to be a Builder-style routine: a new `Form`, `Mouse` and exec
+environment every block, and a `while continueRoutine` loop that redrew the whole form (text boxes,
+slider ticks and labels) on every frame. `FlashCountRoutine` is built once per session and only
+resets the form between blocks. While a mouse button is held (dragging the slider) the form is
+drawn directly, as it takes the slider input; it is captured into a single texture
+(`visual.BufferImageStim`) only when the button is released (and once at the start). Other frames
+draw that one texture. Clicks and ratings go into preallocated
+arrays, and `run` returns on the frame the continue button is clicked.
+"""
+import numpy as np
+
+
+class FlashCountRoutine:
+    """
+    Flash count question, reused for every block.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window for this experiment.
+    form : psychopy.visual.Form
+        The question (reset before each block).
+    button : psychopy.visual.ImageStim
+        Button that ends the routine, shown once the form is complete.
+    mouse : psychopy.event.Mouse or None
+        Mouse to read, one is created if None.
+    check_abort : callable or None
+        Called on every frame (e.g. ends the experiment once escape was pressed).
+    max_clicks : int
+        Clicks recorded per block.
+    max_blocks : int
+        Ratings kept for the session.
+    """
+    def __init__(self, win, form, button, mouse=None, check_abort=None, max_clicks=256, max_blocks=1000):
+        from psychopy import core, event
+
+        self.win = win
+        self.form = form
+        self.button = button
+        self.mouse = mouse if mouse is not None else event.Mouse(win=win)
+        self.check_abort = check_abort
+        self.clock = core.Clock()
+
+        # Clicks of the current block
+        self.n_clicks = 0
+        self.click_x = np.empty(max_clicks)
+        self.click_y = np.empty(max_clicks)
+        self.click_buttons = np.zeros((max_clicks, 3), dtype=np.int8)
+        self.click_time = np.empty(max_clicks)
+        self.click_on_button = np.zeros(max_clicks, dtype=bool)
+
+        # One rating per block
+        self.n_runs = 0
+        self.responses = np.full(max_blocks, np.nan)
+        self.response_times = np.full(max_blocks, np.nan)
+
+        self.n_frames = 0
+        self.n_redraws = 0
+        self.n_live = 0
+
+    def _record_click(self, buttons, t):
+        n = self.n_clicks
+        if n >= self.click_time.shape[0]:
+            return False
+        on_button = self._button_shown and bool(self.button.contains(self.mouse))
+        self.click_x[n], self.click_y[n] = self.mouse.getPos()
+        self.click_buttons[n] = buttons
+        self.click_time[n] = t
+        self.click_on_button[n] = on_button
+        self.n_clicks += 1
+        return on_button
+
+    def _stims(self):
+        return [self.form, self.button] if self._button_shown else [self.form]
+
+    def _redraw(self):
+        """Draw the form (which takes the slider input) and the button, and capture them."""
+        from psychopy import visual
+
+        self._frame = visual.BufferImageStim(self.win, stim=self._stims(), autoLog=False)
+        self.n_redraws += 1
+
+    def _draw_live(self):
+        """Draw the form and the button directly, while the slider is being dragged."""
+        for stim in self._stims():
+            stim.draw()
+        self.n_live += 1
+
+    def run(self, thisExp):
+        """
+        Show the question until the continue button is clicked and add the answer to `thisExp`.
+
+        Returns
+        ==========
+        float
+            The rating (NaN if the form didn't return one).
+        """
+        win, form, mouse = self.win, self.form, self.mouse
+        form.reset()
+        self.n_clicks = 0
+        self._button_shown = False
+
+        self.clock.reset()
+        thisExp.addData(form.name + '.started', self.clock.getTime())
+        thisExp.timestampOnFlip(win, 'form.started')
+        thisExp.addData('mouse.started', self.clock.getTime())
+        prev_buttons = mouse.getPressed()  # a button already down isn't a new click
+        self._redraw()
+        while True:
+            if self.check_abort is not None:
+                self.check_abort()
+            buttons = mouse.getPressed()
+            held = bool(sum(buttons))
+            released = False
+            if buttons != prev_buttons:
+                if held and self._record_click(buttons, self.clock.getTime()):
+                    break
+                released = not held
+                prev_buttons = buttons
+            if held:
+                self._draw_live()
+            else:
+                if released:
+                    self._redraw()
+                self._frame.draw()
+            if not self._button_shown and form.complete:
+                self._button_shown = True
+                thisExp.timestampOnFlip(win, 'clickable_img.started')
+                if held:
+                    self.button.draw()
+                else:
+                    self._redraw()
+            win.flip()
+            self.n_frames += 1
+
+        response = self._response()
+        if self.n_runs < self.responses.shape[0]:
+            self.responses[self.n_runs] = response
+            self.response_times[self.n_runs] = self.clock.getTime()
+        self.n_runs += 1
+
+        thisExp.addData(form.name + '.stopped', self.clock.getTime())
+        form.addDataToExp(thisExp, 'rows')
+        n = self.n_clicks
+        thisExp.addData('mouse.x', self.click_x[:n].tolist())
+        thisExp.addData('mouse.y', self.click_y[:n].tolist())
+        thisExp.addData('mouse.leftButton', self.click_buttons[:n, 0].tolist())
+        thisExp.addData('mouse.midButton', self.click_buttons[:n, 1].tolist())
+        thisExp.addData('mouse.rightButton', self.click_buttons[:n, 2].tolist())
+        thisExp.addData('mouse.time', self.click_time[:n].tolist())
+        thisExp.addData('mouse.clicked_name', [self.button.name] * int(self.click_on_button[:n].sum()))
+        return response
+
+    def _response(self):
+        for item in self.form.getData():
+            try:
+                return float(item['response'])
+            except (KeyError, TypeError, ValueError):
+                pass
+        return np.nan
+
+    def report(self):
+        if not self.n_runs:
+            return 'Flash count: not shown'
+        return (f"Flash count: {self.n_runs} answers, form captured {self.n_redraws} times and drawn directly on "
+                f"{self.n_live} of {self.n_frames} frames")
@@ -0,0 +1,104 @@
+"""
+Pre-rendered composite frames for the Hybrid BCI conditions.
+
+A block only ever shows a limited set of on/off combinations of its six locations (at most 64 in
+`Flicker`). Each distinct combination is rendered once at block start into an offscreen texture
+(`visual.BufferImageStim`, read from the FBO when `visual.useFBO` is on), and every frame of the
+block then becomes a single blit of the texture for its state.
+"""
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from stimulus_renderers import LAYER_BITS
+
+
+class FrameCache:
+    """
+    Least-recently-used cache of composite frames, shared across blocks.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window for this experiment.
+    layers : sequence
+        Stimuli for each layer, indexed `layers[layer][location]`.
+    max_bytes : int
+        Memory cap for the cached textures. States of earlier blocks are evicted to make room;
+        a block with more states than fit under the cap is played without the cache.
+    padding : int
+        Extra pixels captured around the stimuli.
+    """
+    def __init__(self, win, layers, max_bytes=512 * 2 ** 20, padding=4):
+        self.win = win
+        self.layers = layers
+        self.n_locations = len(layers[0])
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()  # state key -> BufferImageStim
+
+        # Capture a region centred on the screen that covers every location, so the captured
+        # textures are blitted back at the default position (0, 0)
+        half_w, half_h = padding, padding
+        for stim in (stim for layer in layers for stim in layer):
+            vertices = np.abs(np.asarray(stim.verticesPix))
+            half_w = max(half_w, vertices[:, 0].max() + padding)
+            half_h = max(half_h, vertices[:, 1].max() + padding)
+        win_w, win_h = win.size
+        half_w, half_h = min(half_w, win_w / 2), min(half_h, win_h / 2)
+        self.rect = [-2 * half_w / win_w, 2 * half_h / win_h, 2 * half_w / win_w, -2 * half_h / win_h]
+        self.state_bytes = int(np.ceil(2 * half_w) * np.ceil(2 * half_h) * 4)
+
+    @property
+    def nbytes(self):
+        return len(self._frames) * self.state_bytes
+
+    def _render(self, codes):
+        """Draw one on/off state into the back buffer and capture it as a texture."""
+        from psychopy import visual
+
+        # Silhouettes first, then images on top -> same order as the live renderers
+        stims = [stims[loc] for stims, bit in zip(self.layers, LAYER_BITS)
+                 for loc in range(self.n_locations) if codes[loc] & bit]
+        self.win.clearBuffer()
+        return visual.BufferImageStim(self.win, rect=self.rect, stim=stims, interpolate=False, autoLog=False)
+
+    def prepare(self, schedule):
+        """
+        Make sure every state of `schedule` is rendered, evicting older states if needed.
+
+        Returns
+        ==========
+        list or None
+            The composite frame to draw on each frame of the schedule, or None if the block has
+            more states than fit under `max_bytes` (play it with the live renderer instead).
+        """
+        t0 = time.perf_counter()
+        states, state_index = np.unique(schedule.codes, axis=0, return_inverse=True)
+        keys = [state.tobytes() for state in states]
+
+        if len(keys) * self.state_bytes > self.max_bytes:
+            print(f"Frame cache: {len(keys)} states need {len(keys) * self.state_bytes / 2 ** 20:.0f} MB "
+                  f"(cap {self.max_bytes / 2 ** 20:.0f} MB) -> rendering this block live")
+            return None
+
+        # Keep the states this block needs, then evict the least recently used ones until the rest fit
+        for key in keys:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+        missing = [(key, state) for key, state in zip(keys, states) if key not in self._frames]
+        n_evicted = 0
+        while self.nbytes + len(missing) * self.state_bytes > self.max_bytes:
+            self._frames.popitem(last=False)
+            n_evicted += 1
+
+        for key, state in missing:
+            self._frames[key] = self._render(state)
+        self.win.clearBuffer()
+
+        frames = [self._frames[key] for key in keys]
+        composites = [frames[n] for n in state_index.reshape(-1).tolist()]
+
+        print(f"Frame cache warm-up: {len(missing)} of {len(keys)} states rendered in "
+              f"{time.perf_counter() - t0:.2f} s ({n_evicted} evicted, {self.nbytes / 2 ** 20:.0f} MB cached)")
+        return composites
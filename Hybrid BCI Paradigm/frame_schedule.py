@@ -0,0 +1,287 @@
+"""
+Precompiled frame schedules for the Hybrid BCI conditions.
+
+Instead of working out `(frame_count % flicker_period) < (flicker_period / 2)` for every
+location on every frame, each block is compiled ahead of time into a table with one row per
+frame and one column per location. The render loop then only has to play the table back and
+touch the stimuli whose state actually changed.
+"""
+import numpy as np
+
+# Layers a location can show when it is on
+SILHOUETTE = 0  # grey silhouettes (`silhouettes`)
+IMAGE = 1  # condition stimuli (`image_stims`) - white faces or grey silhouettes depending on the condition
+IMAGE_OVER_SILHOUETTE = 2  # the image drawn on top of the silhouette (Oddball highlight)
+
+# Display codes are `layer + 1`, which makes them a bitmask of the drawn layers
+SILHOUETTE_BIT = 1
+IMAGE_BIT = 2
+
+CONDITIONS = ('Flicker', 'Oddball', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball')
+FLICKER_CONDITIONS = ('Flicker', 'FlickerOddball', 'DannyFlicker', 'DannyFlickerOddball')
+
+
+class FrameSchedule:
+    """
+    On/off table for one block.
+
+    Attributes
+    ==========
+    on : np.ndarray of bool, shape (n_frames, n_locations)
+        Whether each location is drawn on each frame.
+    layer : np.ndarray of uint8, shape (n_frames, n_locations)
+        Which stimulus layer (`SILHOUETTE`, `IMAGE` or `IMAGE_OVER_SILHOUETTE`) is drawn at each
+        location when it is on.
+    events : dict
+        Frame index -> list of markers to send when that frame is presented.
+    changes : list
+        One entry per frame, each a list of `(location, code)` tuples for the locations whose
+        displayed stimulus differs from the previous frame. `code` is 0 for off, otherwise
+        `layer + 1` (a bitmask of `SILHOUETTE_BIT` and `IMAGE_BIT`).
+    """
+    def __init__(self, on, layer, events):
+        self.on = on
+        self.layer = layer
+        self.events = events
+        self.changes = compile_changes(self.codes)
+
+    @property
+    def n_frames(self):
+        return self.on.shape[0]
+
+    @property
+    def n_locations(self):
+        return self.on.shape[1]
+
+    @property
+    def codes(self):
+        """Per frame/location display code: 0 = off, otherwise `layer + 1`."""
+        return np.where(self.on, self.layer.astype(np.uint8) + 1, 0).astype(np.uint8)
+
+
+def flicker_states(flicker_frames_per_cycle, n_frames, start=1):
+    """
+    On/off states of every location for `n_frames` consecutive frames.
+
+    Parameters
+    ==========
+    flicker_frames_per_cycle : list of float
+        Flicker period (in frames) of each location.
+    n_frames : int
+        Number of frames to compute.
+    start : int
+        Value of the frame counter on the first frame (the trial loops count from 1).
+
+    Returns
+    ==========
+    np.ndarray of bool, shape (n_frames, n_locations)
+    """
+    periods = np.asarray(flicker_frames_per_cycle, dtype=float)[np.newaxis, :]
+    frame_count = np.arange(start, start + n_frames, dtype=float)[:, np.newaxis]
+    return (frame_count % periods) < (periods / 2)
+
+
+def compile_changes(codes):
+    """
+    List, per frame, the locations whose display code differs from the previous frame.
+
+    The frame before the first one is taken to have every location off.
+    """
+    previous = np.vstack([np.zeros((1, codes.shape[1]), dtype=codes.dtype), codes[:-1]])
+    frames, locs = np.nonzero(codes != previous)
+    changes = [[] for _ in range(codes.shape[0])]
+    for frame, loc in zip(frames.tolist(), locs.tolist()):
+        changes[frame].append((loc, int(codes[frame, loc])))
+    return changes
+
+
+class _ScheduleBuilder:
+    """Accumulates segments of a block and concatenates them into a `FrameSchedule`."""
+    def __init__(self, n_locations):
+        self.n_locations = n_locations
+        self.on = []
+        self.layer = []
+        self.events = {}
+        self.n_frames = 0
+
+    def add(self, on, layer, marker=None):
+        if marker is not None:
+            self.events.setdefault(self.n_frames, []).append(marker)
+        layer = np.broadcast_to(np.asarray(layer, dtype=np.uint8), on.shape)
+        self.on.append(on)
+        self.layer.append(layer)
+        self.n_frames += on.shape[0]
+
+    def static(self, n_frames, on=True, layer=SILHOUETTE, marker=None):
+        self.add(np.full((n_frames, self.n_locations), on, dtype=bool), layer, marker)
+
+    def build(self):
+        return FrameSchedule(np.concatenate(self.on), np.ascontiguousarray(np.concatenate(self.layer)), self.events)
+
+
+def flicker_frames(refresh_rate, seconds):
+    """
+    Frames of a flicker period, counted as the original frame loops did (`int`, not `round`: at
+    239.96 Hz, 30 s are 7198 frames, not 7199). The static screens, which were timed with `core.wait`,
+    take the nearest whole number of frames instead.
+    """
+    return int(refresh_rate * seconds + 1e-9)  # 1e-9: 0.29 s at 100 Hz are 29 frames, not 28
+
+
+def _trial_marker(marker_prefix, loc, target_loc):
+    status = 'target' if loc == target_loc else 'nontarget'
+    return marker_prefix + f'{status}/loc_{loc}'
+
+
+def compile_block_schedule(expt_mode, flicker_frames_per_cycle, refresh_rate, timing,
+                           trial_locs=None, target_loc=None, marker_prefix=''):
+    """
+    Compile the frame schedule of one block.
+
+    Parameters
+    ==========
+    expt_mode : str
+        One of `CONDITIONS`.
+    flicker_frames_per_cycle : list of float
+        Flicker period (in frames) of each location, as in `stimuli_map`.
+    refresh_rate : float
+        Monitor refresh rate in Hz.
+    timing : dict
+        Durations (seconds) and repeat counts for the conditions: `flicker_trial_time`,
+        `highlight_duration`, `flickeroddball_flicker_time`, `between_trial_duration`,
+        `danny_flicker_trial_time`, `danny_flicker_inter_trial_time`, `danny_flicker_repeats`
+        and `danny_flickeroddball_flicker_time`.
+    trial_locs : list of int
+        Location of each trial, in presentation order (oddball conditions only).
+    target_loc : int
+        Location the participant attends to in this block.
+    marker_prefix : str
+        Prefix of every marker in the block, e.g. `'FlickerOddball/block_0/'`.
+
+    Returns
+    ==========
+    FrameSchedule
+    """
+    n_locations = len(flicker_frames_per_cycle)
+    block = _ScheduleBuilder(n_locations)
+
+    if expt_mode == 'Flicker':
+        n_frames = flicker_frames(refresh_rate, timing['flicker_trial_time'])
+        block.add(flicker_states(flicker_frames_per_cycle, n_frames), IMAGE)
+
+    elif expt_mode == 'Oddball':
+        n_highlight = round(refresh_rate * timing['highlight_duration'])
+        n_between = round(refresh_rate * timing['between_trial_duration'])
+        for loc in trial_locs:
+            # Static silhouettes everywhere, with the image drawn on top of the trial location
+            layer = np.full(n_locations, SILHOUETTE, dtype=np.uint8)
+            layer[loc] = IMAGE_OVER_SILHOUETTE
+            block.static(n_highlight, layer=layer, marker=_trial_marker(marker_prefix, loc, target_loc))
+            block.static(n_between, layer=SILHOUETTE)
+
+    elif expt_mode == 'FlickerOddball':
+        n_flicker = flicker_frames(refresh_rate, timing['flickeroddball_flicker_time'])
+        n_between = flicker_frames(refresh_rate, timing['between_trial_duration'])  # the silhouettes flicker too
+        flicker_on = flicker_states(flicker_frames_per_cycle, n_flicker)
+        between_on = flicker_states(flicker_frames_per_cycle, n_between)
+        for loc in trial_locs:
+            # The trial location flickers the image, every other location flickers its silhouette
+            layer = np.full(n_locations, SILHOUETTE, dtype=np.uint8)
+            layer[loc] = IMAGE
+            block.add(flicker_on, layer, marker=_trial_marker(marker_prefix, loc, target_loc))
+            # One blank frame, then only the silhouettes flicker until the next trial
+            block.static(1, on=False)
+            block.add(between_on, SILHOUETTE)
+
+    elif expt_mode == 'DannyFlicker':
+        n_static = round(refresh_rate * timing['danny_flicker_inter_trial_time'])
+        n_flicker = flicker_frames(refresh_rate, timing['danny_flicker_trial_time'])
+        for repeat_n in range(timing['danny_flicker_repeats']):
+            # All the images are shown statically before they start flickering again
+            block.static(n_static, layer=IMAGE)
+            # The frame counter keeps running across repeats
+            on = flicker_states(flicker_frames_per_cycle, n_flicker, start=repeat_n * n_flicker + 1)
+            block.add(on, IMAGE, marker=marker_prefix + f'repeat_{repeat_n + 1}')
+
+    elif expt_mode == 'DannyFlickerOddball':
+        n_flicker = flicker_frames(refresh_rate, timing['danny_flickeroddball_flicker_time'])
+        n_between = round(refresh_rate * timing['between_trial_duration'])
+        for trial_n, loc in enumerate(trial_locs):
+            # Static silhouettes everywhere except the trial location, whose image flickers.
+            # The frame counter keeps running across trials.
+            on = np.ones((n_flicker, n_locations), dtype=bool)
+            on[:, loc] = flicker_states([flicker_frames_per_cycle[loc]], n_flicker, start=trial_n * n_flicker + 1)[:, 0]
+            layer = np.full(n_locations, SILHOUETTE, dtype=np.uint8)
+            layer[loc] = IMAGE
+            block.add(on, layer, marker=_trial_marker(marker_prefix, loc, target_loc))
+            block.static(n_between, layer=SILHOUETTE)
+
+    else:
+        raise ValueError(f'No frame schedule for condition {expt_mode!r}')
+
+    return block.build()
+
+
+def play_schedule(win, schedule, renderer, push_marker, check_abort=None, check_interval=1, composites=None,
+                  stop_early=None):
+    """
+    Present a compiled block, one `win.flip()` per row of the schedule.
+
+    Only the locations whose state changed since the previous frame are passed to the renderer.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window for this experiment.
+    schedule : FrameSchedule
+        Compiled block.
+    renderer : object
+        Render backend from `stimulus_renderers` (`AutoDrawRenderer` or `ElementArrayRenderer`).
+    push_marker : callable
+        Called with each marker of the schedule right before its frame is flipped
+        (`MarkerDispatcher.on_flip` stamps it with that flip).
+    check_abort : callable or None
+        Called on every frame with a marker and every `check_interval` frames otherwise.
+    check_interval : int
+        Number of frames between calls of `check_abort`.
+    composites : list or None
+        Pre-rendered frame for every row of the schedule, from `FrameCache.prepare`. When given,
+        each frame is a single draw of its composite and `renderer` is not used.
+    stop_early : callable or None
+        Called before every frame with markers (a trial onset); the block ends there if it returns
+        True (e.g. `OnlineERP.decided`).
+
+    Returns
+    ==========
+    int
+        Number of frames played.
+    """
+    events = schedule.events
+    check_interval = max(int(check_interval), 1)
+
+    if composites is None:
+        renderer.start()
+    n_played = len(schedule.changes)
+    for frame, changes in enumerate(schedule.changes):
+        if stop_early is not None and frame in events and stop_early():
+            n_played = frame
+            break
+        if composites is not None:
+            composites[frame].draw()
+        elif changes:
+            renderer.apply(changes)
+
+        if frame in events:
+            for marker in events[frame]:
+                push_marker(marker)
+            if check_abort is not None:
+                check_abort()
+        elif check_abort is not None and frame % check_interval == 0:
+            check_abort()
+
+        win.flip()
+
+    # Leave nothing on screen for whatever comes after the block
+    if composites is None:
+        renderer.stop()
+    return n_played
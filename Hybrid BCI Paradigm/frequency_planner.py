@@ -0,0 +1,241 @@
+"""
+Flicker frequency planner.
+
+A location can only flicker at `refresh_rate / frames` for a whole number of frames per cycle, so
+the possible frequencies in a band are a short, fixed list for each refresh rate. `plan_frequencies`
+picks `n_locations` of them that are as far apart as possible, counting the harmonics as well
+(8 and 12 Hz are 4 Hz apart, but their 3rd and 2nd harmonics are both at 24 Hz).
+
+The separation of every pair of candidates is worked out at once with NumPy. The set with the
+largest minimum separation is found by bisecting over those separations; at each threshold a
+branch-and-bound search looks for `n_locations` candidates that are all at least that far apart.
+Ties are broken by the next smallest separations. Planning a 240 Hz monitor takes milliseconds,
+so it can run at startup for the measured refresh rate (`flicker_band` in the experiment script).
+
+Usage:
+    python frequency_planner.py --refresh-rate 240 --band 10 12.7 --locations 6
+    python frequency_planner.py --monitor Alienware --band 10 12.7 --out stimuli_map.json
+"""
+import argparse
+import json
+import math
+import os.path as op
+
+import numpy as np
+
+from session_plan import SCRIPT, make_stimuli_map, read_script_constants
+from shared_modules import use_shared
+
+expt_root = op.dirname(op.abspath(__file__))
+
+
+def candidate_frames(refresh_rate, band, tolerance=0.05):
+    """
+    Whole numbers of frames per cycle whose frequency at `refresh_rate` is within `band` (Hz).
+
+    A cycle up to `tolerance` of a frame past the band edges still counts, so a monitor measured a
+    little off its nominal rate keeps the frequencies at the edges: 24 frames at 239.96 Hz are
+    9.998 Hz, for a band starting at 10 Hz.
+    """
+    low, high = band
+    return np.arange(math.ceil(refresh_rate / high - tolerance), math.floor(refresh_rate / low + tolerance) + 1)
+
+
+def separation_matrix(freqs, n_harmonics=3):
+    """
+    Spectral separation of every pair of frequencies.
+
+    Parameters
+    ==========
+    freqs : array_like of float
+        Frequencies (Hz).
+    n_harmonics : int
+        Harmonics of each frequency compared (1 compares the fundamentals only).
+
+    Returns
+    ==========
+    np.ndarray, shape (n, n)
+        `min |a * freqs[i] - b * freqs[j]|` over harmonics `a, b = 1..n_harmonics`, inf on the diagonal.
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    harmonics = np.arange(1, n_harmonics + 1, dtype=float)
+    lines = harmonics[:, None] * freqs[None, :]  # (harmonic, freq)
+    separation = np.abs(lines[:, None, :, None] - lines[None, :, None, :]).min(axis=(0, 1))
+    np.fill_diagonal(separation, np.inf)
+    return separation
+
+
+def min_separation(freqs, n_harmonics=3):
+    """Smallest separation (Hz) between any two of `freqs`, harmonics included."""
+    return float(separation_matrix(freqs, n_harmonics).min())
+
+
+def _find_sets(adjacent, chain, k, limit, max_nodes):
+    """
+    Up to `limit` sets of `k` candidates that are all adjacent to each other (bitset adjacency),
+    built in candidate order. `chain[v]` bounds how many candidates from `v` on can be in one set.
+    The search stops after `max_nodes` partial sets.
+    """
+    found = []
+    nodes = [0]
+
+    def extend(chosen, remaining):
+        nodes[0] += 1
+        if nodes[0] > max_nodes:
+            return True
+        if len(chosen) == k:
+            found.append(chosen)
+            return len(found) >= limit
+        while remaining:
+            lowest = remaining & -remaining
+            v = lowest.bit_length() - 1
+            # Not enough candidates left to complete the set (`chain` only gets shorter further on)
+            if len(chosen) + chain[v] < k or len(chosen) + bin(remaining).count('1') < k:
+                return False
+            remaining ^= lowest
+            if extend(chosen + (v,), remaining & adjacent[v]):
+                return True
+        return False
+
+    extend((), (1 << len(adjacent)) - 1)
+    return found
+
+
+def _adjacency(separation, threshold):
+    return [sum(1 << int(j) for j in np.flatnonzero(row >= threshold)) for row in separation]
+
+
+def _chain_lengths(freqs, threshold):
+    """
+    Most frequencies from each candidate on (`freqs` descending) whose fundamentals are `threshold`
+    apart, packed greedily. The harmonics only bring frequencies closer, so no set can be longer.
+    """
+    n = freqs.shape[0]
+    # First candidate after each one that is at least `threshold` lower
+    following = np.maximum(np.searchsorted(-freqs, -(freqs - threshold + 1e-9), side='left'), np.arange(1, n + 1))
+    chain = [1] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        chain[i] = 1 + chain[following[i]] if following[i] < n else 1
+    return chain
+
+
+def plan_frequencies(refresh_rate, band, n_locations, n_harmonics=3, max_ties=10000, max_nodes=200000):
+    """
+    Frequencies for `n_locations` locations with the largest minimum separation, harmonics included.
+
+    Parameters
+    ==========
+    refresh_rate : float
+        Refresh rate of the monitor (Hz), preferably the measured one.
+    band : tuple of float
+        Lowest and highest frequency allowed (Hz).
+    n_locations : int
+        Number of frequencies to pick, at least 2.
+    n_harmonics : int
+        Harmonics compared (see `separation_matrix`).
+    max_ties : int
+        Number of sets with the best minimum separation compared to break the tie.
+    max_nodes : int
+        Search budget per threshold. Six locations need a few hundred; with many locations and a wide
+        band, a threshold the budget runs out on counts as not reached, so the set returned may be
+        slightly short of the best one.
+
+    Returns
+    ==========
+    frames : np.ndarray of int
+        Frames per cycle of each location, in the order of `arrange_around_circle`.
+    min_sep : float
+        Minimum separation (Hz) of the set.
+    """
+    if n_locations < 2:
+        raise ValueError(f'{n_locations} locations given; a separation needs at least 2')
+    frames = candidate_frames(refresh_rate, band)
+    if frames.shape[0] < n_locations:
+        raise ValueError(f'Only {frames.shape[0]} frequencies between {band[0]} and {band[1]} Hz at {refresh_rate} Hz, '
+                         f'{n_locations} needed; widen the band')
+    freqs = refresh_rate / frames
+    separation = separation_matrix(freqs, n_harmonics)
+
+    def find_sets(threshold, limit):
+        return _find_sets(_adjacency(separation, threshold), _chain_lengths(freqs, threshold), n_locations, limit,
+                          max_nodes)
+
+    # Largest threshold at which a set still exists (the feasible thresholds are a prefix of `thresholds`)
+    thresholds = np.unique(separation[np.triu_indices_from(separation, 1)])
+    lo, hi = 0, thresholds.shape[0] - 1
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if find_sets(thresholds[mid], 1):
+            lo = mid
+        else:
+            hi = mid - 1
+    best = thresholds[lo]
+
+    # Break ties by the sorted separations of each set, smallest first (largest wins)
+    sets = np.array(find_sets(best, max_ties))
+    pairs = np.triu_indices(n_locations, 1)
+    set_separations = np.sort(separation[sets[:, pairs[0]], sets[:, pairs[1]]], axis=1)
+    chosen = sets[np.lexsort(set_separations.T[::-1])[-1]]
+    return arrange_around_circle(frames[chosen]), float(best)
+
+
+def arrange_around_circle(frames):
+    """
+    Order the frequencies around the circle of locations so that neighbours are far apart: sorted,
+    then interleaved (lowest, middle, second lowest, second middle, ...).
+    """
+    frames = np.sort(frames)
+    half = (frames.shape[0] + 1) // 2
+    order = np.empty_like(frames)
+    order[0::2] = frames[:half]
+    order[1::2] = frames[half:]
+    return order
+
+
+def planned_freqs(refresh_rate, frames, decimals=2):
+    """Frequencies as listed in `screens` (rounded, but still giving `frames` at `refresh_rate`)."""
+    return [round(float(refresh_rate / f), decimals) for f in frames]
+
+
+def main(argv=None):
+    from monitor_calibration import load_profile, profile_filename
+
+    constants = read_script_constants(SCRIPT, {'screens', 'num_locations', 'dist_from_ctr'})
+    screens = constants['screens']
+    parser = argparse.ArgumentParser(description='Plan flicker frequencies for a refresh rate')
+    parser.add_argument('--refresh-rate', type=float, help='refresh rate (Hz); by default the measured or nominal '
+                                                          'rate of --monitor')
+    parser.add_argument('--monitor', default='Alienware', choices=list(screens))
+    parser.add_argument('--band', type=float, nargs=2, required=True, metavar=('LOW', 'HIGH'))
+    parser.add_argument('--locations', type=int, default=constants['num_locations'])
+    parser.add_argument('--harmonics', type=int, default=3)
+    parser.add_argument('--out', help='stimuli_map.json to write')
+    args = parser.parse_args(argv)
+
+    refresh_rate = args.refresh_rate
+    if refresh_rate is None:
+        screen = screens[args.monitor]
+        profile = load_profile(profile_filename(op.join(expt_root, 'calibration'), args.monitor), args.monitor,
+                               screen['resolution'])
+        refresh_rate = profile['refresh_rate'] if profile else screen['refresh_rate']
+
+    frames, min_sep = plan_frequencies(refresh_rate, args.band, args.locations, n_harmonics=args.harmonics)
+    freqs = planned_freqs(refresh_rate, frames)
+    print(f'{refresh_rate} Hz, {args.band[0]}-{args.band[1]} Hz band, {len(candidate_frames(refresh_rate, args.band))} '
+          f'candidates: {freqs}')
+    print(f'Minimum separation {min_sep:.3f} Hz (up to harmonic {args.harmonics})')
+    if min_sep < 1e-6:
+        print('WARNING: two of the frequencies share a harmonic in this band; narrow it or use fewer harmonics')
+    if args.refresh_rate is None and args.locations == len(screens[args.monitor]['flicker_freqs']):
+        print(f"`screens` frequencies {screens[args.monitor]['flicker_freqs']}: minimum separation "
+              f"{min_separation(screens[args.monitor]['flicker_freqs'], args.harmonics):.3f} Hz")
+    if args.out:
+        stimuli_map = make_stimuli_map(freqs, refresh_rate, args.locations, constants['dist_from_ctr'])
+        with open(args.out, 'w') as f:
+            json.dump(stimuli_map, f, indent=1)
+        print(f'-> {args.out}')
+
+
+if __name__ == '__main__':
+    use_shared()
+    main()
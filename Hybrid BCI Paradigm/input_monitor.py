@@ -0,0 +1,134 @@
+"""
+Keyboard monitoring on a background thread.
+
+The block loops used to look for escape with `event.getKeys()`: every few frames of the frame
+schedule (allocating a list each time), and not at all while the target cue or the instructions
+were shown, so how quickly an abort was noticed depended on the condition. `InputMonitor` polls a
+`psychopy.hardware.keyboard.Keyboard` from its own thread instead. With the Psychtoolbox backend
+the key presses are queued by Psychtoolbox independently of the window events. The loops only call
+`check()`, which reads `aborted`, a plain attribute written once by the thread, so checking on
+every frame costs nothing and an abort is noticed on the next frame in every condition.
+
+The 'event' backend reads the window's pyglet events, which are dispatched by whoever calls it and
+must stay on the main thread (the instruction screens read `event.getKeys` there). It gets no
+thread: `check()` polls the keyboard itself, from the frame loop.
+"""
+import threading
+import time
+from collections import deque
+
+
+class InputMonitor:
+    """
+    Poll the keyboard on a background thread.
+
+    Parameters
+    ==========
+    keyboard : psychopy.hardware.keyboard.Keyboard or None
+        Keyboard to poll. If None, one is created with `backend`.
+    backend : str
+        Keyboard backend if `keyboard` is None: 'ptb' (Psychtoolbox), 'iohub' or 'event'. PsychoPy
+        falls back to 'event' if Psychtoolbox isn't installed; that backend is polled by `check()`.
+    keys : sequence of str
+        Keys to record.
+    abort_keys : sequence of str
+        Keys that set `aborted`.
+    poll_interval : float
+        Seconds between polls.
+    clock : callable or None
+        Clock for the event timestamps, `psychopy.core.getTime` by default.
+    capacity : int
+        Number of key events kept.
+    """
+    def __init__(self, keyboard=None, backend='ptb', keys=('escape',), abort_keys=('escape',),
+                 poll_interval=0.002, clock=None, capacity=1000):
+        if keyboard is None:
+            from psychopy.hardware.keyboard import Keyboard
+            keyboard = Keyboard(backend=backend)
+        # The backend PsychoPy actually uses (set on the class by the first keyboard created)
+        self.backend = getattr(keyboard, '_backend', None) or backend
+        if clock is None:
+            from psychopy import core
+            clock = core.getTime
+        self.keyboard = keyboard
+        self.keys = list(keys)
+        self.abort_keys = set(abort_keys)
+        self.poll_interval = poll_interval
+        self.clock = clock
+
+        # Written by the polling thread only
+        self.aborted = False
+        self.abort_time = None  # when the abort key was pressed (`tDown`) or, without press times, picked up
+        self.events = deque(maxlen=capacity)
+
+        self._running = False
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        """Start polling, on a thread unless the backend is 'event'. Returns the monitor."""
+        self._running = True
+        if self.backend != 'event':
+            self._thread = threading.Thread(target=self._run, name='InputMonitor', daemon=True)
+            self._thread.start()
+        return self
+
+    def check(self):
+        """Whether an abort key was pressed. Polls the keyboard first if there is no thread ('event' backend)."""
+        if self._thread is None and self._running and not self.aborted:
+            self.poll()
+        return self.aborted
+
+    def poll(self):
+        """Read the keyboard once (called by the thread, or by `check()`)."""
+        for key in self.keyboard.getKeys(keyList=self.keys, waitRelease=False, clear=True):
+            t = self.clock()
+            t_down = getattr(key, 'tDown', None)
+            # (key, time it was picked up, time of the key press as reported by the keyboard)
+            self.events.append((key.name, t, t_down))
+            if key.name in self.abort_keys and not self.aborted:
+                self.abort_time = t if t_down is None else t_down
+                self.aborted = True
+
+    def _run(self):
+        while self._running:
+            try:
+                self.poll()
+            except Exception as e:
+                # Keep polling, but report the first failure
+                if self._error is None:
+                    self._error = e
+                    print(f'InputMonitor: reading the keyboard failed ({e})')
+            time.sleep(self.poll_interval)
+
+    def get_keys(self, key_list=None):
+        """
+        Key events since the last call, oldest first.
+
+        Parameters
+        ==========
+        key_list : sequence of str or None
+            Keys to return; other events are dropped as well. None returns all of them.
+
+        Returns
+        ==========
+        list of tuple
+            `(key, time, tDown)` for each key press.
+        """
+        events = []
+        while True:
+            try:
+                event = self.events.popleft()
+            except IndexError:
+                return events
+            if key_list is None or event[0] in key_list:
+                events.append(event)
+
+    def abort_latency(self):
+        """Seconds since the abort key was pressed, or None if it wasn't."""
+        return None if self.abort_time is None else self.clock() - self.abort_time
+
+    def stop(self, timeout=1.0):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,280 @@
+"""
+Remote control of LabRecorder.
+
+LabRecorder listens on TCP port 22347 for one-line commands (`select all`, `update`,
+`filename {...}`, `start`, `stop`) and answers `OK`. `LabRecorderClient` sends them from a worker
+thread, so the experiment never blocks on the socket, and reconnects if the connection drops.
+`set_filename` and `start` wait for the answer, so the name is set before the recording starts,
+and `start` can also wait for the new `.xdf` file to appear, to confirm that it is recording.
+
+Instead of waiting a fixed time after `stop`, `stop()` watches the newest `.xdf` file under the
+recording folder and returns as soon as its size has stopped changing, i.e. when LabRecorder has
+finished writing it, or after `timeout` seconds at the latest.
+
+Self-test against the local stand-in in `null_backend`:
+    python labrecorder_client.py
+"""
+import glob
+import os
+import os.path as op
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LabRecorderClient:
+    """
+    Send commands to LabRecorder's remote control socket.
+
+    Parameters
+    ==========
+    host, port : str, int
+        Address of the remote control socket.
+    connect_timeout : float
+        Seconds to keep retrying the connection (LabRecorder may still be starting up).
+    ack_timeout : float
+        Seconds to wait for the `OK` after a command. A missing answer is reported but isn't an
+        error, since older LabRecorder versions don't answer every command.
+    retry_interval : float
+        Seconds between connection attempts.
+    """
+    def __init__(self, host='localhost', port=22347, connect_timeout=10.0, ack_timeout=1.0, retry_interval=0.25):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.ack_timeout = ack_timeout
+        self.retry_interval = retry_interval
+        self.sock = None
+        self.n_reconnects = 0
+        self.created = time.time()
+        self._buffer = b''
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='LabRecorderClient')
+
+    def connect(self):
+        """Connect, retrying until `connect_timeout`. Raises `ConnectionError` if it never succeeds."""
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.ack_timeout)
+                self._buffer = b''
+                return self
+            except OSError as e:
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(f'Could not connect to LabRecorder on {self.host}:{self.port}: {e}') from e
+                time.sleep(self.retry_interval)
+
+    def send(self, command):
+        """
+        Queue a command.
+
+        Returns
+        ==========
+        concurrent.futures.Future
+            Resolves to LabRecorder's answer (e.g. `'OK'`), or None if it didn't answer in time.
+        """
+        return self._executor.submit(self._send, command)
+
+    def _send(self, command):
+        line = command.rstrip('\n').encode() + b'\n'
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall(line)
+                return self._read_answer()
+            except (ConnectionError, OSError):
+                # The connection dropped: reconnect once and send the command again
+                self._close_socket()
+                if attempt:
+                    raise
+                self.n_reconnects += 1
+
+    def _read_answer(self):
+        deadline = time.monotonic() + self.ack_timeout
+        while b'\n' not in self._buffer and self._buffer.strip() != b'OK':
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f'LabRecorder: no answer within {self.ack_timeout} s')
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(1024)
+            except socket.timeout:
+                continue
+            if not data:
+                raise ConnectionError('LabRecorder closed the connection')
+            self._buffer += data
+        answer, _, self._buffer = self._buffer.partition(b'\n')
+        return answer.decode(errors='replace').strip()
+
+    def _wait(self, future, command):
+        """Answer to a queued command, or None (with the reason printed) if there was none."""
+        try:
+            answer = future.result(timeout=self.ack_timeout + self.connect_timeout)
+        except Exception as e:
+            print(f'LabRecorder: {command} failed ({e})')
+            return None
+        if answer is not None and answer != 'OK':
+            print(f'LabRecorder: {command} answered {answer!r}')
+        return answer
+
+    def set_filename(self, **fields):
+        """
+        Name the next recording, e.g. `set_filename(task='Flicker', participant='123', session='001')`.
+
+        Returns
+        ==========
+        str or None
+            LabRecorder's answer, None if there was none within `ack_timeout`.
+        """
+        return self._wait(self.send('filename ' + ' '.join(f'{{{key}:{value}}}' for key, value in fields.items())),
+                          'filename')
+
+    def select_all(self):
+        return self.send('select all')
+
+    def update(self):
+        return self.send('update')
+
+    def start(self, watch_dir=None, timeout=5.0, poll_interval=0.05):
+        """
+        Start recording, and check that the recording was created.
+
+        Parameters
+        ==========
+        watch_dir : str or None
+            Folder LabRecorder saves under (its `StudyRoot`). If given, waits until a new `.xdf`
+            file appears below it.
+        timeout : float
+            Longest wait for the recording to appear.
+        poll_interval : float
+            Seconds between looks at `watch_dir`.
+
+        Returns
+        ==========
+        str or None
+            The new recording, or None if `watch_dir` is None or nothing appeared before `timeout`.
+        """
+        t = time.time()
+        self._wait(self.send('start'), 'start')
+        if watch_dir is None:
+            return None
+        deadline = time.monotonic() + timeout
+        while True:
+            xdf_file = newest_recording(watch_dir, since=t)
+            if xdf_file is not None:
+                print(f'LabRecorder: recording to {xdf_file}')
+                return xdf_file
+            if time.monotonic() >= deadline:
+                print(f'LabRecorder: no new recording under {watch_dir} after {timeout} s')
+                return None
+            time.sleep(poll_interval)
+
+    def stop(self, watch_dir=None, settle_time=0.5, timeout=15.0):
+        """
+        Stop recording and wait until the recording has been written.
+
+        Parameters
+        ==========
+        watch_dir : str or None
+            Folder LabRecorder saves under (its `StudyRoot`). The newest `.xdf` file below it that
+            was modified after this client was created is watched. If None or nothing is found,
+            waits `timeout` seconds as before.
+        settle_time : float
+            Seconds the file size has to stay the same to count as saved.
+        timeout : float
+            Longest time to wait for the recording.
+
+        Returns
+        ==========
+        str or None
+            The recording, if one was found and finished saving.
+        """
+        t = time.monotonic()
+        self._wait(self.send('stop'), 'stop')
+        remaining = max(timeout - (time.monotonic() - t), 0)
+        if watch_dir is None:
+            time.sleep(remaining)
+            return None
+        xdf_file = wait_until_saved(watch_dir, since=self.created, settle_time=settle_time, timeout=remaining)
+        if xdf_file is None:
+            print(f'LabRecorder: no recording found under {watch_dir}')
+        else:
+            print(f'LabRecorder: {xdf_file} saved in {time.monotonic() - t:.1f} s')
+        return xdf_file
+
+    def _close_socket(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._close_socket()
+
+
+def newest_recording(watch_dir, since=0.0):
+    """Most recently modified `.xdf` file below `watch_dir` modified after `since`, or None."""
+    files = [(op.getmtime(f), f) for f in glob.glob(op.join(watch_dir, '**', '*.xdf'), recursive=True)]
+    files = [(mtime, f) for mtime, f in files if mtime >= since]
+    return max(files)[1] if files else None
+
+
+def wait_until_saved(watch_dir, since=0.0, settle_time=0.5, timeout=15.0, poll_interval=0.05):
+    """
+    Wait until the newest recording below `watch_dir` stops growing.
+
+    Returns
+    ==========
+    str or None
+        The recording, or None if none was found (or it was still growing) before `timeout`.
+    """
+    deadline = time.monotonic() + timeout
+    xdf_file = None
+    last_size = -1
+    stable_since = time.monotonic()
+    while time.monotonic() < deadline:
+        if xdf_file is None:
+            xdf_file = newest_recording(watch_dir, since)
+        if xdf_file is not None:
+            try:
+                size = os.path.getsize(xdf_file)
+            except OSError:
+                size = -1
+            if size != last_size:
+                last_size = size
+                stable_since = time.monotonic()
+            elif time.monotonic() - stable_since >= settle_time:
+                return xdf_file
+        time.sleep(poll_interval)
+    return None
+
+
+def main():
+    import tempfile
+
+    from null_backend import NullLabRecorder
+
+    with tempfile.TemporaryDirectory() as study_root:
+        recorder = NullLabRecorder(study_root, save_time=1.0)
+        client = LabRecorderClient(port=recorder.port).connect()
+        print('filename ->', client.set_filename(task='Flicker', participant='999', session='001'))
+        print('start ->', client.start(watch_dir=study_root))
+        time.sleep(0.5)
+
+        # Drop the connection to check that the next command reconnects
+        recorder.drop_connections()
+        t = time.monotonic()
+        xdf_file = client.stop(watch_dir=study_root, timeout=15.0)
+        print(f'stop returned after {time.monotonic() - t:.2f} s (recorder needed {recorder.save_time} s), '
+              f'{client.n_reconnects} reconnect(s), commands seen: {recorder.commands}')
+        client.close()
+        recorder.close()
+        return 0 if xdf_file is not None else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,128 @@
+"""
+Integer marker codes for the BCIMarkerStream.
+
+With `marker_mode = 'int'` every marker is sent as one int32 instead of a string such as
+`'FlickerOddball/block_0/nontarget/loc_5'`. A code packs the parts of the marker into two decimal
+digits each:
+
+    code = condition * 1000000 + block * 10000 + status * 100 + location
+
+where each part is its index + 1, or 0 if the marker doesn't have that part. For example
+`3010606` is `FlickerOddball/block_0/nontarget/loc_5` and `701` is `loc_0/freq_12.63`.
+
+The names behind the indices are written to a JSON sidecar next to the data, and `decode` turns an
+array of codes back into their parts with array lookups instead of splitting strings.
+"""
+import json
+
+import numpy as np
+
+FIELDS = ('condition', 'block', 'status', 'location')
+FIELD_BASE = 100  # two decimal digits per field
+
+# Markers sent once per block, once per block and location, and the frequency markers
+BLOCK_STATUSES = ('block_start', 'block_end', 'flash_count_start')
+LOCATION_STATUSES = ('target_marker', 'target', 'nontarget')
+STATUSES = BLOCK_STATUSES + LOCATION_STATUSES + ('freq',)
+
+
+def pack(condition=0, block=0, status=0, location=0):
+    """Code of a marker from its field values (each index + 1, 0 for none)."""
+    return ((condition * FIELD_BASE + block) * FIELD_BASE + status) * FIELD_BASE + location
+
+
+class MarkerCodebook:
+    """
+    Every marker a session can send, with its integer code.
+
+    Parameters
+    ==========
+    conditions : sequence of str
+        Condition names (`frame_schedule.CONDITIONS`).
+    n_blocks : int
+        Number of blocks per condition.
+    n_locations : int
+        Number of stimulus locations.
+    n_repeats : int
+        Number of `repeat_<n>` markers per block (`danny_flicker_repeats`).
+    frequencies : list of float or None
+        Flicker frequency of each location, for the `loc_<n>/freq_<f>` markers.
+    """
+    def __init__(self, conditions, n_blocks, n_locations, n_repeats=0, frequencies=None):
+        self.conditions = list(conditions)
+        self.statuses = list(STATUSES) + [f'repeat_{n + 1}' for n in range(n_repeats)]
+        self.n_blocks = n_blocks
+        self.n_locations = n_locations
+        self.frequencies = list(frequencies) if frequencies is not None else []
+
+        for field, n in [('conditions', len(self.conditions)), ('blocks', n_blocks),
+                         ('statuses', len(self.statuses)), ('locations', n_locations)]:
+            if n >= FIELD_BASE:
+                raise ValueError(f'Too many {field} for the marker codes ({n}, at most {FIELD_BASE - 1})')
+
+        status_ids = {status: n + 1 for n, status in enumerate(self.statuses)}
+        block_statuses = list(BLOCK_STATUSES) + self.statuses[len(STATUSES):]
+        self.codes = {}
+        for c, condition in enumerate(self.conditions, start=1):
+            for block in range(n_blocks):
+                prefix = f'{condition}/block_{block}/'
+                for status in block_statuses:
+                    self.codes[prefix + status] = pack(c, block + 1, status_ids[status])
+                for status in LOCATION_STATUSES:
+                    for loc in range(n_locations):
+                        self.codes[prefix + f'{status}/loc_{loc}'] = pack(c, block + 1, status_ids[status], loc + 1)
+        for loc, frequency in enumerate(self.frequencies):
+            self.codes[f'loc_{loc}/freq_{frequency}'] = pack(status=status_ids['freq'], location=loc + 1)
+
+    def encode(self, marker):
+        """Code of a marker string."""
+        return self.codes[marker]
+
+    def encode_events(self, events):
+        """Replace the markers of a `FrameSchedule.events` dict by their codes."""
+        return {frame: [self.codes[marker] for marker in markers] for frame, markers in events.items()}
+
+    def to_dict(self):
+        return {'stream': 'BCIMarkerStream',
+                'fields': list(FIELDS),
+                'field_base': FIELD_BASE,
+                'conditions': self.conditions,
+                'statuses': self.statuses,
+                'n_blocks': self.n_blocks,
+                'n_locations': self.n_locations,
+                'frequencies': self.frequencies,
+                'codes': {str(code): marker for marker, code in self.codes.items()},
+                }
+
+    def write_sidecar(self, filename):
+        """Save the codebook as JSON (`<data file>_markers.json`)."""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+
+def decode(codes, codebook):
+    """
+    Split marker codes into their parts.
+
+    Parameters
+    ==========
+    codes : array-like of int
+        Marker codes, e.g. the values of the marker stream or the event ids of the epochs.
+    codebook : dict
+        Sidecar contents (`json.load` of the `_markers.json` file or `MarkerCodebook.to_dict()`).
+
+    Returns
+    ==========
+    dict
+        `condition` and `status` as arrays of names ('' for none), `block` and `location` as
+        integer arrays (-1 for none).
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    base = codebook['field_base']
+    n_fields = len(codebook['fields'])
+    parts = {field: (codes // base ** (n_fields - 1 - n)) % base for n, field in enumerate(codebook['fields'])}
+    return {'condition': np.array([''] + codebook['conditions'])[parts['condition']],
+            'block': parts['block'] - 1,
+            'status': np.array([''] + codebook['statuses'])[parts['status']],
+            'location': parts['location'] - 1,
+            }
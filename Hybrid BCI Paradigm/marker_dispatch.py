@@ -0,0 +1,107 @@
+"""
+Flip-locked LSL marker dispatch.
+
+Markers are time-stamped from `win.callOnFlip` (i.e. right after the flip that shows the event)
+and handed to a background thread through a `collections.deque`, whose `append`/`popleft` are
+atomic and need no lock. The thread pushes them to the LSL outlet with that explicit timestamp, so
+neither the push cost nor its jitter lands in the frame loop. It also hands each pushed marker to
+`mirror` (e.g. `IncrementalWriter.add_marker`), if one is set.
+"""
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class MarkerDispatcher:
+    """
+    Send markers to an LSL outlet from a background thread.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window for this experiment (for `callOnFlip`).
+    outlet : pylsl.StreamOutlet
+        Outlet of the marker stream (`BCIMarkerStream`).
+    clock : callable or None
+        Clock for the timestamps, `pylsl.local_clock` by default.
+    poll_interval : float
+        Seconds the sender thread sleeps when the queue is empty.
+    capacity : int
+        Number of push latencies kept for the shutdown report.
+    """
+    def __init__(self, win, outlet, clock=None, poll_interval=0.001, capacity=100000):
+        if clock is None:
+            from pylsl import local_clock
+            clock = local_clock
+        self.win = win
+        self.outlet = outlet
+        self.clock = clock
+        self.poll_interval = poll_interval
+        self.mirror = None  # called with (timestamp, 'lsl', marker) after each push
+
+        self._queue = deque()
+        self.max_depth = 0
+        self.n_stamped = 0
+        self.n_pushed = 0
+        self._latencies = np.empty(capacity)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='MarkerDispatcher', daemon=True)
+        self._thread.start()
+
+    def on_flip(self, marker):
+        """Send `marker` stamped with the time of the next flip."""
+        self.win.callOnFlip(self._stamp, marker)
+
+    def push_now(self, marker):
+        """Send `marker` stamped with the current time (for events that aren't tied to a flip)."""
+        self._stamp(marker)
+
+    def _stamp(self, marker):
+        self._queue.append((marker, self.clock()))
+        self.n_stamped += 1
+        depth = len(self._queue)
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def _run(self):
+        queue = self._queue
+        while self._running or queue:
+            try:
+                marker, timestamp = queue.popleft()
+            except IndexError:
+                time.sleep(self.poll_interval)
+                continue
+            self.outlet.push_sample([marker], timestamp)
+            mirror = self.mirror
+            if mirror is not None:
+                mirror(timestamp, 'lsl', marker)
+            if self.n_pushed < self._latencies.shape[0]:
+                self._latencies[self.n_pushed] = self.clock() - timestamp
+            self.n_pushed += 1
+
+    def wait_until_sent(self, timeout=1.0):
+        """Wait until every marker stamped so far has been pushed (and mirrored)."""
+        deadline = time.perf_counter() + timeout
+        while self.n_pushed < self.n_stamped and time.perf_counter() < deadline:
+            time.sleep(self.poll_interval)
+
+    def stop(self, timeout=2.0):
+        """Send whatever is still queued and stop the thread."""
+        self._running = False
+        self._thread.join(timeout)
+
+    def close(self, timeout=2.0):
+        """Stop the thread and print the queue depth/push latency report."""
+        self.stop(timeout)
+        print(self.report())
+
+    def report(self):
+        latencies = self._latencies[:min(self.n_pushed, self._latencies.shape[0])] * 1000
+        if not latencies.size:
+            return 'Markers: none sent'
+        return (f"Markers: {self.n_pushed} sent, max queue depth {self.max_depth}, push latency "
+                f"median {np.median(latencies):.2f} ms, p95 {np.percentile(latencies, 95):.2f} ms, "
+                f"max {latencies.max():.2f} ms")
@@ -0,0 +1,219 @@
+"""
+Stand-ins for the PsychoPy window, stimuli and LSL outlet.
+
+They implement just enough of the real interfaces for `frame_schedule.play_schedule` and the render
+backends to run without a display, monitor or LabRecorder, while counting what would have been
+drawn and pushed. Used by `benchmark_conditions.py`.
+
+`NullLabRecorder` is a local TCP stand-in for LabRecorder's remote control socket, used by the
+self-test of `labrecorder_client.py`.
+"""
+import os
+import os.path as op
+import re
+import socket
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class NullWindow:
+    """
+    Window that draws nothing but records when each flip happened.
+
+    `flip()` draws the autoDraw stimuli (so their draw calls are counted), runs the `callOnFlip`
+    callbacks and returns `time.perf_counter()`. It does not wait for a refresh.
+    """
+    def __init__(self, size=(1920, 1080), units='deg'):
+        self.size = np.array(size)
+        self.units = units
+        self._toDraw = []
+        self._toCall = []
+        self.n_flips = 0
+        self.n_draws = 0
+        self.n_autodraw_changes = 0
+        self.flip_times = np.empty(0)
+        self.frame_alloc = np.empty(0)
+        self._trace_alloc = False
+        self._alloc_base = 0
+
+    def start_recording(self, capacity, trace_alloc=False):
+        """Preallocate the per-flip buffers and reset the counters."""
+        self.n_flips = 0
+        self.n_draws = 0
+        self.n_autodraw_changes = 0
+        self.flip_times = np.zeros(capacity)
+        self.frame_alloc = np.zeros(capacity)
+        self._trace_alloc = trace_alloc
+        if trace_alloc:
+            self._alloc_base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+    def flip(self, clearBuffer=True):
+        for stim in self._toDraw:
+            stim.draw()
+        for function, args, kwargs in self._toCall:
+            function(*args, **kwargs)
+        self._toCall = []
+
+        t = time.perf_counter()
+        if self.n_flips < self.flip_times.shape[0]:
+            self.flip_times[self.n_flips] = t
+            if self._trace_alloc:
+                # Largest amount of memory allocated on top of what was live at the last flip
+                current, peak = tracemalloc.get_traced_memory()
+                self.frame_alloc[self.n_flips] = peak - self._alloc_base
+                self._alloc_base = current
+                tracemalloc.reset_peak()
+        self.n_flips += 1
+        return t
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._toCall.append((function, args, kwargs))
+
+    def clearBuffer(self):
+        pass
+
+    def clearAutoDraw(self):
+        for stim in list(self._toDraw):
+            stim.setAutoDraw(False)
+
+
+class NullStim:
+    """Stimulus that only counts its draw calls on its window."""
+    def __init__(self, win, image=None, pos=(0, 0), size=5, **kwargs):
+        self.win = win
+        self.image = image
+        self.pos = np.array(pos, dtype=float)
+        self.size = np.array([size, size] if np.isscalar(size) else size, dtype=float)
+        self.autoDraw = False
+
+    def draw(self):
+        self.win.n_draws += 1
+
+    def setAutoDraw(self, value):
+        self.win.n_autodraw_changes += 1
+        if value and not self.autoDraw:
+            self.win._toDraw.append(self)
+        elif not value and self.autoDraw:
+            self.win._toDraw.remove(self)
+        self.autoDraw = value
+
+
+class NullElementArrayStim(NullStim):
+    """`visual.ElementArrayStim` stand-in: one draw call for every element."""
+    def __init__(self, win, opacities=None, **kwargs):
+        super().__init__(win)
+        self.opacities = opacities
+
+
+class NullOutlet:
+    """`pylsl.StreamOutlet` stand-in that counts the samples pushed."""
+    def __init__(self):
+        self.n_samples = 0
+
+    def push_sample(self, sample, timestamp=0.0, pushthrough=True):
+        self.n_samples += 1
+
+
+class NullLabRecorder:
+    """
+    Local stand-in for LabRecorder's remote control socket.
+
+    Answers every command with `OK`. `start` creates an `.xdf` file under `study_root` (named from
+    the last `filename` command) and appends to it while recording; after `stop` it keeps writing
+    for `save_time` seconds, like LabRecorder flushing its buffers.
+
+    Parameters
+    ==========
+    study_root : str
+        Folder the recordings are written under.
+    save_time : float
+        Seconds the recording keeps growing after `stop`.
+    port : int
+        Port to listen on, 0 for any free port (see `self.port`).
+    """
+    def __init__(self, study_root, save_time=1.0, port=0):
+        self.study_root = study_root
+        self.save_time = save_time
+        self.commands = []
+        self.fields = {}
+        self._connections = []
+        self._recording = None
+        self._stop_at = None
+        self._running = True
+
+        self._server = socket.create_server(('localhost', port))
+        self._server.settimeout(0.1)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self._connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        buffer = b''
+        while self._running:
+            try:
+                data = conn.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b'\n' in buffer:
+                line, _, buffer = buffer.partition(b'\n')
+                self._handle(line.decode().strip())
+                try:
+                    conn.sendall(b'OK\n')
+                except OSError:
+                    return
+
+    def _handle(self, command):
+        self.commands.append(command.split(' ')[0])
+        if command.startswith('filename'):
+            self.fields = dict(re.findall(r'\{(\w+):([^}]*)\}', command))
+        elif command == 'start':
+            folder = op.join(self.study_root, f"sub-{self.fields.get('participant', 'P001')}",
+                             f"ses-{self.fields.get('session', 'S001')}", 'eeg')
+            os.makedirs(folder, exist_ok=True)
+            self._recording = op.join(folder, f"task-{self.fields.get('task', 'T1')}_eeg.xdf")
+            self._stop_at = None
+        elif command == 'stop' and self._recording is not None:
+            self._stop_at = time.monotonic() + self.save_time
+
+    def _write(self):
+        while self._running:
+            recording = self._recording
+            if recording is not None:
+                with open(recording, 'ab') as f:
+                    f.write(b'\0' * 4096)
+                if self._stop_at is not None and time.monotonic() >= self._stop_at:
+                    self._recording = None
+            time.sleep(0.02)
+
+    def drop_connections(self):
+        """Close every client connection (to exercise reconnecting)."""
+        for conn in self._connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+                conn.close()
+            except OSError:
+                pass
+        self._connections = []
+
+    def close(self):
+        self._running = False
+        self.drop_connections()
+        self._server.close()
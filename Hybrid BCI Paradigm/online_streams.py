@@ -0,0 +1,131 @@
+"""
+LSL plumbing shared by the online decoders.
+
+The decoders read the EEG and the `BCIMarkerStream` markers with clock synchronisation and
+dejittering switched on, so both streams are on the decoding computer's `local_clock` and a marker
+can be matched to EEG samples by timestamp. Their decisions go out on a marker stream of their own.
+`MarkerParser` splits a marker, string or `marker_codebook` code, into its condition, block,
+status and location.
+"""
+import json
+
+import numpy as np
+
+from marker_codebook import decode
+
+
+def open_inlet(name=None, stream_type=None, timeout=10.0, max_buflen=30):
+    """
+    Resolve a stream by name (or by type) and open an inlet on it.
+
+    Parameters
+    ==========
+    name : str or None
+        Stream name, e.g. 'BCIMarkerStream'.
+    stream_type : str or None
+        Stream type, e.g. 'EEG', used if `name` is None.
+    timeout : float
+        Seconds to wait for the stream.
+    max_buflen : int
+        Seconds of data LSL keeps for the inlet if it isn't read in time.
+
+    Returns
+    ==========
+    pylsl.StreamInlet
+    """
+    from pylsl import StreamInlet, proc_clocksync, proc_dejitter, proc_monotonize, resolve_byprop
+
+    prop, value = ('name', name) if name is not None else ('type', stream_type)
+    streams = resolve_byprop(prop, value, timeout=timeout)
+    if not streams:
+        raise RuntimeError(f'No LSL stream with {prop} {value!r} found within {timeout} s')
+    return StreamInlet(streams[0], max_buflen=max_buflen,
+                       processing_flags=proc_clocksync | proc_dejitter | proc_monotonize)
+
+
+def create_marker_outlet(name, source_id):
+    """String marker outlet for decisions (one channel, irregular rate)."""
+    from pylsl import StreamInfo, StreamOutlet
+
+    return StreamOutlet(StreamInfo(name, 'Markers', 1, 0, 'string', source_id))
+
+
+def eeg_channels(inlet):
+    """Number of channels and sampling rate of an EEG inlet."""
+    info = inlet.info()
+    return info.channel_count(), info.nominal_srate()
+
+
+class MarkerParser:
+    """
+    Split `BCIMarkerStream` markers into their parts.
+
+    Parameters
+    ==========
+    codebook : dict, str or None
+        Codebook of an 'int' marker stream (`MarkerCodebook.to_dict()` or the path of the
+        `_markers.json` sidecar). Not needed for string markers.
+    """
+    def __init__(self, codebook=None):
+        if isinstance(codebook, str):
+            with open(codebook) as f:
+                codebook = json.load(f)
+        self.codebook = codebook
+
+    def parse(self, marker):
+        """
+        Parts of a marker, e.g. `'Flicker/block_0/target_marker/loc_3'` ->
+        `{'condition': 'Flicker', 'block': 0, 'status': 'target_marker', 'location': 3}`.
+        Missing parts are '' (condition, status) or -1 (block, location).
+        """
+        if isinstance(marker, (list, tuple)):
+            marker = marker[0]
+        if not isinstance(marker, str):
+            if self.codebook is None:
+                raise ValueError(f'Integer marker {marker} needs the codebook of the session')
+            parts = decode(np.array([marker]), self.codebook)
+            return {'condition': str(parts['condition'][0]), 'block': int(parts['block'][0]),
+                    'status': str(parts['status'][0]), 'location': int(parts['location'][0])}
+
+        parsed = {'condition': '', 'block': -1, 'status': '', 'location': -1}
+        fields = marker.split('/')
+        if fields and not fields[0].startswith(('block_', 'loc_')):
+            parsed['condition'] = fields.pop(0)
+        for field in fields:
+            if field.startswith('block_') and field[6:].isdigit():
+                parsed['block'] = int(field[6:])
+            elif field.startswith('loc_') and field[4:].isdigit():
+                parsed['location'] = int(field[4:])
+            else:
+                parsed['status'] = field
+        return parsed
+
+
+class LatencyLog:
+    """Latencies kept in a preallocated array, for the report printed when a decoder stops."""
+    def __init__(self, capacity=100000):
+        self.values = np.empty(capacity)
+        self.n = 0
+
+    def add(self, value):
+        if self.n < self.values.shape[0]:
+            self.values[self.n] = value
+        self.n += 1
+
+    def summary(self):
+        values = self.values[:min(self.n, self.values.shape[0])] * 1000
+        if not values.size:
+            return 'none'
+        return (f'median {np.median(values):.1f} ms, p95 {np.percentile(values, 95):.1f} ms, '
+                f'max {values.max():.1f} ms')
+
+
+def itr_bits_per_min(n_classes, accuracy, selection_time):
+    """Wolpaw information transfer rate (bits/min) of `n_classes` choices at `accuracy`, one per `selection_time` s."""
+    p = min(max(accuracy, 0.0), 1.0)
+    if p <= 1.0 / n_classes:
+        return 0.0  # chance or worse
+    bits = np.log2(n_classes) + p * np.log2(p)
+    if p < 1:
+        bits += (1 - p) * np.log2((1 - p) / (n_classes - 1))
+    return float(bits) * 60.0 / selection_time
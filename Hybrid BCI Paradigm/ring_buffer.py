@@ -0,0 +1,80 @@
+"""
+Fixed-size sample buffer for the online decoders.
+
+`RingBuffer` keeps the last `capacity` samples of a multichannel stream, with their timestamps, in
+two preallocated arrays. Every sample gets an absolute index (samples written before it), so a
+decoder can remember where a trial or epoch starts and read it back later without copying the
+stream as it grows. A chunk is written with at most two slice assignments and reads that don't
+wrap around the end of the buffer are views.
+"""
+import numpy as np
+
+
+class RingBuffer:
+    """
+    The last `capacity` samples of a stream.
+
+    Parameters
+    ==========
+    n_channels : int
+        Number of channels.
+    capacity : int
+        Number of samples kept.
+    dtype : numpy dtype
+        Type of the samples.
+    """
+    def __init__(self, n_channels, capacity, dtype=np.float64):
+        self.capacity = int(capacity)
+        self.data = np.zeros((self.capacity, n_channels), dtype=dtype)
+        self.times = np.full(self.capacity, -np.inf)
+        self.n_written = 0
+
+    @property
+    def first_index(self):
+        """Absolute index of the oldest sample still held."""
+        return max(0, self.n_written - self.capacity)
+
+    def write(self, samples, timestamps):
+        """Append a chunk, shape (n_samples, n_channels), and its timestamps."""
+        samples = np.asarray(samples)
+        timestamps = np.asarray(timestamps, dtype=float)
+        n = samples.shape[0]
+        if n > self.capacity:
+            # Only the last `capacity` samples would survive anyway
+            self.n_written += n - self.capacity
+            samples, timestamps, n = samples[-self.capacity:], timestamps[-self.capacity:], self.capacity
+        start = self.n_written % self.capacity
+        first = min(n, self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.times[start:start + first] = timestamps[:first]
+        if first < n:
+            self.data[:n - first] = samples[first:]
+            self.times[:n - first] = timestamps[first:]
+        self.n_written += n
+
+    def read(self, start, stop=None):
+        """
+        Samples and timestamps with absolute indices `start` to `stop` (exclusive).
+
+        Returns
+        ==========
+        samples : np.ndarray, shape (stop - start, n_channels)
+        timestamps : np.ndarray, shape (stop - start,)
+        """
+        stop = self.n_written if stop is None else stop
+        if start < self.first_index or stop > self.n_written:
+            raise IndexError(f'samples {start}-{stop} are not in the buffer '
+                             f'(it holds {self.first_index}-{self.n_written})')
+        i, j = start % self.capacity, stop % self.capacity
+        if stop - start == 0:
+            return self.data[:0], self.times[:0]
+        if i < j or j == 0:
+            j = j or self.capacity
+            return self.data[i:j], self.times[i:j]
+        return np.concatenate([self.data[i:], self.data[:j]]), np.concatenate([self.times[i:], self.times[:j]])
+
+    def index_at(self, timestamp):
+        """Absolute index of the first sample held at or after `timestamp` (`n_written` if none yet)."""
+        start = self.first_index
+        _, times = self.read(start)
+        return start + int(np.searchsorted(times, timestamp, side='left'))
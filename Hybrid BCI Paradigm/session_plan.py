@@ -0,0 +1,327 @@
+"""
+Session plans: everything a session will present, compiled before the window opens.
+
+A plan holds the target order, the trial locations of every block, the per-frame on/off tables
+(`frame_schedule`) and every marker the session sends (as strings and as `marker_codebook`
+codes), saved as a single `.npz` next to the data. `BCI_Paradigm_24-25.py` loads
+`<data file>_plan.npz` if it exists and otherwise compiles and saves one at startup, so the block
+loops only look things up in the plan and every session can be reproduced and audited afterwards.
+
+Plans can be compiled ahead of time from the settings in `BCI_Paradigm_24-25.py`:
+    python session_plan.py --participant sub-123 --monitor Alienware
+    python session_plan.py --participant sub-123 --condition Oddball FlickerOddball --seed 42
+"""
+import argparse
+import ast
+import json
+import os
+import os.path as op
+
+import numpy as np
+
+from frame_schedule import CONDITIONS, FrameSchedule, compile_block_schedule
+from marker_codebook import MarkerCodebook
+from shared_modules import use_shared
+from trial_sequences import block_sequences, validate_sequences
+
+expt_root = op.dirname(op.abspath(__file__))
+SCRIPT = op.join(expt_root, 'BCI_Paradigm_24-25.py')
+
+# Module-level settings of the experiment script that the frame schedules depend on
+TIMING_NAMES = ['flicker_trial_time', 'highlight_duration', 'flickeroddball_flicker_time',
+                'between_trial_duration', 'danny_flicker_trial_time', 'danny_flicker_inter_trial_time',
+                'danny_flicker_repeats', 'danny_flickeroddball_flicker_time']
+
+ODDBALL_CONDITIONS = ('Oddball', 'FlickerOddball', 'DannyFlickerOddball')
+
+# Markers sent once per block, outside the frame schedule
+BLOCK_MARKERS = ('target_marker', 'block_start', 'block_end', 'flash_count_start')
+
+
+def read_script_constants(path, names):
+    """
+    Read module-level assignments (e.g. `screens` or `flicker_trial_time`) from a script without
+    running it. Literals are read as they are; simple expressions of constants read before them
+    (e.g. `num_blocks = num_locations * 1`) are evaluated.
+    """
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    values = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in names:
+                try:
+                    values[name] = ast.literal_eval(node.value)
+                except ValueError:
+                    try:
+                        values[name] = eval(compile(ast.Expression(node.value), path, 'eval'),
+                                            {'__builtins__': {}}, dict(values))
+                    except Exception:
+                        pass
+    return values
+
+
+def make_stimuli_map(flicker_freqs, refresh_rate, num_locations, dist_from_ctr):
+    """
+    `stimuli_map` as built by the experiment script: coordinates, frequency, frames per flicker cycle
+    and the frequency those frames actually give at `refresh_rate` ('delivered_frequency', with a
+    warning printed if it is off).
+    """
+    from monitor_calibration import delivered_frequencies
+
+    delivered = delivered_frequencies(flicker_freqs[:num_locations], refresh_rate)
+    return {i: {'coordinates': (round(dist_from_ctr * np.sin(2 * np.pi * i / num_locations), 4),
+                                round(dist_from_ctr * np.cos(2 * np.pi * i / num_locations), 4)),
+                'frequency': flicker_freqs[i],
+                'frames': float(delivered[i][0]),
+                'delivered_frequency': round(delivered[i][1], 4)}
+            for i in range(num_locations)}
+
+
+def condition_seed(seed, condition):
+    """
+    Seed of one condition of a session: the child of the session seed for that condition, so it is
+    the same whichever conditions are compiled together.
+    """
+    entropy = seed.entropy if isinstance(seed, np.random.SeedSequence) else seed
+    return np.random.SeedSequence(entropy, spawn_key=(CONDITIONS.index(condition),))
+
+
+class SessionPlan:
+    """
+    Compiled session, as saved in the `.npz` file.
+
+    Attributes
+    ==========
+    info : dict
+        Condition, monitor, participant, session, refresh rate, timing and the seed of the plan.
+    stimuli_map : dict
+        Location -> coordinates, frequency and frames per flicker cycle.
+    codebook : dict
+        Marker codebook (as in the `_markers.json` sidecar).
+    target_order : np.ndarray of int16, shape (n_blocks,)
+        Target location of each block.
+    trial_locs : np.ndarray of int16, shape (n_blocks, n_trials)
+        Location of every trial (no columns for the flicker-only conditions).
+    on, layer : np.ndarray, shape (n_frames, n_locations)
+        On/off table and layers of all blocks, one after the other.
+    block_frames : np.ndarray of int64, shape (n_blocks + 1,)
+        First row of each block in `on`/`layer` (and the total number of rows).
+    event_block, event_frame : np.ndarray of int32
+        Block and frame (within the block) of each marker of the frame schedules.
+    event_marker, event_code : np.ndarray
+        That marker as a string and as a code.
+    block_markers, block_marker_codes : np.ndarray, shape (n_blocks, len(BLOCK_MARKERS))
+        The markers of each block that aren't part of the frame schedule.
+    freq_markers, freq_marker_codes : np.ndarray, shape (n_locations,)
+        The `loc_<n>/freq_<f>` markers sent at the start of the flicker conditions.
+    marker_mode : str
+        'string' or 'int', which form of the markers the methods return.
+    """
+    ARRAYS = ('target_order', 'trial_locs', 'flicker_frames_per_cycle', 'on', 'layer', 'block_frames',
+              'event_block', 'event_frame', 'event_marker', 'event_code',
+              'block_markers', 'block_marker_codes', 'freq_markers', 'freq_marker_codes')
+
+    def __init__(self, info, stimuli_map, codebook, marker_mode='string', **arrays):
+        self.info = info
+        self.stimuli_map = stimuli_map
+        self.codebook = codebook
+        self.marker_mode = marker_mode
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @property
+    def condition(self):
+        return self.info['condition']
+
+    @property
+    def n_blocks(self):
+        return self.target_order.shape[0]
+
+    def block_schedule(self, block):
+        """`FrameSchedule` of a block, with its markers in the form of `marker_mode`."""
+        rows = slice(self.block_frames[block], self.block_frames[block + 1])
+        markers = self.event_code if self.marker_mode == 'int' else self.event_marker
+        events = {}
+        for n in np.flatnonzero(self.event_block == block):
+            marker = markers[n].item()
+            events.setdefault(int(self.event_frame[n]), []).append(marker)
+        return FrameSchedule(self.on[rows], self.layer[rows], events)
+
+    def block_schedules(self):
+        return [self.block_schedule(block) for block in range(self.n_blocks)]
+
+    def block_marker(self, block, name):
+        """One of the `BLOCK_MARKERS` of a block, e.g. `plan.block_marker(0, 'block_start')`."""
+        markers = self.block_marker_codes if self.marker_mode == 'int' else self.block_markers
+        return markers[block, BLOCK_MARKERS.index(name)].item()
+
+    def freq_marker_list(self):
+        markers = self.freq_marker_codes if self.marker_mode == 'int' else self.freq_markers
+        return markers.tolist()
+
+    def write_marker_sidecar(self, filename):
+        """Save the marker codebook as JSON (`<data file>_markers.json`)."""
+        with open(filename, 'w') as f:
+            json.dump(self.codebook, f, indent=1)
+
+    def save(self, filename):
+        np.savez_compressed(filename,
+                            info=np.array(json.dumps(self.info)),
+                            stimuli_map=np.array(json.dumps(self.stimuli_map)),
+                            codebook=np.array(json.dumps(self.codebook)),
+                            **{name: getattr(self, name) for name in self.ARRAYS})
+
+
+def load_session_plan(filename, marker_mode='string'):
+    """Read a plan saved by `SessionPlan.save`."""
+    with np.load(filename) as f:
+        return SessionPlan(json.loads(f['info'].item()),
+                           {int(loc): details for loc, details in json.loads(f['stimuli_map'].item()).items()},
+                           json.loads(f['codebook'].item()),
+                           marker_mode=marker_mode,
+                           **{name: f[name] for name in SessionPlan.ARRAYS})
+
+
+def compile_session_plan(expt_mode, stimuli_map, refresh_rate, timing, num_blocks, num_trials,
+                         seed=None, info=None, marker_mode='string'):
+    """
+    Compile every block of a session.
+
+    Parameters
+    ==========
+    expt_mode : str
+        One of `CONDITIONS`.
+    stimuli_map : dict
+        Location -> {'coordinates', 'frequency', 'frames'}, as in `stimuli_map.json`.
+    refresh_rate : float
+        Monitor refresh rate in Hz.
+    timing : dict
+        Durations and repeats of the conditions (see `compile_block_schedule`).
+    num_blocks : int
+        Number of blocks.
+    num_trials : int
+        Trials per location per block in the oddball conditions.
+    seed : int, np.random.SeedSequence or None
+        Seed of the target order and trial sequences. None draws a new one (saved in the plan).
+    info : dict or None
+        Extra information to keep with the plan (participant, session, monitor...).
+    marker_mode : str
+        'string' or 'int', see `SessionPlan`.
+
+    Returns
+    ==========
+    SessionPlan
+    """
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    target_seed, trials_seed = seed.spawn(2)
+
+    num_locations = len(stimuli_map)
+    locs = sorted(stimuli_map, key=int)
+    flicker_freqs = [stimuli_map[loc]['frequency'] for loc in locs]
+    flicker_frames_per_cycle = [stimuli_map[loc]['frames'] for loc in locs]
+    codebook = MarkerCodebook(CONDITIONS, num_blocks, num_locations,
+                              n_repeats=timing['danny_flicker_repeats'], frequencies=flicker_freqs)
+
+    target_order = np.random.default_rng(target_seed).permutation(num_locations).astype(np.int16)
+    if expt_mode in ODDBALL_CONDITIONS:
+        trial_locs = block_sequences(num_blocks, num_locations, num_trials, seed=trials_seed)
+        validate_sequences(trial_locs, num_locations, num_trials)
+    else:
+        trial_locs = np.zeros((num_blocks, 0), dtype=np.int16)
+
+    on, layer, block_frames = [], [], [0]
+    event_block, event_frame, event_marker = [], [], []
+    block_markers = []
+    for block in range(num_blocks):
+        marker_prefix = expt_mode + '/block_' + str(block) + '/'
+        schedule = compile_block_schedule(expt_mode, flicker_frames_per_cycle, refresh_rate, timing,
+                                          trial_locs=trial_locs[block].tolist() if trial_locs.size else None,
+                                          target_loc=int(target_order[block]), marker_prefix=marker_prefix)
+        on.append(schedule.on)
+        layer.append(schedule.layer)
+        block_frames.append(block_frames[-1] + schedule.n_frames)
+        for frame in sorted(schedule.events):
+            for marker in schedule.events[frame]:
+                event_block.append(block)
+                event_frame.append(frame)
+                event_marker.append(marker)
+        block_markers.append([marker_prefix + f'target_marker/loc_{target_order[block]}', marker_prefix + 'block_start',
+                              marker_prefix + 'block_end', marker_prefix + 'flash_count_start'])
+
+    freq_markers = [f'loc_{loc}/freq_{frequency}' for loc, frequency in enumerate(flicker_freqs)]
+    info = dict(info or {}, condition=expt_mode, refresh_rate=refresh_rate, timing=timing,
+                num_blocks=num_blocks, num_trials=num_trials,
+                seed=str(seed.entropy), seed_spawn_key=list(seed.spawn_key))
+
+    return SessionPlan(info, {int(loc): stimuli_map[loc] for loc in locs}, codebook.to_dict(), marker_mode=marker_mode,
+                       target_order=target_order,
+                       trial_locs=trial_locs,
+                       flicker_frames_per_cycle=np.array(flicker_frames_per_cycle, dtype=float),
+                       on=np.concatenate(on),
+                       layer=np.concatenate(layer),
+                       block_frames=np.array(block_frames, dtype=np.int64),
+                       event_block=np.array(event_block, dtype=np.int32),
+                       event_frame=np.array(event_frame, dtype=np.int32),
+                       event_marker=np.array(event_marker, dtype=str),
+                       event_code=np.array([codebook.encode(m) for m in event_marker], dtype=np.int32),
+                       block_markers=np.array(block_markers, dtype=str),
+                       block_marker_codes=np.array([[codebook.encode(m) for m in row] for row in block_markers], dtype=np.int32),
+                       freq_markers=np.array(freq_markers, dtype=str),
+                       freq_marker_codes=np.array([codebook.encode(m) for m in freq_markers], dtype=np.int32),
+                       )
+
+
+def plan_filename(data_root, participant, session, condition):
+    """Where the experiment script looks for the plan (`<data file>_plan.npz`)."""
+    return op.join(data_root, participant, session, 'beh', f'{participant}_task-{condition}_plan.npz')
+
+
+def main(argv=None):
+    from monitor_calibration import load_profile, profile_filename
+
+    constants = read_script_constants(SCRIPT, {'screens', 'num_locations', 'dist_from_ctr', 'num_blocks',
+                                               'num_trials', 'sequence_seed'} | set(TIMING_NAMES))
+    screens = constants['screens']
+    parser = argparse.ArgumentParser(description='Compile session plans for BCI_Paradigm_24-25.py')
+    parser.add_argument('--participant', required=True, help="e.g. 'sub-123'")
+    parser.add_argument('--session', default='ses-001')
+    parser.add_argument('--condition', nargs='+', default=list(CONDITIONS), choices=list(CONDITIONS))
+    parser.add_argument('--monitor', default='Alienware', choices=list(screens))
+    parser.add_argument('--stimuli-map', help='stimuli_map.json to use instead of the frequencies in `screens`')
+    parser.add_argument('--seed', type=int, default=constants.get('sequence_seed'),
+                        help='seed of the session (each condition gets its own child seed)')
+    parser.add_argument('--data-root', default=op.join(expt_root, 'data'))
+    parser.add_argument('--calibration-root', default=op.join(expt_root, 'calibration'),
+                        help='measured monitor profiles; the nominal refresh rate is used if there is none')
+    args = parser.parse_args(argv)
+
+    screen = screens[args.monitor]
+    profile = load_profile(profile_filename(args.calibration_root, args.monitor), args.monitor, screen['resolution'])
+    refresh_rate = profile['refresh_rate'] if profile else screen['refresh_rate']
+    print(f"{args.monitor}: {refresh_rate} Hz ({'measured' if profile else 'nominal'})")
+    if args.stimuli_map:
+        with open(args.stimuli_map) as f:
+            stimuli_map = {int(loc): details for loc, details in json.load(f).items()}
+    else:
+        stimuli_map = make_stimuli_map(screen['flicker_freqs'], refresh_rate, constants['num_locations'],
+                                       constants['dist_from_ctr'])
+    timing = {name: constants[name] for name in TIMING_NAMES}
+
+    seed = np.random.SeedSequence(args.seed)
+    for condition in args.condition:
+        plan = compile_session_plan(condition, stimuli_map, refresh_rate, timing,
+                                    constants['num_blocks'], constants['num_trials'], seed=condition_seed(seed, condition),
+                                    info={'participant': args.participant, 'session': args.session,
+                                          'monitor_name': args.monitor})
+        filename = plan_filename(args.data_root, args.participant, args.session, condition)
+        os.makedirs(op.dirname(filename), exist_ok=True)
+        plan.save(filename)
+        print(f'{condition}: {plan.n_blocks} blocks, {plan.on.shape[0]} frames, '
+              f'{plan.event_marker.shape[0]} trial markers -> {filename}')
+
+
+if __name__ == '__main__':
+    use_shared()
+    main()
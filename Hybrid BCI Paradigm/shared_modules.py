@@ -0,0 +1,18 @@
+"""
+Access to the modules both paradigms use.
+
+`flip_timing`, `block_gc`, `incremental_writer`, `monitor_calibration` and `dry_run` are kept once,
+in `shared/` at the top of the repository. The scripts run from this folder (the experiment and
+the command lines of `session_plan.py`, `frequency_planner.py` and `benchmark_conditions.py`) call
+`use_shared()` before importing them; importing a module of this folder never changes `sys.path`.
+"""
+import os.path as op
+import sys
+
+SHARED = op.join(op.dirname(op.dirname(op.abspath(__file__))), 'shared')
+
+
+def use_shared():
+    """Put `shared/` on `sys.path`."""
+    if SHARED not in sys.path:
+        sys.path.insert(0, SHARED)
@@ -0,0 +1,523 @@
+"""
+Online SSVEP decoder for the `Flicker` and `DannyFlicker` conditions.
+
+Reads an EEG stream and the `BCIMarkerStream` markers from LSL, and decides which of the six
+locations the participant attends from the frequencies in `stimuli_map.json` (the measured
+`calibration/<monitor>_stimuli_map.json` if there is one). Each decision goes out as a marker
+such as `Flicker/block_0/decision/loc_3` on the `BCIDecoderStream` outlet.
+
+Filter-bank CCA (Chen et al. 2015): the EEG goes through a bank of FIR band-pass filters (streamed
+with overlap-save, so the filters never restart) into a ring buffer. Each sub-band is correlated with
+sine/cosine references at every frequency and its harmonics. The canonical correlations are
+computed incrementally, from running sums of the cross-products since the flicker started, so an
+update costs the same after 0.5 s as after 5 s. The weighted correlations of the sub-bands are turned
+into a confidence with a softmax. A decision is made as soon as the confidence crosses
+`threshold` (dynamic stopping), or when `max_duration` is reached.
+
+A decoding window starts with the flicker: at `block_start` in `Flicker` (and again after every
+decision, until `block_end`), at every `repeat_<n>` in `DannyFlicker`. The target marker of the
+block is used to report the accuracy online.
+
+Usage:
+    python ssvep_decoder.py --simulate
+    python ssvep_decoder.py --eeg-type EEG --channels 0 1 2 3 4 5 6 7
+    python ssvep_decoder.py --eeg-name ActiChamp-0 --codebook data/sub-123/ses-001/beh/sub-123_task-Flicker_markers.json
+"""
+import argparse
+import json
+import os.path as op
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from online_streams import (LatencyLog, MarkerParser, create_marker_outlet, eeg_channels, itr_bits_per_min,
+                            open_inlet)
+from ring_buffer import RingBuffer
+from session_plan import SCRIPT, read_script_constants
+
+expt_root = op.dirname(op.abspath(__file__))
+
+SSVEP_CONDITIONS = ('Flicker', 'DannyFlicker')
+
+Decision = namedtuple('Decision', ['location', 'frequency', 'confidence', 'duration', 'correlations', 'onset',
+                                   'timestamp'])
+
+
+def load_frequencies(stimuli_map_file):
+    """Flicker frequency of each location (`delivered_frequency` if the map has it)."""
+    with open(stimuli_map_file) as f:
+        stimuli_map = json.load(f)
+    return [stimuli_map[loc].get('delivered_frequency', stimuli_map[loc]['frequency'])
+            for loc in sorted(stimuli_map, key=int)]
+
+
+def bandpass_taps(low, high, sfreq, n_taps):
+    """Linear-phase FIR band-pass (Hamming-windowed sinc) from `low` to `high` Hz."""
+    n = np.arange(n_taps) - (n_taps - 1) / 2
+
+    def lowpass(cutoff):
+        return 2 * cutoff / sfreq * np.sinc(2 * cutoff / sfreq * n)
+
+    return (lowpass(high) - lowpass(low)) * np.hamming(n_taps)
+
+
+def filter_bank_bands(freqs, sfreq, n_bands=5, high=90.0):
+    """
+    FBCCA sub-bands: band n starts just below the n-th harmonic of the lowest frequency, all end at
+    `high` (or 0.45 x the sampling rate). Bands that would be empty are left out.
+    """
+    high = min(high, 0.45 * sfreq)
+    lows = [max(1.0, (n + 1) * min(freqs) - 2.0) for n in range(n_bands)]
+    return [(low, high) for low in lows if low < high - 4.0]
+
+
+class FilterBank:
+    """
+    Streaming FIR filter bank.
+
+    Chunks are filtered with overlap-save in the frequency domain, keeping the last `n_taps - 1`
+    samples between chunks. The output is delayed by `delay` samples (half the filter length).
+
+    Parameters
+    ==========
+    bands : list of tuple
+        (low, high) of each band (Hz).
+    sfreq : float
+        Sampling rate (Hz).
+    n_channels : int
+        Number of channels.
+    n_taps : int
+        Filter length (odd).
+    """
+    def __init__(self, bands, sfreq, n_channels, n_taps):
+        self.taps = np.stack([bandpass_taps(low, high, sfreq, n_taps) for low, high in bands])
+        self.n_taps = n_taps
+        self.delay = (n_taps - 1) // 2
+        self._tail = np.zeros((n_taps - 1, n_channels))
+        self._spectra = {}
+
+    def process(self, chunk):
+        """Filter a chunk, shape (n_samples, n_channels), into (n_samples, n_bands, n_channels)."""
+        x = np.concatenate([self._tail, chunk])
+        nfft = 1 << int(np.ceil(np.log2(x.shape[0])))
+        if nfft not in self._spectra:
+            self._spectra[nfft] = np.fft.rfft(self.taps, nfft, axis=1)
+        spectrum = np.fft.rfft(x, nfft, axis=0)
+        # The first n_taps - 1 outputs are wrapped around (circular convolution) and are dropped
+        y = np.fft.irfft(self._spectra[nfft][:, :, None] * spectrum[None], nfft, axis=1)[:, self.n_taps - 1:x.shape[0]]
+        self._tail = x[x.shape[0] - (self.n_taps - 1):]
+        return y.transpose(1, 0, 2)
+
+
+class IncrementalCCA:
+    """
+    Canonical correlations between a growing EEG window and sine/cosine references.
+
+    Only the sums of the samples and of their cross-products are kept, so adding a chunk and
+    computing the correlations don't depend on the length of the window.
+
+    Parameters
+    ==========
+    n_bands, n_channels : int
+        Shape of a filtered sample.
+    freqs : list of float
+        Frequencies (Hz).
+    sfreq : float
+        Sampling rate (Hz).
+    n_harmonics : int
+        Harmonics in the references (those above 0.45 x the sampling rate are left out).
+    regularization : float
+        Added to the diagonal of the covariances, relative to their mean variance.
+    """
+    def __init__(self, n_bands, n_channels, freqs, sfreq, n_harmonics=3, regularization=1e-4):
+        harmonics = np.arange(1, n_harmonics + 1)
+        omega = 2 * np.pi * np.outer(freqs, harmonics) / sfreq  # (freq, harmonic), radians per sample
+        self.omega = np.where(omega < 0.9 * np.pi, omega, 0.0)  # a zero reference is ignored by the regularisation
+        self.n_bands, self.n_channels = n_bands, n_channels
+        self.regularization = regularization
+        self.reset()
+
+    def reset(self):
+        k, c, (f, h) = self.n_bands, self.n_channels, self.omega.shape
+        self.n = 0
+        self.sx = np.zeros((k, c))
+        self.sxx = np.zeros((k, c, c))
+        self.sy = np.zeros((f, 2 * h))
+        self.syy = np.zeros((f, 2 * h, 2 * h))
+        self.sxy = np.zeros((k, c, f, 2 * h))
+
+    def references(self, start, n):
+        """References of samples `start` to `start + n` of the window, shape (freq, n, 2 x harmonic)."""
+        phase = self.omega[:, None, :] * np.arange(start, start + n)[None, :, None]
+        return np.concatenate([np.sin(phase), np.cos(phase)], axis=2)
+
+    def add(self, x):
+        """Add filtered samples, shape (n_samples, n_bands, n_channels)."""
+        n = x.shape[0]
+        if not n:
+            return
+        y = self.references(self.n, n)
+        xk = x.transpose(1, 2, 0)  # (band, channel, sample)
+        self.sx += xk.sum(axis=2)
+        self.sxx += xk @ x.transpose(1, 0, 2)
+        self.sy += y.sum(axis=1)
+        self.syy += y.transpose(0, 2, 1) @ y
+        f, _, r = y.shape
+        self.sxy += (x.reshape(n, -1).T @ y.transpose(1, 0, 2).reshape(n, -1)).reshape(self.n_bands, self.n_channels,
+                                                                                       f, r)
+        self.n += n
+
+    def correlations(self):
+        """Largest canonical correlation of every band and frequency, shape (band, freq)."""
+        n = self.n
+        cxx = self.sxx - self.sx[:, :, None] * self.sx[:, None, :] / n
+        cyy = self.syy - self.sy[:, :, None] * self.sy[:, None, :] / n
+        cxy = (self.sxy - self.sx[:, :, None, None] * self.sy[None, None, :, :] / n).transpose(0, 2, 1, 3)
+        cxx = cxx + np.eye(self.n_channels) * (self.regularization * np.trace(cxx, axis1=1, axis2=2)
+                                               / self.n_channels + 1e-12)[:, None, None]
+        cyy = cyy + np.eye(cyy.shape[1]) * (self.regularization * np.trace(cyy, axis1=1, axis2=2)
+                                            / cyy.shape[1] + 1e-12)[:, None, None]
+        # Whiten both sides; the correlation is the largest singular value of what is left
+        lx = np.linalg.cholesky(cxx)[:, None]
+        ly = np.linalg.cholesky(cyy)[None]
+        a = np.linalg.solve(lx, cxy)  # (band, freq, channel, ref)
+        m = np.linalg.solve(ly, a.transpose(0, 1, 3, 2))
+        return np.clip(np.linalg.svd(m, compute_uv=False)[..., 0], 0.0, 1.0)
+
+
+class SSVEPDecoder:
+    """
+    FBCCA with dynamic stopping on a stream of EEG chunks.
+
+    Parameters
+    ==========
+    freqs : list of float
+        Flicker frequency of each location (Hz).
+    sfreq : float
+        Sampling rate of the EEG (Hz).
+    n_channels : int
+        Number of channels decoded.
+    n_harmonics : int
+        Harmonics in the references.
+    n_bands : int
+        Filter bank sub-bands.
+    filter_length : float
+        Length of the band-pass filters (s). The decisions are delayed by half of it.
+    min_duration, max_duration : float
+        Shortest and longest decoding window (s). A decision is made at `max_duration` whatever the
+        confidence.
+    threshold : float
+        Confidence at which to stop early.
+    beta : float
+        Sharpness of the softmax that turns the correlations into confidences.
+    step : float
+        Seconds of EEG between two confidence updates.
+    buffer_duration : float
+        Seconds of filtered EEG kept (must cover the marker delay and `max_duration`).
+    """
+    def __init__(self, freqs, sfreq, n_channels, n_harmonics=3, n_bands=5, filter_length=0.25, min_duration=0.5,
+                 max_duration=4.0, threshold=0.9, beta=40.0, step=0.1, buffer_duration=10.0):
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.sfreq = float(sfreq)
+        bands = filter_bank_bands(self.freqs, self.sfreq, n_bands)
+        n_taps = int(filter_length * self.sfreq) // 2 * 2 + 1
+        self.filters = FilterBank(bands, self.sfreq, n_channels, n_taps)
+        self.cca = IncrementalCCA(len(bands), n_channels, self.freqs, self.sfreq, n_harmonics)
+        self.weights = np.arange(1, len(bands) + 1) ** -1.25 + 0.25
+        self.buffer = RingBuffer(len(bands) * n_channels, int(buffer_duration * self.sfreq))
+        self.min_samples = int(min_duration * self.sfreq)
+        self.max_samples = int(max_duration * self.sfreq)
+        self.step_samples = max(1, int(step * self.sfreq))
+        self.threshold = threshold
+        self.beta = beta
+        self.filter_delay = self.filters.delay / self.sfreq
+
+        self.onset = None
+        self._next = None
+        self._next_update = 0
+        self.n_updates = 0
+        self.update_time = LatencyLog()
+
+    def start(self, onset):
+        """Start a decoding window at `onset` (EEG stream time, e.g. the timestamp of a marker)."""
+        self.onset = onset
+        self._next = None
+        self._next_update = self.min_samples
+        self.cca.reset()
+
+    def stop(self):
+        """Drop the current window without a decision."""
+        self.onset = None
+
+    def push(self, samples, timestamps):
+        """
+        Add a chunk of EEG, shape (n_samples, n_channels), with its timestamps.
+
+        Returns
+        ==========
+        Decision or None
+        """
+        samples = np.asarray(samples, dtype=float)
+        filtered = self.filters.process(samples)
+        # Filtered sample i is centred on input sample i - delay
+        self.buffer.write(filtered.reshape(filtered.shape[0], -1), np.asarray(timestamps) - self.filter_delay)
+        return self._decode()
+
+    def scores(self):
+        """FBCCA score of every frequency (weighted squared correlations), and the correlations."""
+        correlations = self.cca.correlations()
+        return self.weights @ correlations ** 2, correlations
+
+    def confidences(self, scores):
+        """Softmax of the correlations behind `scores`."""
+        rho = np.sqrt(scores / self.weights.sum())
+        p = np.exp(self.beta * (rho - rho.max()))
+        return p / p.sum()
+
+    def _decode(self):
+        if self.onset is None or not self.buffer.n_written:
+            return None
+        if self._next is None:
+            if self.buffer.times[(self.buffer.n_written - 1) % self.buffer.capacity] < self.onset:
+                return None  # the flicker hasn't reached the filtered EEG yet
+            self._next = max(self.buffer.index_at(self.onset), self.buffer.first_index)
+        stop = min(self.buffer.n_written, self._next + self.max_samples - self.cca.n)
+        data, times = self.buffer.read(self._next, stop)
+        self.cca.add(data.reshape(data.shape[0], self.cca.n_bands, self.cca.n_channels))
+        self._next = stop
+        if self.cca.n < min(self._next_update, self.max_samples):
+            return None
+
+        t = time.perf_counter()
+        self._next_update = self.cca.n + self.step_samples
+        scores, correlations = self.scores()
+        p = self.confidences(scores)
+        self.n_updates += 1
+        self.update_time.add(time.perf_counter() - t)
+        best = int(np.argmax(p))
+        if p[best] < self.threshold and self.cca.n < self.max_samples:
+            return None
+        decision = Decision(best, float(self.freqs[best]), float(p[best]), self.cca.n / self.sfreq,
+                            correlations, self.onset, float(times[-1]) + self.filter_delay)
+        self.onset = None
+        return decision
+
+
+class OnlineSSVEP:
+    """
+    Run an `SSVEPDecoder` on LSL streams and push its decisions.
+
+    Parameters
+    ==========
+    decoder : SSVEPDecoder
+    eeg_inlet, marker_inlet : pylsl.StreamInlet
+        EEG and `BCIMarkerStream` inlets (see `online_streams.open_inlet`).
+    outlet : pylsl.StreamOutlet
+        Decision marker outlet.
+    channels : list of int or None
+        EEG channels decoded (all if None).
+    parser : MarkerParser or None
+        Needed for an 'int' marker stream (with the codebook).
+    max_chunk : int
+        Most samples pulled at once, which bounds the work per update.
+    clock : callable or None
+        LSL clock, `pylsl.local_clock` by default.
+    """
+    def __init__(self, decoder, eeg_inlet, marker_inlet, outlet, channels=None, parser=None, max_chunk=64,
+                 clock=None):
+        if clock is None:
+            from pylsl import local_clock
+            clock = local_clock
+        self.decoder = decoder
+        self.eeg_inlet = eeg_inlet
+        self.marker_inlet = marker_inlet
+        self.outlet = outlet
+        self.channels = channels
+        self.parser = parser or MarkerParser()
+        self.max_chunk = max_chunk
+        self.clock = clock
+
+        self.continuous = False  # `Flicker`: decode again after each decision until the block ends
+        self.trial = None  # (condition, block) of the current window
+        self.target = None
+        self.decisions = []
+        self.latency = LatencyLog()
+
+    def on_marker(self, marker, timestamp):
+        parts = self.parser.parse(marker)
+        if parts['condition'] not in SSVEP_CONDITIONS:
+            return
+        status = parts['status']
+        if status == 'target_marker':
+            self.target = parts['location']
+        elif status == 'block_start' and parts['condition'] == 'Flicker':
+            self.continuous = True
+            self.trial = (parts['condition'], parts['block'])
+            self.decoder.start(timestamp)
+        elif status.startswith('repeat_'):
+            self.continuous = False
+            self.trial = (parts['condition'], parts['block'])
+            self.decoder.start(timestamp)
+        elif status == 'block_end':
+            self.continuous = False
+            self.decoder.stop()
+
+    def on_decision(self, decision, now):
+        condition, block = self.trial
+        self.outlet.push_sample([f'{condition}/block_{block}/decision/loc_{decision.location}'], now)
+        self.latency.add(now - decision.timestamp)
+        self.decisions.append((decision, self.target))
+        print(f'{condition} block {block}: loc_{decision.location} ({decision.frequency:.2f} Hz), confidence '
+              f'{decision.confidence:.2f} after {decision.duration:.2f} s (target loc_{self.target})')
+        if self.continuous:
+            self.decoder.start(decision.timestamp)
+
+    def step(self, timeout=0.05):
+        """Read the new markers and one EEG chunk, and decode."""
+        markers, marker_times = self.marker_inlet.pull_chunk(timeout=0.0)
+        for marker, timestamp in zip(markers, marker_times):
+            self.on_marker(marker, timestamp)
+        samples, timestamps = self.eeg_inlet.pull_chunk(timeout=timeout, max_samples=self.max_chunk)
+        if not timestamps:
+            return
+        samples = np.asarray(samples)
+        if self.channels is not None:
+            samples = samples[:, self.channels]
+        decision = self.decoder.push(samples, timestamps)
+        if decision is not None:
+            self.on_decision(decision, self.clock())
+
+    def run(self, duration=None):
+        deadline = None if duration is None else time.monotonic() + duration
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                self.step()
+        except KeyboardInterrupt:
+            pass
+        print(self.report())
+
+    def report(self):
+        return decision_report(self.decisions, len(self.decoder.freqs), self.latency, self.decoder)
+
+
+def decision_report(decisions, n_classes, latency, decoder):
+    """Accuracy, selection time and ITR of `(decision, target)` pairs, plus the latencies."""
+    if not decisions:
+        return 'SSVEP decoder: no decisions'
+    scored = [(d, target) for d, target in decisions if target is not None]
+    durations = np.array([d.duration for d, _ in decisions])
+    lines = [f'SSVEP decoder: {len(decisions)} decisions, window median {np.median(durations):.2f} s '
+             f'(+{decoder.filter_delay * 1000:.0f} ms filter delay)']
+    if scored:
+        accuracy = np.mean([d.location == target for d, target in scored])
+        selection_time = np.mean([d.duration for d, _ in scored]) + decoder.filter_delay
+        lines.append(f'  accuracy {accuracy:.0%} of {len(scored)}, '
+                     f'ITR {itr_bits_per_min(n_classes, accuracy, selection_time):.1f} bits/min')
+    line = f'  update {decoder.update_time.summary()} ({decoder.n_updates} updates)'
+    if latency.n:
+        line += f', decision latency {latency.summary()}'
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+def simulate(decoder, n_trials=30, n_channels=8, snr=0.5, chunk=0.05, seed=None):
+    """
+    Run the decoder on synthetic EEG in-process: an SSVEP at the target frequency (and its harmonics,
+    with a different phase and gain on every channel) in 1/f noise, fed in chunks as from an inlet.
+
+    Returns
+    ==========
+    list of tuple
+        `(decision, target)` for each trial.
+    """
+    rng = np.random.default_rng(seed)
+    sfreq = decoder.sfreq
+    chunk_size = max(1, int(chunk * sfreq))
+    max_samples = decoder.max_samples + 2 * decoder.filters.n_taps
+    n_samples = (max_samples // chunk_size + 1) * chunk_size
+    freqs_axis = np.fft.rfftfreq(n_samples, 1 / sfreq)
+    pink = 1 / np.sqrt(np.maximum(freqs_axis, 1.0))
+    t0 = 0.0
+    decisions = []
+    for _ in range(n_trials):
+        target = int(rng.integers(len(decoder.freqs)))
+        t = np.arange(n_samples) / sfreq
+        noise = np.fft.irfft(pink[:, None] * (rng.standard_normal((freqs_axis.shape[0], n_channels))
+                                              + 1j * rng.standard_normal((freqs_axis.shape[0], n_channels))),
+                             n_samples, axis=0)
+        noise /= noise.std(axis=0)
+        signal = np.zeros((n_samples, n_channels))
+        for harmonic in range(1, 4):
+            phase = rng.uniform(0, 2 * np.pi, n_channels)
+            gain = rng.uniform(0.5, 1.0, n_channels) / harmonic
+            signal += gain * np.sin(2 * np.pi * harmonic * decoder.freqs[target] * t[:, None] + phase)
+        eeg = noise + snr * signal
+        timestamps = t0 + t
+        decoder.start(t0)
+        decision = None
+        for start in range(0, n_samples, chunk_size):
+            decision = decoder.push(eeg[start:start + chunk_size], timestamps[start:start + chunk_size])
+            if decision is not None:
+                break
+        decoder.stop()
+        decisions.append((decision, target))
+        t0 = timestamps[-1] + 1 / sfreq
+    return [(d, target) for d, target in decisions if d is not None]
+
+
+def main(argv=None):
+    screens = read_script_constants(SCRIPT, {'screens'})['screens']
+    parser = argparse.ArgumentParser(description='Online FBCCA decoder for the Flicker conditions')
+    parser.add_argument('--monitor', default='Alienware', choices=list(screens),
+                        help='use the stimuli map measured on this monitor (calibration/<monitor>_stimuli_map.json)')
+    parser.add_argument('--stimuli-map', help='stimuli map to use instead')
+    parser.add_argument('--eeg-name', help='name of the EEG stream (default: the first stream of --eeg-type)')
+    parser.add_argument('--eeg-type', default='EEG')
+    parser.add_argument('--channels', type=int, nargs='+', help='channel indices to decode (default: all)')
+    parser.add_argument('--codebook', help="_markers.json sidecar, for marker_mode = 'int'")
+    parser.add_argument('--outlet', default='BCIDecoderStream')
+    parser.add_argument('--threshold', type=float, default=0.9)
+    parser.add_argument('--min-duration', type=float, default=0.5)
+    parser.add_argument('--max-duration', type=float, default=4.0)
+    parser.add_argument('--harmonics', type=int, default=3)
+    parser.add_argument('--bands', type=int, default=5)
+    parser.add_argument('--duration', type=float, help='seconds to run (default: until Ctrl+C)')
+    parser.add_argument('--simulate', action='store_true', help='decode synthetic EEG in-process instead of LSL')
+    parser.add_argument('--sfreq', type=float, default=500.0, help='sampling rate of --simulate')
+    parser.add_argument('--snr', type=float, default=0.5, help='SSVEP amplitude of --simulate (noise SD = 1)')
+    parser.add_argument('--trials', type=int, default=30, help='trials of --simulate')
+    args = parser.parse_args(argv)
+
+    stimuli_map_file = args.stimuli_map
+    if stimuli_map_file is None:
+        stimuli_map_file = op.join(expt_root, 'calibration', f'{args.monitor}_stimuli_map.json')
+        if not op.exists(stimuli_map_file):
+            stimuli_map_file = op.join(expt_root, 'stimuli_map.json')
+    freqs = load_frequencies(stimuli_map_file)
+    settings = dict(n_harmonics=args.harmonics, n_bands=args.bands, threshold=args.threshold,
+                    min_duration=args.min_duration, max_duration=args.max_duration)
+    if args.simulate:
+        n_channels = len(args.channels) if args.channels else 8
+        decoder = SSVEPDecoder(freqs, args.sfreq, n_channels, **settings)
+        decisions = simulate(decoder, n_trials=args.trials, n_channels=n_channels, snr=args.snr, seed=0)
+        print(f'Simulated {args.trials} trials at {args.sfreq:g} Hz, {n_channels} channels, SNR {args.snr}, '
+              f'frequencies {freqs}')
+        print(decision_report(decisions, len(freqs), LatencyLog(), decoder))
+        return 0
+
+    eeg_inlet = open_inlet(name=args.eeg_name, stream_type=None if args.eeg_name else args.eeg_type)
+    n_channels, sfreq = eeg_channels(eeg_inlet)
+    if args.channels:
+        n_channels = len(args.channels)
+    marker_inlet = open_inlet(name='BCIMarkerStream')
+    decoder = SSVEPDecoder(freqs, sfreq, n_channels, **settings)
+    outlet = create_marker_outlet(args.outlet, 'BCIPsychoPySSVEP')
+    print(f'Decoding {n_channels} channels at {sfreq:g} Hz, frequencies {freqs} -> {args.outlet}')
+    OnlineSSVEP(decoder, eeg_inlet, marker_inlet, outlet, channels=args.channels,
+                parser=MarkerParser(args.codebook)).run(args.duration)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
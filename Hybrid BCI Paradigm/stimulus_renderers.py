@@ -0,0 +1,199 @@
+"""
+Render backends for the six stimulus locations.
+
+Both backends take the per-location display codes produced by `frame_schedule` (0 = off,
+otherwise a bitmask of `SILHOUETTE_BIT` and `IMAGE_BIT`) and are interchangeable in
+`play_schedule`:
+
+- `AutoDrawRenderer` toggles autoDraw on the individual `visual.ImageStim` objects.
+- `ElementArrayRenderer` packs every texture into one atlas and draws all locations with a
+  single `visual.ElementArrayStim`, so a frame costs one draw call however many locations are on.
+"""
+import numpy as np
+
+from frame_schedule import SILHOUETTE_BIT, IMAGE_BIT
+
+LAYER_BITS = (SILHOUETTE_BIT, IMAGE_BIT)
+
+
+class AutoDrawRenderer:
+    """
+    Show each location by switching autoDraw on its `visual.ImageStim`.
+
+    Parameters
+    ==========
+    layers : sequence
+        Stimuli for each layer, indexed `layers[layer][location]` -> `(silhouettes, image_stims)`.
+    """
+    def __init__(self, layers):
+        self.layers = layers
+        self.n_locations = len(layers[0])
+        self._shown = [0] * self.n_locations
+        # Built once so `apply` doesn't create zip iterators on every frame
+        self._layer_bits = tuple(zip(layers, LAYER_BITS))
+
+    def start(self):
+        self._shown = [0] * self.n_locations
+
+    def apply(self, changes):
+        for loc, code in changes:
+            # Switch off everything at the location first so the image always lands on top
+            previous = self._shown[loc]
+            for stims, bit in self._layer_bits:
+                if previous & bit:
+                    stims[loc].setAutoDraw(False)
+            for stims, bit in self._layer_bits:
+                if code & bit:
+                    stims[loc].setAutoDraw(True)
+            self._shown[loc] = code
+
+    def stop(self):
+        self.apply([(loc, 0) for loc in range(self.n_locations) if self._shown[loc]])
+
+
+def _power_of_2_grid(n_tiles):
+    """Number of tiles per side of a square grid holding `n_tiles`, rounded up to a power of 2."""
+    side = int(np.ceil(np.sqrt(n_tiles)))
+    return 1 << max(side - 1, 0).bit_length()
+
+
+def build_texture_atlas(images, tile_res=256):
+    """
+    Pack images into a square, power-of-two RGBA texture atlas.
+
+    Parameters
+    ==========
+    images : list of str or PIL.Image.Image
+        Image files (or already decoded images, e.g. from `asset_cache`), placed row by row from
+        the top-left tile.
+    tile_res : int
+        Size in pixels each image is resampled to.
+
+    Returns
+    ==========
+    PIL.Image.Image, int
+        The atlas and the number of tiles per side.
+    """
+    from PIL import Image
+
+    grid = _power_of_2_grid(len(images))
+    atlas = Image.new('RGBA', (grid * tile_res, grid * tile_res), (0, 0, 0, 0))
+    for n, image in enumerate(images):
+        if isinstance(image, Image.Image):
+            tile = image.convert('RGBA').resize((tile_res, tile_res), Image.LANCZOS)
+        else:
+            with Image.open(image) as im:
+                tile = im.convert('RGBA').resize((tile_res, tile_res), Image.LANCZOS)
+        atlas.paste(tile, ((n % grid) * tile_res, (n // grid) * tile_res))
+    return atlas, grid
+
+
+def atlas_coordinates(sizes, grid, units='deg'):
+    """
+    Spatial frequencies and phases that pin element `n` to tile `n` of a `grid` x `grid` atlas.
+
+    PsychoPy centres each element's texture coordinates on `0.5 - phase` and spans `size * sf`
+    around it (just `sf` in 'norm', 'pix' and 'height' units, where sf is in cycles per element).
+    Rows of the atlas start from the top of the image, and texture y runs upwards.
+
+    Parameters
+    ==========
+    sizes : np.ndarray
+        Size of each element, shape (n_elements, 2).
+    grid : int
+        Number of tiles per side of the atlas.
+    units : str
+        Units of `sizes`.
+
+    Returns
+    ==========
+    np.ndarray, np.ndarray
+        sfs and phases, both shape (n_elements, 2).
+    """
+    sizes = np.asarray(sizes, dtype=float)
+    n_elements = sizes.shape[0]
+    tiles = np.arange(n_elements)
+    if units in ('norm', 'pix', 'height'):
+        sfs = np.full((n_elements, 2), 1.0 / grid)
+    else:
+        sfs = 1.0 / (grid * sizes)
+    phases = np.column_stack([0.5 - (tiles % grid + 0.5) / grid,
+                              (tiles // grid + 0.5) / grid - 0.5])
+    return sfs, phases
+
+
+class ElementArrayRenderer:
+    """
+    Draw every location with a single `visual.ElementArrayStim`.
+
+    There is one element per layer and location (silhouettes first so images are drawn on top of
+    them). Each element is pinned to its own tile of the texture atlas through its spatial frequency
+    and phase, and a location is shown or hidden by setting its elements' opacity.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window for this experiment.
+    layers : sequence
+        Stimuli for each layer, indexed `layers[layer][location]`. Their image file, position and
+        size are copied into the element array.
+    tile_res : int
+        Resolution of each texture in the atlas.
+    units : str
+        Units of the stimuli positions and sizes.
+    stim_class : type or None
+        Class of the element array, `visual.ElementArrayStim` by default.
+    """
+    def __init__(self, win, layers, tile_res=256, units='deg', stim_class=None):
+        if stim_class is None:
+            from psychopy import visual
+            stim_class = visual.ElementArrayStim
+
+        stims = [stim for layer in layers for stim in layer]
+        self.n_locations = len(layers[0])
+        self.n_layers = len(layers)
+
+        atlas, grid = build_texture_atlas([stim.image for stim in stims], tile_res=tile_res)
+
+        n_elements = len(stims)
+        xys = np.array([stim.pos for stim in stims], dtype=float)
+        sizes = np.array([stim.size for stim in stims], dtype=float)
+
+        sfs, phases = atlas_coordinates(sizes, grid, units)
+
+        self._opacities = np.zeros(n_elements)
+        # Element index offset and bit of each layer, built once for `apply`
+        self._layer_offsets = tuple((layer_n * self.n_locations, bit)
+                                    for layer_n, bit in enumerate(LAYER_BITS[:self.n_layers]))
+        self.stim = stim_class(win, units=units, nElements=n_elements,
+                               xys=xys, sizes=sizes, sfs=sfs, phases=phases,
+                               opacities=self._opacities,
+                               elementTex=atlas, elementMask=None,
+                               texRes=grid * tile_res, interpolate=True,
+                               autoLog=False)
+
+    def start(self):
+        self._opacities[:] = 0
+        self.stim.opacities = self._opacities
+        self.stim.setAutoDraw(True)
+
+    def apply(self, changes):
+        opacities = self._opacities
+        for loc, code in changes:
+            for offset, bit in self._layer_offsets:
+                opacities[offset + loc] = 1.0 if code & bit else 0.0
+        self.stim.opacities = self._opacities
+
+    def stop(self):
+        self.stim.setAutoDraw(False)
+
+
+def create_renderer(backend, win, layers, **kwargs):
+    """
+    Make the render backend selected by `render_backend` ('autodraw' or 'elementarray').
+    """
+    if backend == 'autodraw':
+        return AutoDrawRenderer(layers)
+    elif backend == 'elementarray':
+        return ElementArrayRenderer(win, layers, **kwargs)
+    raise ValueError(f'Unknown render backend {backend!r}')
@@ -0,0 +1,371 @@
+"""
+Synthetic EEG/MEG stream for testing without an amplifier.
+
+Publishes a multichannel LSL stream (`SyntheticEEG`, type 'EEG') of 1/f noise with the responses
+the paradigm should evoke:
+    - an SSVEP at the frequency of the attended location (the block's `target_marker`) and its
+      harmonics, while it flickers: the whole block in `Flicker` and `FlickerOddball`, each
+      `repeat_<n>` in `DannyFlicker`, each target flash in `DannyFlickerOddball`;
+    - a P300-like waveform after every `target` flash of the oddball conditions.
+Each response has its own random topography.
+
+The events come either from the `BCIMarkerStream` of a running experiment, or from a session plan
+(`--plan`), whose blocks are played on the generator's clock. With `--push-markers` it sends the plan's
+markers on `BCIMarkerStream` too, so the decoders can be tested on one machine without PsychoPy.
+
+Everything is generated block-wise with NumPy, in float32. The noise is cut from long segments made
+with one inverse FFT each and cross-faded, and the responses are outer products of a time course
+and a topography. So 300 channels at 5 kHz take a small fraction of one core (`--benchmark` measures
+it without LSL). Samples are sent `delay` seconds after their timestamp, as an amplifier would,
+so that markers arrive before the samples they affect.
+
+Usage:
+    python synthetic_eeg.py --channels 64 --sfreq 1000
+    python synthetic_eeg.py --plan data/sub-123/ses-001/beh/sub-123_task-Flicker_plan.npz --push-markers
+    python synthetic_eeg.py --benchmark --channels 300 --sfreq 5000
+"""
+import argparse
+import json
+import os.path as op
+import time
+
+import numpy as np
+
+from erp_decoder import p300_template
+from online_streams import LatencyLog, MarkerParser, open_inlet
+from session_plan import ODDBALL_CONDITIONS, SCRIPT, TIMING_NAMES, load_session_plan, read_script_constants
+from ssvep_decoder import load_frequencies
+
+expt_root = op.dirname(op.abspath(__file__))
+
+
+class PinkNoise:
+    """
+    Stream of 1/f^exponent noise with unit variance per channel.
+
+    Segments of `segment` seconds are made with one inverse FFT per channel and joined with
+    `crossfade`-second sine/cosine cross-fades, which keep the variance constant. The next segment
+    is made a few channels at a time while the current one is read, so no read pays for a whole
+    segment.
+    """
+    def __init__(self, n_channels, sfreq, exponent=1.0, segment=10.0, crossfade=1.0, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.n_channels = n_channels
+        self.n_segment = int(segment * sfreq)
+        self.n_fade = int(crossfade * sfreq)
+        self.n_usable = self.n_segment - self.n_fade  # the last n_fade samples are faded into the next segment
+        freqs = np.fft.rfftfreq(self.n_segment, 1 / sfreq)
+        self.shape = (np.maximum(freqs, 0.5) ** (-exponent / 2)).astype(np.float32)[:, None]
+        fade = np.linspace(0, np.pi / 2, self.n_fade, dtype=np.float32)[:, None]
+        self.fade_in, self.fade_out = np.sin(fade), np.cos(fade)
+        self._current = np.empty((self.n_segment, n_channels), dtype=np.float32)
+        self._make(self._current, 0, n_channels)
+        self._following = np.empty_like(self._current)
+        self._n_made = 0  # channels of the following segment made so far
+        self._pos = 0
+
+    def _make(self, segment, start, stop):
+        """Fill channels `start` to `stop` of `segment`."""
+        shape = (self.shape.shape[0], stop - start)
+        spectrum = self.rng.standard_normal(shape, dtype=np.float32) * self.shape
+        spectrum = spectrum + 1j * self.rng.standard_normal(shape, dtype=np.float32) * self.shape
+        part = np.fft.irfft(spectrum, self.n_segment, axis=0)
+        segment[:, start:stop] = part / part.std(axis=0)
+
+    def _make_following(self, stop):
+        if stop > self._n_made:
+            self._make(self._following, self._n_made, stop)
+            self._n_made = stop
+
+    def read(self, n):
+        """Next `n` samples, shape (n, n_channels)."""
+        out = np.empty((n, self.n_channels), dtype=np.float32)
+        filled = 0
+        while filled < n:
+            if self._pos >= self.n_usable:
+                self._make_following(self.n_channels)
+                following = self._following
+                following[:self.n_fade] = (following[:self.n_fade] * self.fade_in
+                                           + self._current[self.n_usable:] * self.fade_out)
+                self._current, self._following = following, self._current
+                self._n_made, self._pos = 0, 0
+            take = min(n - filled, self.n_usable - self._pos)
+            out[filled:filled + take] = self._current[self._pos:self._pos + take]
+            filled += take
+            self._pos += take
+        # Keep the following segment as far along as the current one
+        self._make_following(min(self.n_channels, -(-self._pos * self.n_channels // self.n_usable)))
+        return out
+
+
+class SyntheticEEG:
+    """
+    Noise plus the responses to the events of the paradigm.
+
+    Parameters
+    ==========
+    n_channels : int
+        Number of channels.
+    sfreq : float
+        Sampling rate (Hz).
+    freqs : list of float
+        Flicker frequency of each location (Hz).
+    timing : dict
+        Timing of the conditions (`session_plan.TIMING_NAMES`).
+    noise_uv, ssvep_uv, p300_uv : float
+        Noise SD and peak amplitudes of the SSVEP (fundamental) and the P300 (µV).
+    codebook : dict or None
+        Codebook, for an 'int' marker stream.
+    seed : int or None
+        Seed of the noise and the topographies.
+    """
+    def __init__(self, n_channels, sfreq, freqs, timing, noise_uv=10.0, ssvep_uv=2.0, p300_uv=5.0, codebook=None,
+                 seed=None):
+        rng = np.random.default_rng(seed)
+        self.sfreq = float(sfreq)
+        self.freqs = list(freqs)
+        self.timing = timing
+        self.noise_uv = noise_uv
+        self.noise = PinkNoise(n_channels, sfreq, seed=rng.integers(2 ** 32))
+        self.ssvep_topography = (ssvep_uv * rng.uniform(0.2, 1.0, n_channels)).astype(np.float32)
+        self.p300_topography = (p300_uv * rng.uniform(0.2, 1.0, n_channels)).astype(np.float32)
+        self.ssvep_harmonics = [(1, 1.0, rng.uniform(0, 2 * np.pi)), (2, 0.5, rng.uniform(0, 2 * np.pi)),
+                                (3, 0.25, rng.uniform(0, 2 * np.pi))]
+        self.p300 = p300_template(self.sfreq).astype(np.float32)
+        self.parser = MarkerParser(codebook)
+
+        self.target = None
+        self.ssvep = []  # (start, stop, frequency) of the flicker of the attended location
+        self.flashes = []  # onsets of the target flashes
+        self.n_events = 0
+
+    def on_marker(self, marker, timestamp):
+        parts = self.parser.parse(marker)
+        condition, status = parts['condition'], parts['status']
+        timing = self.timing
+        if status == 'target_marker':
+            self.target = parts['location']
+        elif self.target is None:
+            return
+        elif status == 'block_start' and condition in ('Flicker', 'FlickerOddball'):
+            self.ssvep.append([timestamp, np.inf, self.freqs[self.target]])
+        elif status == 'block_end':
+            for window in self.ssvep:
+                window[1] = min(window[1], timestamp)
+        elif status.startswith('repeat_') and condition == 'DannyFlicker':
+            self.ssvep.append([timestamp, timestamp + timing['danny_flicker_trial_time'], self.freqs[self.target]])
+        elif status == 'target':
+            self.flashes.append(timestamp)
+            if condition == 'DannyFlickerOddball':
+                self.ssvep.append([timestamp, timestamp + timing['danny_flickeroddball_flicker_time'],
+                                   self.freqs[self.target]])
+        else:
+            return
+        self.n_events += 1
+
+    def generate(self, t0, n):
+        """
+        `n` samples from time `t0`, shape (n, n_channels), float32 (µV).
+        """
+        eeg = self.noise.read(n)
+        eeg *= self.noise_uv
+        t = t0 + np.arange(n) / self.sfreq
+        t_end = t[-1]
+
+        course = None
+        for start, stop, freq in self.ssvep:
+            if start > t_end or stop < t0:
+                continue
+            i, j = np.searchsorted(t, [start, stop])
+            phase = 2 * np.pi * freq * (t[i:j] - start)
+            if course is None:
+                course = np.zeros(n, dtype=np.float32)
+            for harmonic, gain, offset in self.ssvep_harmonics:
+                course[i:j] += gain * np.sin(harmonic * phase + offset)
+        if course is not None:
+            eeg += course[:, None] * self.ssvep_topography
+
+        course = None
+        for onset in self.flashes:
+            if onset > t_end or onset + self.p300.shape[0] / self.sfreq < t0:
+                continue
+            # Template sample of every sample of the block, from the onset
+            k0 = int(round((t0 - onset) * self.sfreq))
+            k = np.arange(k0, k0 + n)
+            valid = (k >= 0) & (k < self.p300.shape[0])
+            if course is None:
+                course = np.zeros(n, dtype=np.float32)
+            course[valid] += self.p300[k[valid]]
+        if course is not None:
+            eeg += course[:, None] * self.p300_topography
+
+        # Forget what is over
+        self.ssvep = [w for w in self.ssvep if w[1] >= t_end]
+        self.flashes = [onset for onset in self.flashes if onset + self.p300.shape[0] / self.sfreq >= t_end]
+        return eeg
+
+
+def plan_timeline(plan, t0=0.0, target_id_duration=2.0, inter_block_interval=2.0, form_duration=3.0):
+    """
+    Markers of a session plan and when they would be sent, as if the session started at `t0`.
+
+    Returns
+    ==========
+    list of tuple
+        `(time, marker)` in time order (string markers).
+    """
+    refresh_rate = plan.info['refresh_rate']
+    markers = [(t0, marker) for marker in plan.freq_marker_list()]
+    t = t0
+    for block in range(plan.n_blocks):
+        markers.append((t, plan.block_marker(block, 'target_marker')))
+        t += target_id_duration
+        markers.append((t, plan.block_marker(block, 'block_start')))
+        for n in np.flatnonzero(plan.event_block == block):
+            markers.append((t + plan.event_frame[n] / refresh_rate, plan.event_marker[n].item()))
+        t += (plan.block_frames[block + 1] - plan.block_frames[block]) / refresh_rate
+        markers.append((t, plan.block_marker(block, 'block_end')))
+        t += form_duration if plan.condition in ODDBALL_CONDITIONS else inter_block_interval
+    return sorted(markers, key=lambda marker: marker[0])
+
+
+def benchmark(n_channels, sfreq, freqs, timing, duration=10.0, chunk=0.02):
+    """Generate `duration` seconds of a `Flicker` block as fast as possible, without LSL."""
+    generator = SyntheticEEG(n_channels, sfreq, freqs, timing, seed=0)
+    generator.on_marker('Flicker/block_0/target_marker/loc_0', 0.0)
+    generator.on_marker('Flicker/block_0/block_start', 0.0)
+    for n in range(int(duration / 0.75)):
+        generator.on_marker(f'Oddball/block_0/{"target" if n % 6 == 0 else "nontarget"}/loc_{n % 6}', n * 0.75)
+    chunk_size = max(1, int(chunk * sfreq))
+    n_chunks = int(duration * sfreq) // chunk_size
+    times = np.empty(n_chunks)
+    for n in range(n_chunks):
+        t = time.perf_counter()
+        generator.generate(n * chunk_size / sfreq, chunk_size)
+        times[n] = time.perf_counter() - t
+    print(f'{n_channels} channels at {sfreq:g} Hz, {chunk_size}-sample chunks: {duration / times.sum():.0f}x real time, '
+          f'chunk median {np.median(times) * 1000:.2f} ms, p95 {np.percentile(times, 95) * 1000:.2f} ms, '
+          f'max {times.max() * 1000:.2f} ms (of {chunk * 1000:.0f} ms)')
+
+
+def run(generator, n_channels, sfreq, name='SyntheticEEG', timeline=None, marker_inlet=None, push_markers=False,
+        chunk=0.02, delay=0.1, duration=None):
+    """
+    Stream `generator` on LSL in real time.
+
+    Parameters
+    ==========
+    timeline : list of tuple or None
+        `(time, marker)` from `plan_timeline`, relative to the start of the stream.
+    marker_inlet : pylsl.StreamInlet or None
+        `BCIMarkerStream` inlet of a running experiment.
+    push_markers : bool
+        Send the markers of `timeline` on a `BCIMarkerStream` outlet.
+    delay : float
+        Seconds between a sample's timestamp and when it is sent.
+    """
+    from pylsl import StreamInfo, StreamOutlet, local_clock
+
+    info = StreamInfo(name, 'EEG', n_channels, sfreq, 'float32', 'BCIPsychoPySynthetic')
+    channels = info.desc().append_child('channels')
+    for n in range(n_channels):
+        channel = channels.append_child('channel')
+        channel.append_child_value('label', f'S{n + 1}')
+        channel.append_child_value('unit', 'microvolts')
+        channel.append_child_value('type', 'EEG')
+    outlet = StreamOutlet(info, chunk_size=max(1, int(chunk * sfreq)))
+    marker_outlet = None
+    if push_markers and timeline:
+        marker_outlet = StreamOutlet(StreamInfo('BCIMarkerStream', 'Markers', 1, 0, 'string', 'BCIPsychoPySynthetic'))
+
+    chunk_size = max(1, int(chunk * sfreq))
+    t_start = local_clock() + delay
+    if timeline:
+        timeline = [(t_start + t, marker) for t, marker in timeline]
+    n_sent, n_timeline = 0, 0
+    lag = LatencyLog()
+    generate_time = LatencyLog()
+    print(f'Streaming {name}: {n_channels} channels at {sfreq:g} Hz' + (f', {len(timeline)} plan markers' if timeline else ''))
+    try:
+        while duration is None or n_sent < duration * sfreq:
+            now = local_clock()
+            while timeline and n_timeline < len(timeline) and timeline[n_timeline][0] <= now:
+                t, marker = timeline[n_timeline]
+                generator.on_marker(marker, t)
+                if marker_outlet is not None:
+                    marker_outlet.push_sample([marker], t)
+                n_timeline += 1
+            if marker_inlet is not None:
+                markers, marker_times = marker_inlet.pull_chunk(timeout=0.0)
+                for marker, timestamp in zip(markers, marker_times):
+                    generator.on_marker(marker[0], timestamp)
+
+            # Samples whose time (plus the delay) has come
+            due = int((now - delay - t_start) * sfreq) + 1 - n_sent
+            if due < chunk_size:
+                time.sleep((chunk_size - due) / sfreq)
+                continue
+            n = due // chunk_size * chunk_size
+            t0 = t_start + n_sent / sfreq
+            t = time.perf_counter()
+            data = generator.generate(t0, n)
+            generate_time.add(time.perf_counter() - t)
+            outlet.push_chunk(data, t0 + (n - 1) / sfreq)
+            lag.add(local_clock() - (t0 + (n - 1) / sfreq))
+            n_sent += n
+    except KeyboardInterrupt:
+        pass
+    print(f'{name}: {n_sent} samples ({n_sent / sfreq:.1f} s), {generator.n_events} events injected; generation '
+          f'{generate_time.summary()} per push, sample age when sent {lag.summary()}')
+
+
+def main(argv=None):
+    timing = read_script_constants(SCRIPT, set(TIMING_NAMES) | {'target_id_duration', 'inter_block_interval'})
+    parser = argparse.ArgumentParser(description='Synthetic EEG/MEG LSL stream with SSVEP and P300 responses')
+    parser.add_argument('--channels', type=int, default=64)
+    parser.add_argument('--sfreq', type=float, default=1000.0)
+    parser.add_argument('--name', default='SyntheticEEG')
+    parser.add_argument('--stimuli-map', default=op.join(expt_root, 'stimuli_map.json'))
+    parser.add_argument('--plan', help='play the markers of this session plan instead of reading BCIMarkerStream')
+    parser.add_argument('--push-markers', action='store_true', help='send the markers of --plan on BCIMarkerStream')
+    parser.add_argument('--codebook', help="_markers.json sidecar, for marker_mode = 'int'")
+    parser.add_argument('--noise', type=float, default=10.0, help='noise SD (µV)')
+    parser.add_argument('--ssvep', type=float, default=2.0, help='SSVEP amplitude (µV)')
+    parser.add_argument('--p300', type=float, default=5.0, help='P300 amplitude (µV)')
+    parser.add_argument('--chunk', type=float, default=0.02, help='seconds per push')
+    parser.add_argument('--delay', type=float, default=0.1, help='seconds between a sample and its push')
+    parser.add_argument('--duration', type=float, help='seconds to stream (default: until Ctrl+C)')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--benchmark', action='store_true', help='measure the generation speed without LSL')
+    args = parser.parse_args(argv)
+
+    plan = load_session_plan(args.plan) if args.plan else None
+    if plan is not None:
+        freqs = [plan.stimuli_map[loc].get('delivered_frequency', plan.stimuli_map[loc]['frequency'])
+                 for loc in sorted(plan.stimuli_map)]
+    else:
+        freqs = load_frequencies(args.stimuli_map)
+
+    if args.benchmark:
+        benchmark(args.channels, args.sfreq, freqs, timing, chunk=args.chunk)
+        return 0
+
+    codebook = None
+    if args.codebook:
+        with open(args.codebook) as f:
+            codebook = json.load(f)
+    generator = SyntheticEEG(args.channels, args.sfreq, freqs, timing, noise_uv=args.noise, ssvep_uv=args.ssvep,
+                             p300_uv=args.p300, codebook=codebook, seed=args.seed)
+    timeline, marker_inlet = None, None
+    if plan is not None:
+        timeline = plan_timeline(plan, target_id_duration=timing['target_id_duration'],
+                                 inter_block_interval=timing['inter_block_interval'])
+    else:
+        marker_inlet = open_inlet(name='BCIMarkerStream')
+    run(generator, args.channels, args.sfreq, name=args.name, timeline=timeline, marker_inlet=marker_inlet,
+        push_markers=args.push_markers, chunk=args.chunk, delay=args.delay, duration=args.duration)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
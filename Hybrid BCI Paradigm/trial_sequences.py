@@ -0,0 +1,192 @@
+"""
+Trial sequences with no location stimulated twice in a row.
+
+`no_repeat_sequence` draws every item exactly `repeats` times in linear time. Each step picks a
+random remaining trial (so items are drawn in proportion to how often they are still left),
+rejects the item of the previous trial, and forces the item that would otherwise become
+impossible to place, i.e. the one with more than half of the remaining trials. The constraint is
+therefore always met, unlike shuffling and then swapping duplicates, which can leave repeats at
+the end of the list.
+
+Sequences are seeded through `np.random.SeedSequence`, so a whole session (or every participant of a
+study) can be generated ahead of time from one seed and checked with `validate_sequences`.
+
+Usage (throughput benchmark):
+    python trial_sequences.py
+    python trial_sequences.py --locations 6 12 24 --repeats 10 100 1000
+"""
+import argparse
+import time
+
+import numpy as np
+
+
+def no_repeat_sequence(items, repeats=10, rng=None):
+    """
+    Random order of `items`, each repeated `repeats` times, with no item twice in a row.
+
+    Parameters
+    ==========
+    items : list
+        Items to order, e.g. `list(range(num_locations))`.
+    repeats : int or list of int
+        Number of times each item appears (one count per item if a list).
+    rng : np.random.Generator, int or None
+        Random generator, or a seed for one.
+
+    Returns
+    ==========
+    list
+        The sequence.
+    """
+    rng = np.random.default_rng(rng)
+    counts = [repeats] * len(items) if np.isscalar(repeats) else list(repeats)
+    n = sum(counts)
+    if n == 0:
+        return []
+    max_count = max(counts)
+    if max_count > (n + 1) // 2:
+        raise ValueError(f'No sequence without consecutive repeats exists: an item appears {max_count} '
+                         f'times out of {n}')
+
+    # One entry per remaining trial (item index), removed by swapping in the last entry
+    pool = [i for i, count in enumerate(counts) for _ in range(count)]
+    # Number of items left with each count, to keep track of the largest count in O(1) per step
+    n_with_count = [0] * (max_count + 1)
+    for count in counts:
+        n_with_count[count] += 1
+
+    uniforms = rng.random(2 * n + 16)
+    u = 0
+    sequence = [None] * n
+    previous = -1
+    for step in range(n):
+        remaining = n - step
+        # An item holding more than half of the remaining trials has to go now
+        forced = max_count > remaining // 2
+        while True:
+            if u == uniforms.shape[0]:
+                uniforms = rng.random(2 * remaining + 16)
+                u = 0
+            idx = int(uniforms[u] * remaining)
+            u += 1
+            item = pool[idx]
+            if item != previous and (not forced or counts[item] == max_count):
+                break
+
+        pool[idx] = pool[remaining - 1]
+        pool.pop()
+        n_with_count[counts[item]] -= 1
+        counts[item] -= 1
+        n_with_count[counts[item]] += 1
+        while max_count > 0 and n_with_count[max_count] == 0:
+            max_count -= 1
+
+        sequence[step] = items[item]
+        previous = item
+    return sequence
+
+
+def block_sequences(n_blocks, n_locations, repeats, seed=None):
+    """
+    Trial locations of every block of a session.
+
+    Parameters
+    ==========
+    n_blocks : int
+        Number of blocks.
+    n_locations : int
+        Number of stimulus locations.
+    repeats : int
+        Trials per location per block (`num_trials`).
+    seed : int, np.random.SeedSequence or None
+        Seed of the session. Each block gets its own child seed.
+
+    Returns
+    ==========
+    np.ndarray of int16, shape (n_blocks, n_locations * repeats)
+    """
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    locations = list(range(n_locations))
+    return np.array([no_repeat_sequence(locations, repeats, rng=np.random.default_rng(child))
+                     for child in seed.spawn(n_blocks)], dtype=np.int16).reshape(n_blocks, n_locations * repeats)
+
+
+def session_sequences(n_participants, n_blocks, n_locations, repeats, seed=None):
+    """
+    `block_sequences` for every participant of a study, from one study seed.
+
+    Returns
+    ==========
+    np.ndarray of int16, shape (n_participants, n_blocks, n_locations * repeats)
+    """
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return np.stack([block_sequences(n_blocks, n_locations, repeats, seed=child)
+                     for child in seed.spawn(n_participants)])
+
+
+def validate_sequences(sequences, n_locations, repeats):
+    """
+    Check trial sequences for consecutive repeats and wrong location counts.
+
+    Parameters
+    ==========
+    sequences : np.ndarray of int, shape (..., n_trials)
+        One sequence per row, e.g. the output of `block_sequences` or `session_sequences`.
+    n_locations : int
+        Number of stimulus locations.
+    repeats : int
+        Expected number of trials per location in every sequence.
+
+    Raises
+    ==========
+    ValueError
+        Listing the sequences (as index tuples) that break a constraint.
+    """
+    sequences = np.asarray(sequences)
+    repeated = (sequences[..., 1:] == sequences[..., :-1]).any(axis=-1)
+    counts = (sequences[..., np.newaxis] == np.arange(n_locations)).sum(axis=-2)
+    miscounted = (counts != repeats).any(axis=-1)
+
+    errors = []
+    if repeated.any():
+        errors.append(f'consecutive repeats in {[tuple(i) for i in np.argwhere(repeated).tolist()]}')
+    if miscounted.any():
+        errors.append(f'wrong location counts in {[tuple(i) for i in np.argwhere(miscounted).tolist()]}')
+    if errors:
+        raise ValueError('Invalid trial sequences: ' + '; '.join(errors))
+
+
+def benchmark(location_counts, repeat_counts, n_sequences=20, seed=0):
+    """Sequences and trials generated per second for each number of locations and repeats."""
+    results = []
+    for n_locations in location_counts:
+        for repeats in repeat_counts:
+            rng = np.random.default_rng(seed)
+            t = time.perf_counter()
+            sequences = [no_repeat_sequence(list(range(n_locations)), repeats, rng=rng) for _ in range(n_sequences)]
+            elapsed = time.perf_counter() - t
+            validate_sequences(np.array(sequences), n_locations, repeats)
+            results.append({'locations': n_locations,
+                            'repeats': repeats,
+                            'trials': n_locations * repeats,
+                            'ms_per_sequence': elapsed / n_sequences * 1000,
+                            'trials_per_s': n_sequences * n_locations * repeats / elapsed,
+                            })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Throughput of the no-repeat trial sequence generator')
+    parser.add_argument('--locations', nargs='+', type=int, default=[6, 12, 24, 48])
+    parser.add_argument('--repeats', nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument('--sequences', type=int, default=20, help='sequences generated per setting')
+    args = parser.parse_args(argv)
+
+    print(f"{'locations':>10}{'repeats':>9}{'trials':>9}{'ms/sequence':>13}{'trials/s':>13}")
+    for r in benchmark(args.locations, args.repeats, n_sequences=args.sequences):
+        print(f"{r['locations']:>10}{r['repeats']:>9}{r['trials']:>9}{r['ms_per_sequence']:>13.3f}{r['trials_per_s']:>13.0f}")
+
+
+if __name__ == '__main__':
+    main()
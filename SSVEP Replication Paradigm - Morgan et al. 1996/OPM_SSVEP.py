@@ -4,12 +4,25 @@ from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
                                 STOPPED, FINISHED, PRESSED, RELEASED, FOREVER, priority)
 import psychopy
 import os.path as op
+import sys
 import os
 import numpy as np
 from numpy.random import random, randint
 import random
 import u3
 
+# The only entry point of this folder, so ../shared (modules the Hybrid BCI paradigm uses too) goes on the path here
+sys.path.insert(0, op.join(op.dirname(op.dirname(op.abspath(__file__))), 'shared'))
+
+from flip_timing import FlipTimer
+from block_gc import BlockGC
+from character_stream import CharacterStream, no_repeat_sequences
+from incremental_writer import IncrementalWriter
+from trigger_scheduler import TriggerScheduler
+from trial_timeline import Phase, TrialTimeline, duration_frames
+from monitor_calibration import (calibrate, check_refresh_rate, delivered_frequencies, load_profile, profile_filename,
+                                 profile_matches)
+
 
 
 ############################################
@@ -46,6 +59,12 @@ def endExperiment(thisExp, win=None):
     thisExp.status = FINISHED
     
     # Cleanup and Exit
+    print(block_gc.report())
+    triggers.close() # Write the triggers still queued before the data log closes
+    print(triggers.report())
+    print(character_stream.report())
+    data_writer.close() # Write the rows and triggers still queued
+    print(data_writer.report())
     core.wait(2.)
     logging.flush()
     
@@ -142,27 +161,6 @@ def setupLogging(filename):
     
     return logFile
 
-## This function creates a list with no back-to-back repeats
-def create_randomized_stim_sequence(win, image_paths, characters, position, num_stim=51):
-    # Generate an initial random sequence with choices
-    random_sequence = random.choices(characters, k=num_stim)
-    
-    # Adjust to ensure no consecutive duplicates
-    for i in range(1, len(random_sequence)):
-        if random_sequence[i] == random_sequence[i - 1]:
-            # Pick a new character that is not the same as the previous one
-            available_characters = [char for char in characters if char != random_sequence[i - 1]]
-            random_sequence[i] = random.choice(available_characters)
-            
-    # Create the stimulus sequence with ImageStim objects
-    # stim_sequence = [visual.ImageStim(win, image=image_paths[char], pos=position, name=char) for char in random_sequence]
-    stim_sequence = [visual.ImageStim(win, image=image_paths[char], pos=position, name=char, units='deg', mask=None, anchor='center',
-        ori=0.0, size=letter_size,
-        color=[1,1,1], colorSpace='rgb', opacity=None,
-        flipHoriz=False, flipVert=False,
-        texRes=128.0, interpolate=True, depth=-2.0) for char in random_sequence] # change texRes to 256.0 from 128.0
-    return stim_sequence
-
 def clear_window():
     win.clearAutoDraw()
     win.clearBuffer()
@@ -195,7 +193,7 @@ expt_root = op.dirname(op.abspath(__file__))
 
 print(f"Experiment Root: {expt_root}")
 
-data_root = op.join(expt_root, 'data')
+data_root = os.environ.get('PARADIGM_DATA_ROOT') or op.join(expt_root, 'data') # the dry run writes to a temporary folder
 
 ###############################
 # LabJack Initialization
@@ -259,22 +257,54 @@ expInfo = showExpInfoDlg(expInfo=expInfo, gui=gui)
 thisExp, data_dir = setupData(expInfo=expInfo, data_dir=data_root)
 logFile = setupLogging(filename=thisExp.dataFileName)
 
+# Trial rows and every LabJack trigger are also appended to <file>_rows.jsonl / <file>_markers.bin after each
+# block, so a crash loses at most the current block (`python incremental_writer.py <file>` rebuilds the csv)
+data_writer = IncrementalWriter(thisExp.dataFileName, info=thisExp.extraInfo)
+
+# LabJack writes go through an I/O thread, and only when the value changes (the DAC holds it in between).
+# Each write is queued for the data log with the time it was requested, or of the flip it was locked to.
+triggers = TriggerScheduler(d, u3.DAC0_8, clock=core.getTime, log=data_writer.add_marker)
+
 monitor_name = expInfo['monitor_name']
 monitor_num = screens[monitor_name]['monitor_num']
 monitor_width = screens[monitor_name]['width']
 monitor_res = screens[monitor_name]['resolution']
 
+############################################
+# Monitor calibration
+############################################
+# The refresh rate in `screens` is nominal. The actual rate is measured once per monitor (a few seconds of flips
+# in a window of its own) and kept in calibration/<monitor>.json; frame counts and flicker periods use it.
+calibration_max_age_days = 90  # measure again after this many days (None keeps a profile until it is deleted)
+calibration_file = profile_filename(op.join(expt_root, 'calibration'), monitor_name)
+monitor_profile = load_profile(calibration_file, monitor_name, monitor_res, max_age_days=calibration_max_age_days)
+# Only a monitor without a valid profile is measured, in a window of its own; a stored profile is loaded as it is
+# and checked on the experiment window once it is open
+profile_measured = monitor_profile is None
+if profile_measured:
+    calibration_win = visual.Window(monitor=monitors.Monitor(monitor_name), screen=monitor_num, size=monitor_res,
+                                    units='deg', winType='pyglet', fullscr=True, allowGUI=False, waitBlanking=True,
+                                    color='black', useRetina=screens[monitor_name]['useRetina'])
+    calibration_win.mouseVisible = False
+    monitor_profile = calibrate(calibration_win, calibration_file, monitor_name, monitor_res,
+                                nominal_refresh_rate=screens[monitor_name]['refresh_rate'])
+    calibration_win.close()
+check_refresh_rate(monitor_profile)
+
 ############################################  
 # Parameters user might want to change
 ############################################
-refresh_rate = screens[monitor_name]['refresh_rate']  # Monitor refresh rate
+refresh_rate = monitor_profile['refresh_rate']  # Measured monitor refresh rate -> see Monitor calibration
 letter_duration = 0.2  # 200ms
-frames_per_letter = int(refresh_rate * letter_duration) # 200 ms = 12 frames @ 60 frames per second
+frames_per_letter = round(refresh_rate * letter_duration) # 200 ms = 12 frames @ 60 frames per second
 trial_duration = 10 # Seconds
 num_trials = 8 # Number of trials per block
 num_blocks = 15 # Number of blocks per participant
-arrow_duration = 1.5 # Seconds
+ready_duration = 2 # Seconds
 fixation_cross_duration = 3 # Seconds
+arrow_duration = 1.5 # Seconds
+pre_flicker_duration = 0.5 # Seconds, fixation cross between the arrow and the flicker
+inter_trial_duration = 2 # Seconds, fixation cross after the flicker
 vertical_offset = 0
 
 view_dist = screens[monitor_name]['view_dist'] #60.0 #13.0  # viewing distance in cm
@@ -301,6 +331,10 @@ conditions = [
     {"attention": "right", "flicker": {"left": 10, "right": 12}, "voltage": RIGHT_ATT_10HZ_LEFT_12HZ_RIGHT},
 ]
 
+# Frames per flicker cycle of each frequency at the measured refresh rate (warns if one can't be shown accurately)
+used_freqs = sorted({freq for condition in conditions for freq in condition["flicker"].values()})
+flicker_periods = {freq: frames for freq, (frames, _) in zip(used_freqs, delivered_frequencies(used_freqs, refresh_rate))}
+
 # Generate counterbalanced blocks
 all_blocks = []
 for block_num in range(num_blocks):
@@ -316,6 +350,7 @@ for block_num in range(num_blocks):
 ################################################
 visual.useFBO = True  # if available (try without for comparison)
 disable_gc = False  # disable python garbage collection (try without for comparison)
+freeze_gc = True  # collect before each trial, then freeze the collector until it ends (no GC pauses during a trial)
 process_priority = 'realtime'  # 'high' or 'realtime'
 
 if process_priority == 'normal':
@@ -331,6 +366,9 @@ else:
 
 if disable_gc:
     gc.disable()
+
+# Garbage is collected between trials only
+block_gc = BlockGC(enabled=freeze_gc)
     
 #######################
 # Set up the window
@@ -351,6 +389,14 @@ win = visual.Window(monitor = mon,
                     allowStencil = True
                     )
 
+# A stored profile is checked against the rate the monitor runs at now (60 flips). A display switched to another
+# rate since would get the wrong frame counts, so the profile is deleted and the next launch measures it again.
+if not profile_measured and not profile_matches(win, monitor_profile):
+    os.remove(calibration_file)
+    win.close()
+    raise RuntimeError(f"{monitor_name} no longer runs at the rate of its profile, which was deleted. "
+                       "Start the experiment again to measure the monitor.")
+
 #######################
 # Create the stimuli
 #######################
@@ -384,13 +430,30 @@ right_box = visual.Rect(
     lineWidth=1.0, colorSpace='rgb',  lineColor='white', fillColor='white',
     opacity=1.0, depth=1.0, interpolate=True)
 
-# Define character stimuli with calculated size
+# Frames of the flicker period and the letter shown on each of them (a new letter every `frames_per_letter` frames)
+n_flicker_frames = round(refresh_rate * trial_duration) # Produces exactly 600 cycles (60 Hz/fps x 10 seconds)
+frame_count = np.arange(1, n_flicker_frames + 1)
+letter_index = frame_count // frames_per_letter
+
+# Define character stimuli with calculated size: the 12 images are read once and each field gets a stimulus per character
 characters = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', '5']
 image_paths = {char: f'images/stimuli/{char}.png' for char in characters}
-left_character_sequence = create_randomized_stim_sequence(win, image_paths, characters, position=(-fixation_distance, 0))
-right_character_sequence = create_randomized_stim_sequence(win, image_paths, characters, position=(fixation_distance, 0))
+character_stream = CharacterStream(win, image_paths, positions=[(-fixation_distance, 0), (fixation_distance, 0)],
+                                   letter_index=letter_index, units='deg', mask=None, anchor='center',
+                                   ori=0.0, size=letter_size,
+                                   color=[1,1,1], colorSpace='rgb', opacity=None,
+                                   flipHoriz=False, flipVert=False,
+                                   texRes=128.0, interpolate=True, depth=-2.0)
+
+# A new letter sequence for every trial and field (left, right), with no letter twice in a row
+letter_sequences = no_repeat_sequences(np.random.default_rng(), len(characters),
+                                       (len(all_blocks), max(map(len, all_blocks)), 2, character_stream.n_letters))
 
-flicker_boxes = [left_box, right_box]
+# Record every flip so each trial can be checked for dropped frames and the delivered flicker frequencies
+trial_frames = n_flicker_frames + sum(duration_frames(duration, refresh_rate) for duration in
+                                      (ready_duration, fixation_cross_duration, arrow_duration, pre_flicker_duration,
+                                       inter_trial_duration))
+flip_timer = FlipTimer(win, refresh_rate, thisExp.dataFileName, capacity=trial_frames + int(refresh_rate))
 
 
 ###############################
@@ -407,9 +470,6 @@ print(f"Starting Experiment\n")
 
 win.mouseVisible = False
 
-# start the clock
-routine_timer = core.Clock() 
-
 for block_num, block in enumerate(all_blocks):
     
     clear_window()
@@ -422,17 +482,13 @@ for block_num, block in enumerate(all_blocks):
     
     print(f"*-- Starting Block {block_num + 1} --*")
     
-    d.getFeedback(u3.DAC0_8(BLOCK_START_VAL))
+    triggers.send(BLOCK_START_VAL)
     
     for trial_num, trial in enumerate(block):
         
-        # Add break/exit option for participant control
+        # Add break/exit option for participant control (through endExperiment, so the queued triggers and rows are written)
         if 'escape' in event.getKeys():
-            win.close()
-            core.quit()
-        
-        # Clear the screen
-        clear_window()
+            endExperiment(thisExp, win=win)
         
         # Get attention direction and flicker configuration for this trial
         attention = trial["attention"] # Left or right
@@ -441,7 +497,7 @@ for block_num, block in enumerate(all_blocks):
         trial_voltage = trial["voltage"] # Retrieves the voltage for the current condition
         
         flicker_freqs = [flicker_left, flicker_right]
-        flicker_frames_per_cycle = [int(refresh_rate / freq) for freq in flicker_freqs]
+        flicker_frames_per_cycle = [flicker_periods[freq] for freq in flicker_freqs]
 
         # Set arrow direction based on trial
         arrow_image = left_arrow if attention == "left" else right_arrow
@@ -449,99 +505,52 @@ for block_num, block in enumerate(all_blocks):
         # Set up the visual elements accordingly
         print(f"\nTrial {trial_num + 1}: Attention {attention}; Left: {flicker_left}Hz, Right: {flicker_right}Hz")
         
-        if trial != 0:
-            core.wait(2.0) # Wait for 2 seconds between trials
-                
-        clear_window()
+        # Work out every frame of the trial beforehand, so the frame loop only draws and flips.
+        # During the flicker a box is on for the first half of each of its cycles.
+        left_on, right_on = [((frame_count % flicker_period) < (flicker_period / 2)).tolist()
+                             for flicker_period in flicker_frames_per_cycle]
+        flicker_draw = [(left_box,) * left + (right_box,) * right + (fixation_cross,)
+                        for left, right in zip(left_on, right_on)]
+        letter_sequence = letter_sequences[block_num, trial_num]
+        character_stream.start_trial(letter_sequence)
         
-        # Showing 'ready' and fixation cross for 2 seconds       
-        t = routine_timer.getTime()
-        while routine_timer.getTime() - t <= 2:
-            fixation_cross.setAutoDraw(True)
-            ready.setAutoDraw(True)
-            win.flip()
-            
-            d.getFeedback(u3.DAC0_8(trial_voltage))
-
-        # Showing just the fixation cross for 3 seconds
-        t = routine_timer.getTime()
-        while routine_timer.getTime() - t <= fixation_cross_duration:
-            ready.setAutoDraw(False)
-            win.flip()
-            
-            d.getFeedback(u3.DAC0_8(FIXATION_ON_VAL))
+        timeline = TrialTimeline([
+            Phase('ready', duration_frames(ready_duration, refresh_rate), (fixation_cross, ready), trial_voltage),
+            Phase('fixation', duration_frames(fixation_cross_duration, refresh_rate), (fixation_cross,), FIXATION_ON_VAL),
+            Phase('arrow', duration_frames(arrow_duration, refresh_rate), (arrow_image,), ARROW_ONSET_VAL),
+            Phase('fixation_2', duration_frames(pre_flicker_duration, refresh_rate), (fixation_cross,), FIXATION_2_ON_VAL),
+            Phase('flicker', n_flicker_frames, flicker_draw, FLICKER_ON_VAL, character_stream.draw),
+            Phase('fixation_end', duration_frames(inter_trial_duration, refresh_rate), (fixation_cross,), OFF_VAL),
+        ], refresh_rate)
         
-        # Clear window
-        clear_window()
+        # Collect garbage now and keep the collector frozen until the trial has been played
+        block_gc.begin_block()
+        flip_timer.begin_block()
         
-        # Show the arrow for 1.5 seconds
-        t = routine_timer.getTime()
-        while routine_timer.getTime() - t <= arrow_duration:
-
-            arrow_image.setAutoDraw(True)
-            win.flip()
-            
-            d.getFeedback(u3.DAC0_8(ARROW_ONSET_VAL)) # Marker for arrow onset
-
-        # Clear window
-        clear_window()
+        phase_log = timeline.play(win, triggers)
         
-        # Set the fixation cross to be drawn for the duration of the trial
-        fixation_cross.setAutoDraw(True)
+        flip_timer.end_block(f'block_{block_num}_trial_{trial_num}', on=timeline.shown([left_box, right_box]),
+                             periods=flicker_frames_per_cycle, target_freqs=flicker_freqs)
+        block_gc.end_block()
         
-        d.getFeedback(u3.DAC0_8(FIXATION_2_ON_VAL)) # Marker for fixation 2 onset
-        
-        core.wait(0.500) # Wait for 500 ms
-
-        frame_count = 0
-        letter_frame_count = 0
-        letter_index = 0  # Track the current letter index
-
-        d.getFeedback(u3.DAC0_8(FLICKER_ON_VAL)) # Marker for flicker on
-        
-        # This loop needs to execute each frame for the duration of the flicker cycle
-        for frame in range(int(refresh_rate * trial_duration)): # Produces exactly 600 cycles (60 Hz/fps x 10 seconds)
-            # Increment frame count
-            letter_frame_count += 1
-            frame_count += 1
-            
-            # Determine if the current letter has been shown for 12 frames
-            if letter_frame_count >= frames_per_letter:
-                # Reset the frame count and increment the letter index to show the next letter
-                letter_frame_count = 0
-                letter_index += 1
-            
-            # Loop through the flickering stimuli 
-            for box, flicker_period in zip(flicker_boxes, flicker_frames_per_cycle):
-                # Determine whether to show or hide the stimulus based on frame count
-                if (frame_count % flicker_period) < (flicker_period / 2):
-                    box.draw()
-                else:
-                    pass
-                    
-            # Get the current letters to draw based on the letter index
-            left_letter = left_character_sequence[letter_index]
-            right_letter = right_character_sequence[letter_index]
-            
-            # Draw the current letters
-            left_letter.draw()
-            right_letter.draw()
-
-            # if right_letter.name or left_letter.name == '5' and frame_count % 12 == 0:
-            #     print("5 Detected")
-            
-            # Flip the window to update the display
-            win.flip()
-            
-            
-            # core.wait(1)
-            # # Add break/exit option for participant control
-            # if 'escape' in event.getKeys():
-            #     win.close()
-            #     core.quit()
+        # One row per trial
+        thisExp.addData('block', block_num)
+        thisExp.addData('trial', trial_num)
+        thisExp.addData('attention', attention)
+        thisExp.addData('flicker_left', flicker_left)
+        thisExp.addData('flicker_right', flicker_right)
+        thisExp.addData('trigger', trial_voltage)
+        for phase in phase_log: # Flip time of each phase onset (core.getTime, as the triggers) and its measured length
+            thisExp.addData(f"{phase['phase']}_onset", phase['onset'])
+            thisExp.addData(f"{phase['phase']}_duration", phase['duration'])
+        thisExp.addData('flicker_offset', phase_log[-1]['onset'])
+        thisExp.addData('letters_left', character_stream.letters(letter_sequence[0]))
+        thisExp.addData('letters_right', character_stream.letters(letter_sequence[1]))
+        thisExp.nextEntry()
+        data_writer.add_row(thisExp.entries[-1])
     
-            
-        d.getFeedback(u3.DAC0_8(OFF_VAL))
+    # Written by the writer thread during the break
+    data_writer.flush()
         
         
 print("\nExperiment complete. Exiting...")
@@ -0,0 +1,113 @@
+"""
+Letter streams shown on the flickering boxes.
+
+Each character image is read from disk once, and every field gets one `ImageStim` per character,
+built (and its texture uploaded) before the first trial. A letter change only selects a different
+stimulus by index, so no texture is created or uploaded while the letters are on screen.
+
+The letter sequences of the whole session are drawn ahead of time as index arrays into the pool,
+a fresh one per trial and field, with no letter repeated back-to-back.
+"""
+import numpy as np
+from PIL import Image
+
+
+def no_repeat_sequences(rng, n_characters, shape):
+    """
+    Random indices in `range(n_characters)` with no two neighbours the same along the last axis.
+
+    The first index is uniform and every later one adds a uniform step of 1 to `n_characters - 1`
+    (mod `n_characters`), so each letter is uniform over the ones that differ from its predecessor.
+
+    Parameters
+    ==========
+    rng : np.random.Generator
+        Random number generator.
+    n_characters : int
+        Number of characters in the pool.
+    shape : tuple of int
+        Shape of the result, e.g. (n_blocks, n_trials, n_fields, n_letters).
+
+    Returns
+    ==========
+    np.ndarray of int8
+    """
+    steps = rng.integers(1, n_characters, size=shape)
+    steps[..., 0] = rng.integers(n_characters, size=shape[:-1])
+    return (np.cumsum(steps, axis=-1) % n_characters).astype(np.int8)
+
+
+def load_textures(image_paths, size=256):
+    """
+    Read the character images once.
+
+    They are resized to `size` x `size` (a power of two, as PsychoPy would otherwise do on every
+    texture upload).
+
+    Returns
+    ==========
+    list of PIL.Image.Image
+        In the order of `image_paths`.
+    """
+    textures = []
+    for path in image_paths.values():
+        with Image.open(path) as image:
+            textures.append(image.convert('RGBA').resize((size, size), Image.BILINEAR))
+    return textures
+
+
+class CharacterStream:
+    """
+    One stimulus per character and field, selected by the pool index of the current letter.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window for this experiment.
+    image_paths : dict
+        Character -> image file, in pool order.
+    positions : list of tuple
+        Centre of each field (deg).
+    letter_index : np.ndarray of int
+        Letter shown on each flicker frame (0, 0, ..., 1, 1, ...).
+    **stim_kwargs
+        Passed on to `visual.ImageStim` (size, texRes, ...).
+    """
+    def __init__(self, win, image_paths, positions, letter_index, **stim_kwargs):
+        from psychopy import visual
+
+        self.characters = list(image_paths)
+        self.textures = load_textures(image_paths)
+        # stims[field][character]: every texture is uploaded here, once
+        self.stims = [[visual.ImageStim(win, image=texture, pos=pos, name=char, **stim_kwargs)
+                       for char, texture in zip(self.characters, self.textures)] for pos in positions]
+        letter_index = np.asarray(letter_index)
+        self.n_letters = int(letter_index.max()) + 1
+        # Letter of each flicker frame as a list, for the per-frame lookup in `draw`
+        self._letter = letter_index.tolist()
+        self._shown = []
+        self.sequence = None
+
+    def start_trial(self, sequence):
+        """
+        Show `sequence`, shape (n_fields, n_letters) of pool indices, from the next frame 0.
+        Looks up the stimuli of every letter of the trial.
+        """
+        self.sequence = np.asarray(sequence)
+        if self.sequence.shape[-1] < self.n_letters:
+            raise ValueError(f'{self.sequence.shape[-1]} letters given, the flicker shows {self.n_letters}')
+        self._shown = [tuple(stims[index] for stims, index in zip(self.stims, letters))
+                       for letters in self.sequence[:, :self.n_letters].T.tolist()]
+
+    def draw(self, frame):
+        """Draw the letters of flicker frame `frame`."""
+        for stim in self._shown[self._letter[frame]]:
+            stim.draw()
+
+    def letters(self, sequence):
+        """Characters of one field's sequence as a string, for the data file."""
+        return ''.join(self.characters[index] for index in np.asarray(sequence)[:self.n_letters].tolist())
+
+    def report(self):
+        return (f'Character stream: {len(self.textures)} textures read once, '
+                f'{sum(map(len, self.stims))} stimuli built before the first trial')
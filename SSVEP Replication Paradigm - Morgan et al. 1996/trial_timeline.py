@@ -0,0 +1,116 @@
+"""
+Frame-counted trial timelines.
+
+A trial is declared as a list of `Phase`s (ready, fixation, cue, flicker, ...), each a whole number
+of frames long. `TrialTimeline` compiles them into one draw list per frame, the per-frame draw
+calls and the trigger of each phase onset, then plays them back with exactly one `win.flip()` per
+frame: no wall-clock polling, no `setAutoDraw` bookkeeping and no extra flips between phases.
+Phase lengths are therefore exact in frames, and `play` logs the flip time of every phase onset
+so the delivered durations can be checked against the planned ones.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+# One phase of a trial:
+#   name: name of the phase in the onset log (and the data columns)
+#   n_frames: length of the phase in frames
+#   draw: stimuli drawn on every frame of the phase, or a list of one tuple of stimuli per frame
+#   trigger: trigger written with the first frame of the phase (None for no trigger)
+#   draw_frame: called as draw_frame(frame within the phase) after the draw list, for stimuli that
+#       do more than draw (e.g. `CharacterStream.draw`)
+Phase = namedtuple('Phase', ['name', 'n_frames', 'draw', 'trigger', 'draw_frame'], defaults=((), None, None))
+
+
+def duration_frames(duration, refresh_rate):
+    """Frames closest to `duration` seconds."""
+    return int(round(duration * refresh_rate))
+
+
+class TrialTimeline:
+    """
+    A trial compiled frame by frame.
+
+    Parameters
+    ==========
+    phases : list of Phase
+        Phases in order. Phases with no frames are left out.
+    refresh_rate : float
+        Refresh rate of the monitor (Hz), for the planned durations in the log.
+    """
+    def __init__(self, phases, refresh_rate):
+        self.phases = [phase for phase in phases if phase.n_frames > 0]
+        self.refresh_rate = refresh_rate
+        self.onsets = []  # first frame of each phase
+        self.draw_lists = []
+        self.draw_calls = []
+        for phase in self.phases:
+            self.onsets.append(len(self.draw_lists))
+            if isinstance(phase.draw, list):
+                if len(phase.draw) != phase.n_frames:
+                    raise ValueError(f'Phase {phase.name}: {len(phase.draw)} draw lists for {phase.n_frames} frames')
+                self.draw_lists.extend(tuple(stims) for stims in phase.draw)
+            else:
+                self.draw_lists.extend([tuple(phase.draw)] * phase.n_frames)
+            if phase.draw_frame is None:
+                self.draw_calls.extend([None] * phase.n_frames)
+            else:
+                self.draw_calls.extend((phase.draw_frame, frame) for frame in range(phase.n_frames))
+        self.n_frames = len(self.draw_lists)
+        self.log = []
+
+    def shown(self, stims):
+        """
+        Whether each of `stims` is drawn on each frame, shape (n_frames, len(stims)),
+        e.g. the on/off table of the flickering boxes for `FlipTimer.end_block`.
+        """
+        return np.array([[stim in drawn for stim in stims] for drawn in self.draw_lists], dtype=bool).reshape(
+            self.n_frames, len(stims))
+
+    def play(self, win, triggers=None):
+        """
+        Draw and flip every frame, writing each phase's trigger with its first frame.
+
+        Parameters
+        ==========
+        win : psychopy.visual.Window
+            Window for this experiment.
+        triggers : TriggerScheduler or None
+            Where the phase triggers are written.
+
+        Returns
+        ==========
+        list of dict
+            Per phase: name, first frame, frames, flip time of the onset, planned duration and
+            measured duration (to the next onset; NaN for the last phase, which lasts until
+            the next flip after the timeline).
+        """
+        onset_times = np.full(len(self.phases), np.nan)
+        triggers_at = {onset: phase.trigger for onset, phase in zip(self.onsets, self.phases)
+                       if phase.trigger is not None and triggers is not None}
+        onset_index = {onset: n for n, onset in enumerate(self.onsets)}
+        draw_lists, draw_calls = self.draw_lists, self.draw_calls
+
+        for frame in range(self.n_frames):
+            for stim in draw_lists[frame]:
+                stim.draw()
+            call = draw_calls[frame]
+            if call is not None:
+                call[0](call[1])
+            if frame in triggers_at:
+                triggers.on_flip(win, triggers_at[frame])
+            t = win.flip()
+            if frame in onset_index:
+                onset_times[onset_index[frame]] = t
+
+        durations = np.append(np.diff(onset_times), np.nan)
+        self.log = [{'phase': phase.name, 'onset_frame': onset, 'n_frames': phase.n_frames,
+                     'onset': float(onset_time), 'planned_duration': phase.n_frames / self.refresh_rate,
+                     'duration': float(duration)}
+                    for phase, onset, onset_time, duration in zip(self.phases, self.onsets, onset_times, durations)]
+        return self.log
+
+    def report(self):
+        """One line per phase of the last `play`: planned and measured duration."""
+        return '\n'.join(f"  {entry['phase']}: {entry['n_frames']} frames, planned {entry['planned_duration'] * 1000:.1f} ms, "
+                         f"measured {entry['duration'] * 1000:.1f} ms" for entry in self.log)
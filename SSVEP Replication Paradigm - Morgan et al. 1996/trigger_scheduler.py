@@ -0,0 +1,108 @@
+"""
+LabJack trigger writes, off the frame loop.
+
+The DAC holds its voltage until the next write, so a trigger only has to be written when the
+value changes. `TriggerScheduler` drops requests for the value that is already set, and hands the
+others to an I/O thread through a queue, so the USB transfer (`getFeedback`, about a millisecond
+or more) never runs between two flips. `on_flip` registers the write with `win.callOnFlip`, so
+it is queued the moment the frame it belongs to is shown and timestamped with that flip. Every
+write is logged with its timestamp, and how long it waited in the queue and how long the USB
+transfer took are summarised in the report. `MockLabJack` (or any object with `getFeedback`) can
+stand in for the device.
+"""
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class TriggerScheduler:
+    """
+    Edge-triggered DAC writes from a background thread.
+
+    Parameters
+    ==========
+    device : u3.U3 or MockLabJack
+        Device the values are written to.
+    command : callable
+        Makes the feedback command of a value, e.g. `u3.DAC0_8`.
+    clock : callable
+        Time of the triggers in the data log, e.g. `core.getTime`.
+    log : callable or None
+        Called by the I/O thread as `log(timestamp, 'labjack', value)` after each write,
+        e.g. `data_writer.add_marker`.
+    capacity : int
+        Number of writes whose latencies are kept for the report.
+    """
+    def __init__(self, device, command, clock=time.perf_counter, log=None, capacity=100000):
+        self.device = device
+        self.command = command
+        self.clock = clock
+        self.log = log
+        self.value = None  # last value requested
+        self.n_requests = 0
+        self.n_writes = 0
+        self.n_errors = 0
+        self._queue_delays = np.empty(capacity)
+        self._write_times = np.empty(capacity)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='TriggerScheduler', daemon=True)
+        self._thread.start()
+
+    def _changed(self, value):
+        self.n_requests += 1
+        if value == self.value:
+            return False
+        self.value = value
+        return True
+
+    def send(self, value):
+        """Write `value` now (if it isn't already set), timestamped with the current time."""
+        if self._changed(value):
+            self._queue.put((value, self.clock(), time.perf_counter()))
+
+    def on_flip(self, win, value):
+        """Write `value` (if it isn't already set) when the next `win.flip()` shows the frame, timestamped with that flip."""
+        if self._changed(value):
+            win.callOnFlip(self._flipped, value)
+
+    def _flipped(self, value):
+        self._queue.put((value, self.clock(), time.perf_counter()))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            value, timestamp, queued = item
+            start = time.perf_counter()
+            try:
+                self.device.getFeedback(self.command(value))
+            except Exception as error:  # a failed write shouldn't stop the experiment
+                self.n_errors += 1
+                print(f'Trigger {value} not written: {error}')
+                continue
+            end = time.perf_counter()
+            if self.n_writes < self._write_times.shape[0]:
+                self._queue_delays[self.n_writes] = start - queued
+                self._write_times[self.n_writes] = end - start
+            self.n_writes += 1
+            if self.log is not None:
+                self.log(timestamp, 'labjack', value)
+
+    def close(self, timeout=5.0):
+        """Write whatever is still queued and stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def report(self):
+        n = min(self.n_writes, self._write_times.shape[0])
+        if not n:
+            return f'Triggers: none written ({self.n_requests} requests)'
+        queue_delays, write_times = self._queue_delays[:n] * 1000, self._write_times[:n] * 1000
+        return (f'Triggers: {self.n_writes} writes for {self.n_requests} requests ({self.n_errors} failed); '
+                f'queue delay median {np.median(queue_delays):.2f} ms (max {queue_delays.max():.2f} ms), '
+                f'USB write median {np.median(write_times):.2f} ms, p95 {np.percentile(write_times, 95):.2f} ms, '
+                f'max {write_times.max():.2f} ms')
@@ -0,0 +1,75 @@
+"""
+Garbage collection between blocks only.
+
+A collection of the older generations can take several milliseconds, longer than a frame at
+240 Hz. `BlockGC` collects right before a block starts, then freezes everything that is alive
+(`gc.freeze`, so the objects set up before the block are never scanned again) and switches the
+collector off until the block has ended. Garbage made during a block waits for the collection
+before the next one. A `gc.callbacks` hook counts any collection that still happens inside a
+block (an explicit `gc.collect()` somewhere), so the report shows that none did.
+"""
+import gc
+import time
+
+import numpy as np
+
+
+class BlockGC:
+    """
+    Keep the garbage collector out of the blocks.
+
+    Parameters
+    ==========
+    enabled : bool
+        If False, `begin_block`/`end_block` do nothing (the collector runs as usual).
+    capacity : int
+        Number of blocks whose collection times are kept for the report.
+    """
+    def __init__(self, enabled=True, capacity=10000):
+        self.enabled = enabled
+        self.n_blocks = 0
+        self.n_in_block = 0
+        self._collect_times = np.empty(capacity)
+        self._in_block = False
+        self._was_enabled = True
+        gc.callbacks.append(self._on_collection)
+
+    def _on_collection(self, phase, info):
+        if phase == 'start' and self._in_block:
+            self.n_in_block += 1
+
+    def begin_block(self):
+        """Collect, freeze the survivors and switch the collector off for the block."""
+        if not self.enabled:
+            return
+        t = time.perf_counter()
+        gc.collect()
+        gc.freeze()
+        if self.n_blocks < self._collect_times.shape[0]:
+            self._collect_times[self.n_blocks] = time.perf_counter() - t
+        self.n_blocks += 1
+        self._was_enabled = gc.isenabled()
+        gc.disable()
+        self._in_block = True
+
+    def end_block(self):
+        """Let the collector run again (unless it was off before the block, e.g. `disable_gc`)."""
+        if not self._in_block:
+            return
+        self._in_block = False
+        gc.unfreeze()
+        if self._was_enabled:
+            gc.enable()
+
+    def close(self):
+        self.end_block()
+        if self._on_collection in gc.callbacks:
+            gc.callbacks.remove(self._on_collection)
+
+    def report(self):
+        if not self.n_blocks:
+            return 'GC: not frozen during blocks'
+        collect_ms = self._collect_times[:min(self.n_blocks, self._collect_times.shape[0])] * 1000
+        return (f"GC: frozen during {self.n_blocks} blocks, collection before a block median "
+                f"{np.median(collect_ms):.1f} ms (max {collect_ms.max():.1f} ms), "
+                f"{self.n_in_block} collections inside blocks")
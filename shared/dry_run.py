@@ -0,0 +1,838 @@
+"""
+Fast-forward dry run of a paradigm script on a virtual clock.
+
+The script is run unchanged, but `psychopy`, `pylsl` and `u3` (LabJack) are replaced by stand-ins
+that share one virtual clock: `win.flip()` jumps to the next refresh, `core.wait` advances the clock
+instead of sleeping, and every PsychoPy and LSL clock reads it. Nothing waits for real time, so a
+whole multi-block session finishes in seconds. The dialog is answered from the command line
+(the first option of every field otherwise), `space` is always pressed, and the flash count form
+is answered and clicked through.
+
+Everything the session would send is written next to the behavioural data:
+- `<participant>_dryrun_markers.tsv`: every LSL marker, LabJack write and LabRecorder command with
+  its virtual timestamp.
+- `<participant>_dryrun_frames.tsv`: every flip with its virtual time and the stimuli drawn on it
+  (left empty when they are the same as on the previous flip, `-` when nothing was drawn).
+
+The flip timing reports, plans and data files are written as in a real session, with virtual
+times, but below a temporary data root (`--out` to choose it) instead of the script's `data/`,
+so plans compiled for one monitor never get in the way of a dry run on another. The monitor is calibrated on the virtual clock (so `--refresh-rate 239.96` shows what a
+monitor slightly off its nominal rate does), and the profile goes to a temporary folder instead of
+`calibration/`. The exit code is 0 if the session ran to the end.
+
+Usage, from the folder of a paradigm (its script is found there):
+    python ../shared/dry_run.py
+    python ../shared/dry_run.py --answer condition=Session monitor_name=Alienware
+    python ../shared/dry_run.py --escape-at 45   # press escape 45 s (virtual) into the session
+    python ../shared/dry_run.py "../SSVEP Replication Paradigm - Morgan et al. 1996/OPM_SSVEP.py"
+"""
+import argparse
+import ast
+import csv
+import datetime
+import math
+import os
+import os.path as op
+import pickle
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import types
+from concurrent.futures import Future
+
+import numpy as np
+
+SCRIPTS = ('BCI_Paradigm_24-25.py', 'OPM_SSVEP.py')
+
+# The run being played, set by `DryRun.install`
+SESSION = None
+
+
+def read_screens(script):
+    """The `screens` dict (monitor profiles) of a paradigm script, without running it."""
+    with open(script, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=script)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == 'screens' for t in node.targets):
+            return ast.literal_eval(node.value)
+    return {}
+
+
+class VirtualClock:
+    """
+    Clock that only moves when told to.
+
+    Parameters
+    ==========
+    refresh_rate : float
+        Refresh rate of the virtual monitor in Hz (flips land on multiples of its frame duration).
+    """
+    def __init__(self, refresh_rate=60.0):
+        self.now = 0.0
+        self.set_refresh_rate(refresh_rate)
+
+    def set_refresh_rate(self, refresh_rate):
+        self.refresh_rate = float(refresh_rate)
+        self.frame_dur = 1.0 / self.refresh_rate
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+        return self.now
+
+    def next_flip(self):
+        """Jump to the next refresh."""
+        self.now = (math.floor(self.now / self.frame_dur + 1e-6) + 1) * self.frame_dur
+        return self.now
+
+
+############################################
+# psychopy stand-ins
+############################################
+NOT_STARTED, STARTED, PLAYING, PAUSED = 0, 1, 1, 2
+STOPPED = FINISHED = -1
+PRESSED, RELEASED = 1, -1
+FOREVER = 1000000
+
+
+class priority:
+    CRITICAL, HIGH, MEDIUM, LOW, EXCLUDE = 30, 20, 10, 0, -10
+
+
+class Clock:
+    """`core.Clock` on the virtual clock."""
+    def __init__(self):
+        self._start = SESSION.clock.now
+
+    def getTime(self, applyZero=True):
+        return SESSION.clock.now - self._start
+
+    def reset(self, newT=0.0):
+        self._start = SESSION.clock.now + newT
+
+    def addTime(self, t):
+        self._start -= t
+
+
+def wait(secs, hogCPUperiod=0.2):
+    SESSION.clock.advance(secs)
+    SESSION.tick()
+
+
+def quit():
+    raise SystemExit(0)
+
+
+def _get_time():
+    return SESSION.clock.now
+
+
+class Monitor:
+    def __init__(self, name, width=None, distance=None, **kwargs):
+        self.name = name
+
+
+class Window:
+    """
+    Window that draws nothing. `flip()` moves the virtual clock to the next refresh, runs the
+    `callOnFlip` callbacks and logs the stimuli drawn since the last flip.
+    """
+    def __init__(self, size=(800, 600), monitor=None, units='norm', color=(0, 0, 0), **kwargs):
+        self.size = np.array(size)
+        self.units = units
+        self.color = color
+        self.monitor = monitor
+        self.mouseVisible = True
+        self._toDraw = []
+        self._toCall = []
+        self._drawn = []
+        name = getattr(monitor, 'name', monitor)
+        SESSION.set_monitor(name)
+        SESSION.windows.append(self)
+
+    def flip(self, clearBuffer=True):
+        for stim in self._toDraw:
+            stim.draw()
+        t = SESSION.clock.next_flip()
+        for function, args, kwargs in self._toCall:
+            function(*args, **kwargs)
+        if self._toCall:
+            time.sleep(0)  # let the threads the callbacks fed (trigger I/O) run at this virtual time
+        self._toCall = []
+        SESSION.tick()
+        SESSION.frames.append((t, tuple(self._drawn)))
+        self._drawn = []
+        return t
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._toCall.append((function, args, kwargs))
+
+    def timeOnFlip(self, obj, attrib):
+        self.callOnFlip(lambda: setattr(obj, attrib, SESSION.clock.now))
+
+    def getFutureFlipTime(self, targetTime=0, clock=None):
+        if clock == 'now':
+            return SESSION.clock.frame_dur
+        t = SESSION.clock.now + SESSION.clock.frame_dur
+        return t - clock._start if isinstance(clock, Clock) else t
+
+    def getActualFrameRate(self, **kwargs):
+        return SESSION.clock.refresh_rate
+
+    def clearBuffer(self, color=True, depth=False, stencil=False):
+        self._drawn = []
+
+    def clearAutoDraw(self):
+        for stim in list(self._toDraw):
+            stim.setAutoDraw(False)
+
+    def close(self):
+        pass
+
+
+class _Stim:
+    """Base of the stimulus stand-ins: keeps its arguments and logs its draws on the window."""
+    def __init__(self, win, name=None, pos=(0, 0), size=None, autoLog=True, **kwargs):
+        self.win = win
+        self.pos = np.array(pos, dtype=float)
+        self.size = None if size is None else np.array([size, size] if np.isscalar(size) else size, dtype=float)
+        self.autoDraw = False
+        self.status = NOT_STARTED
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        SESSION.n_stims += 1
+        self.name = name or self._default_name()
+
+    def _default_name(self):
+        return f'{type(self).__name__}{SESSION.n_stims}@{self.pos[0]:g},{self.pos[1]:g}'
+
+    @property
+    def verticesPix(self):
+        half = (self.size if self.size is not None else np.ones(2)) / 2
+        return self.pos + np.array([[-1, -1], [-1, 1], [1, 1], [1, -1]]) * half
+
+    def draw(self, win=None):
+        self.win._drawn.append(self.name)
+        self._shown = True
+
+    def setAutoDraw(self, value, log=None):
+        if value and not self.autoDraw:
+            self.win._toDraw.append(self)
+        elif not value and self.autoDraw:
+            self.win._toDraw.remove(self)
+        self.autoDraw = value
+
+    def contains(self, x, y=None, units=None):
+        return self.autoDraw or self.__dict__.get('_shown', False)
+
+    def __getattr__(self, name):
+        # setImage(...), setOpacity(...), ... -> plain attribute assignment
+        if name.startswith('set') and len(name) > 3:
+            attr = name[3].lower() + name[4:]
+            return lambda value, *args, **kwargs: setattr(self, attr, value)
+        raise AttributeError(name)
+
+
+class ImageStim(_Stim):
+    def __init__(self, win, image=None, **kwargs):
+        # PsychoPy fails the same way when an image file is missing
+        if isinstance(image, str) and not op.exists(image):
+            raise OSError(f"Couldn't find image {image}; check path?")
+        self.image = image
+        super().__init__(win, **kwargs)
+
+    def _default_name(self):
+        if isinstance(self.image, str):
+            return op.splitext(op.basename(self.image))[0]
+        return super()._default_name()
+
+
+class TextStim(_Stim):
+    def __init__(self, win, text='', **kwargs):
+        self.text = text
+        super().__init__(win, **kwargs)
+
+    def _default_name(self):
+        return f'text:{self.text[:24]!r}'
+
+
+class ShapeStim(_Stim):
+    pass
+
+
+class Rect(_Stim):
+    pass
+
+
+class ElementArrayStim(_Stim):
+    pass
+
+
+class BufferImageStim(_Stim):
+    """Draws `stim` once when created (the capture); drawing it later logs the buffer only."""
+    def __init__(self, win, stim=(), **kwargs):
+        for s in stim:
+            s.draw()
+        win._drawn = []
+        super().__init__(win, name=f"buffer:{'+'.join(s.name for s in stim)}", **kwargs)
+
+
+class Form(_Stim):
+    """Form that counts as answered (with the first option of each item) once it's drawn."""
+    def __init__(self, win, items=(), **kwargs):
+        self.items = list(items)
+        super().__init__(win, **kwargs)
+
+    @property
+    def complete(self):
+        return self.status == STARTED or self.__dict__.get('_shown', False)
+
+    def reset(self):
+        self.status = NOT_STARTED
+        self._shown = False
+
+    def getData(self):
+        data = []
+        for item in self.items:
+            options = item.get('options', '')
+            options = options.split(',') if isinstance(options, str) else list(options)
+            data.append({'itemText': item.get('itemText'), 'response': options[0].strip() if options else None})
+        return data
+
+    def addDataToExp(self, exp, itemsAs='rows'):
+        for n, item in enumerate(self.items):
+            options = item.get('options', '')
+            options = options.split(',') if isinstance(options, str) else list(options)
+            exp.addData(f'{self.name}.{n}.response', options[0].strip() if options else None)
+
+
+def getKeys(keyList=None, modifiers=False, timeStamped=False):
+    """`space` is always pressed; `escape` once the virtual clock reaches `--escape-at`."""
+    keys = []
+    if keyList is not None and 'space' in keyList:
+        keys.append('space')
+    if SESSION.escape_at is not None and SESSION.clock.now >= SESSION.escape_at and (keyList is None or 'escape' in keyList):
+        keys.append('escape')
+    return [(key, SESSION.clock.now) for key in keys] if timeStamped else keys
+
+
+def clearEvents(eventType=None):
+    pass
+
+
+class KeyPress:
+    def __init__(self, name, tDown):
+        self.name = name
+        self.value = name
+        self.tDown = tDown
+        self.rt = tDown
+
+
+class Keyboard:
+    """`hardware.keyboard.Keyboard`: `escape` is pressed once, when the virtual clock reaches `--escape-at`."""
+    def __init__(self, *args, **kwargs):
+        self._escaped = False
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        if (self._escaped or SESSION.escape_at is None or SESSION.clock.now < SESSION.escape_at
+                or (keyList is not None and 'escape' not in keyList)):
+            return []
+        self._escaped = True
+        return [KeyPress('escape', SESSION.escape_at)]
+
+    def clearEvents(self, eventType=None):
+        pass
+
+
+class Mouse:
+    """Mouse that clicks every `click_interval` seconds (pressed for the first half)."""
+    click_interval = 0.2
+
+    def __init__(self, visible=True, newPos=None, win=None):
+        self.win = win
+        self.status = NOT_STARTED
+
+    def getPressed(self, getTime=False):
+        pressed = int(SESSION.clock.now / (self.click_interval / 2)) % 2 == 0
+        return [int(pressed), 0, 0]
+
+    def getPos(self):
+        return np.zeros(2)
+
+    def setVisible(self, visible):
+        pass
+
+
+class DlgFromDict:
+    """Fills the dialog fields from `--answer` (first option of a list otherwise) and presses OK."""
+    def __init__(self, dictionary, title='', sortKeys=False, **kwargs):
+        for key, value in list(dictionary.items()):
+            if key in SESSION.answers:
+                dictionary[key] = SESSION.answers[key]
+            elif isinstance(value, (list, tuple)):
+                dictionary[key] = value[0]
+        SESSION.exp_info = dictionary
+        self.OK = True
+
+
+def getDateStr(format='%Y-%m-%d_%Hh%M.%S.%f'):
+    return datetime.datetime.now().strftime(format)[:-3]
+
+
+class ExperimentHandler:
+    """Collects rows like PsychoPy's and writes them to `.csv` (and a pickle of the rows) when saved."""
+    def __init__(self, name='', version='', extraInfo=None, runtimeInfo=None, dataFileName='', **kwargs):
+        self.name = name
+        self.extraInfo = extraInfo if extraInfo is not None else {}
+        self.dataFileName = dataFileName
+        self.status = NOT_STARTED
+        self.entries = []
+        self.thisEntry = {}
+        self.saved = False
+        self.aborted = False
+        SESSION.handlers.append(self)
+
+    def setPriority(self, name, value=None):
+        pass
+
+    def addData(self, name, value, **kwargs):
+        self.thisEntry[name] = value
+
+    def timestampOnFlip(self, win, name, format=float):
+        win.callOnFlip(lambda: self.addData(name, SESSION.clock.now))
+
+    def nextEntry(self):
+        self.entries.append(dict(self.thisEntry))
+        self.thisEntry = {}
+
+    def saveAsWideText(self, fileName, delim='auto', **kwargs):
+        rows = self.entries + ([self.thisEntry] if self.thisEntry else [])
+        columns = list(dict.fromkeys(key for row in rows for key in row)) + list(self.extraInfo)
+        with open(fileName, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({**row, **self.extraInfo})
+        self.saved = True
+
+    def saveAsPickle(self, fileName, **kwargs):
+        with open(fileName + '.psydat', 'wb') as f:
+            pickle.dump({'extraInfo': dict(self.extraInfo), 'entries': self.entries}, f)
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        """What PsychoPy does on exit: save unless `abort()` was called or it was already saved."""
+        if not self.aborted and not self.saved and self.dataFileName:
+            self.saveAsWideText(self.dataFileName + '.csv')
+            self.saveAsPickle(self.dataFileName)
+
+
+class LogFile:
+    def __init__(self, f=None, level=None, filemode='a', **kwargs):
+        self.f = f
+        if f is not None:
+            open(f, filemode).close()
+
+
+class _LogTarget:
+    def setLevel(self, level):
+        pass
+
+    def removeTarget(self, target):
+        pass
+
+
+def _no_op(*args, **kwargs):
+    pass
+
+
+def setExecEnvironment(env):
+    return exec
+
+
+def getFromNames(names, namespace):
+    return list(names) if isinstance(names, (list, tuple)) else [names]
+
+
+############################################
+# pylsl and u3 stand-ins
+############################################
+class StreamInfo:
+    def __init__(self, name='untitled', type='', channel_count=1, nominal_srate=0.0, channel_format='float32', source_id=''):
+        self._name = name
+        self._type = type
+        self._channel_count = channel_count
+        self._nominal_srate = nominal_srate
+        self._channel_format = channel_format
+
+    def name(self):
+        return self._name
+
+    def type(self):
+        return self._type
+
+    def channel_count(self):
+        return self._channel_count
+
+    def nominal_srate(self):
+        return self._nominal_srate
+
+
+class StreamOutlet:
+    """Logs every sample with its (virtual) timestamp."""
+    def __init__(self, info, chunk_size=0, max_buffered=360):
+        self.info = info
+
+    def push_sample(self, sample, timestamp=0.0, pushthrough=True):
+        SESSION.log_marker(timestamp or SESSION.clock.now, 'lsl:' + self.info.name(), sample[0] if len(sample) == 1 else list(sample))
+
+    def have_consumers(self):
+        return True
+
+
+class DAC0_8:
+    def __init__(self, Value):
+        self.value = Value
+
+
+class U3:
+    """LabJack U3 that logs every DAC write."""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def getCalibrationData(self):
+        pass
+
+    def voltageToDACBits(self, volts, dacNumber=0, is16Bits=False):
+        return int(round(min(max(volts, 0.0), 5.0) / 5.0 * (65535 if is16Bits else 255)))
+
+    def getFeedback(self, *commands):
+        for command in commands:
+            SESSION.log_marker(SESSION.clock.now, 'labjack', getattr(command, 'value', command))
+
+    def close(self):
+        pass
+
+
+class LabRecorderStandIn:
+    """`labrecorder_client.LabRecorderClient` stand-in that logs the commands and answers at once."""
+    def __init__(self, host='localhost', port=22347, **kwargs):
+        self.n_reconnects = 0
+
+    def connect(self):
+        return self
+
+    def send(self, command):
+        SESSION.log_marker(SESSION.clock.now, 'labrecorder', command)
+        future = Future()
+        future.set_result('OK')
+        return future
+
+    def set_filename(self, **fields):
+        return self.send('filename ' + ' '.join(f'{{{key}:{value}}}' for key, value in fields.items())).result()
+
+    def select_all(self):
+        return self.send('select all')
+
+    def update(self):
+        return self.send('update')
+
+    def start(self, watch_dir=None, timeout=5.0, poll_interval=0.05):
+        self.send('start')
+        return None if watch_dir is None else op.join(watch_dir, 'dryrun.xdf')
+
+    def stop(self, watch_dir=None, settle_time=0.5, timeout=15.0):
+        self.send('stop')
+        return None
+
+    def close(self):
+        pass
+
+
+def make_input_monitor(base):
+    """`input_monitor.InputMonitor` polled on every virtual flip or wait instead of on a thread."""
+    class InputMonitorStandIn(base):
+        def __init__(self, *args, **kwargs):
+            kwargs['clock'] = _get_time
+            super().__init__(*args, **kwargs)
+
+        def start(self):
+            SESSION.tick_hooks.append(self.poll)
+            return self
+
+        def stop(self, timeout=1.0):
+            if self.poll in SESSION.tick_hooks:
+                SESSION.tick_hooks.remove(self.poll)
+
+    return InputMonitorStandIn
+
+
+class PopenStandIn:
+    """Logs the command instead of starting it (LabRecorder.exe)."""
+    def __init__(self, args, **kwargs):
+        self.args = args
+        self.returncode = None
+        SESSION.log_marker(SESSION.clock.now, 'process', ' '.join(args) if isinstance(args, (list, tuple)) else args)
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = 0
+
+    kill = terminate
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+############################################
+# Run
+############################################
+class DryRun:
+    """
+    One dry run of a paradigm script.
+
+    Parameters
+    ==========
+    script : str
+        Paradigm script to run.
+    answers : dict
+        Dialog fields to fill in, e.g. `{'condition': 'Session'}`.
+    refresh_rate : float or None
+        Refresh rate of the virtual monitor. None uses the `refresh_rate` of the chosen monitor in
+        the script's `screens`.
+    escape_at : float or None
+        Virtual time (s) at which escape is pressed.
+    data_root : str or None
+        Folder the script writes its data to (`PARADIGM_DATA_ROOT`). None makes a temporary one.
+    """
+    def __init__(self, script, answers=None, refresh_rate=None, escape_at=None, data_root=None):
+        self.script = op.abspath(script)
+        self.data_root = op.abspath(data_root) if data_root else tempfile.mkdtemp(prefix='dryrun_data_')
+        self.answers = dict(answers or {})
+        self.refresh_rate = refresh_rate
+        self.escape_at = escape_at
+        self.screens = read_screens(self.script)
+        self.clock = VirtualClock(refresh_rate or 60.0)
+        self.markers = []
+        self.frames = []
+        self.windows = []
+        self.handlers = []
+        self.exp_info = {}
+        self.n_stims = 0
+        self.tick_hooks = []
+        self._patched = []
+        self._calibration_dir = None
+
+    def set_monitor(self, name):
+        if self.refresh_rate is None:
+            self.clock.set_refresh_rate(self.screens.get(name, {}).get('refresh_rate') or 60.0)
+
+    def tick(self):
+        """Called whenever the virtual clock has moved."""
+        for hook in self.tick_hooks:
+            hook()
+
+    def log_marker(self, timestamp, source, value):
+        self.markers.append((timestamp, source, value))
+
+    def install(self):
+        """Put the stand-ins in `sys.modules` (and patch `subprocess.Popen` and LabRecorder)."""
+        global SESSION
+        SESSION = self
+
+        visual = _module('psychopy.visual', Window=Window, ImageStim=ImageStim, TextStim=TextStim,
+                         ShapeStim=ShapeStim, Rect=Rect, ElementArrayStim=ElementArrayStim,
+                         BufferImageStim=BufferImageStim, Form=Form, useFBO=False)
+        core = _module('psychopy.core', Clock=Clock, MonotonicClock=Clock, wait=wait, quit=quit, rush=_no_op,
+                       getTime=_get_time)
+        event = _module('psychopy.event', getKeys=getKeys, clearEvents=clearEvents, Mouse=Mouse,
+                        waitKeys=lambda *args, **kwargs: ['space'])
+        logging = _module('psychopy.logging', LogFile=LogFile, console=_LogTarget(), root=_LogTarget(),
+                          flush=_no_op, exp=_no_op, data=_no_op, info=_no_op, warning=_no_op, error=_no_op,
+                          CRITICAL=50, ERROR=40, WARNING=30, DATA=25, EXP=22, INFO=20, DEBUG=10)
+        constants = _module('psychopy.constants', NOT_STARTED=NOT_STARTED, STARTED=STARTED, PLAYING=PLAYING,
+                            PAUSED=PAUSED, STOPPED=STOPPED, FINISHED=FINISHED, PRESSED=PRESSED,
+                            RELEASED=RELEASED, FOREVER=FOREVER, priority=priority)
+        environmenttools = _module('psychopy.tools.environmenttools', setExecEnvironment=setExecEnvironment,
+                                   getFromNames=getFromNames)
+        keyboard = _module('psychopy.hardware.keyboard', Keyboard=Keyboard, KeyPress=KeyPress)
+        modules = {
+            'psychopy.visual': visual,
+            'psychopy.core': core,
+            'psychopy.event': event,
+            'psychopy.monitors': _module('psychopy.monitors', Monitor=Monitor),
+            'psychopy.data': _module('psychopy.data', ExperimentHandler=ExperimentHandler, getDateStr=getDateStr),
+            'psychopy.gui': _module('psychopy.gui', DlgFromDict=DlgFromDict),
+            'psychopy.logging': logging,
+            'psychopy.constants': constants,
+            'psychopy.tools': _module('psychopy.tools', environmenttools=environmenttools),
+            'psychopy.tools.environmenttools': environmenttools,
+            'psychopy.hardware': _module('psychopy.hardware', keyboard=keyboard, __path__=[]),
+            'psychopy.hardware.keyboard': keyboard,
+            'pylsl': _module('pylsl', StreamInfo=StreamInfo, StreamOutlet=StreamOutlet, local_clock=_get_time),
+            'u3': _module('u3', U3=U3, DAC0_8=DAC0_8),
+        }
+        modules['psychopy'] = _module('psychopy', __version__='dry-run', __path__=[],
+                                      **{name.split('.')[1]: module for name, module in modules.items()
+                                         if name.startswith('psychopy.') and name.count('.') == 1})
+        try:
+            import matplotlib  # noqa: F401
+        except ImportError:
+            # Only needed for `matplotlib.use(...)` at the top of the script
+            modules['matplotlib'] = _module('matplotlib', use=_no_op)
+
+        for name, module in modules.items():
+            self._patched.append((sys.modules, name, sys.modules.get(name)))
+            sys.modules[name] = module
+        self._patch(subprocess, 'Popen', PopenStandIn)
+        self._patched.append((os.environ, 'PARADIGM_DATA_ROOT', os.environ.get('PARADIGM_DATA_ROOT')))
+        os.environ['PARADIGM_DATA_ROOT'] = self.data_root
+        try:
+            import labrecorder_client
+        except ImportError:
+            pass
+        else:
+            self._patch(labrecorder_client, 'LabRecorderClient', LabRecorderStandIn)
+        try:
+            import input_monitor
+        except ImportError:
+            pass
+        else:
+            self._patch(input_monitor, 'InputMonitor', make_input_monitor(input_monitor.InputMonitor))
+        try:
+            import monitor_calibration
+        except ImportError:
+            pass
+        else:
+            # Profiles measured on the virtual clock must never be loaded by a real session
+            self._calibration_dir = tempfile.mkdtemp(prefix='dryrun_calibration_')
+            self._patch(monitor_calibration, 'profile_filename',
+                        lambda folder, monitor_name: op.join(self._calibration_dir, f'{monitor_name}.json'))
+
+    def _patch(self, obj, name, value):
+        self._patched.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def uninstall(self):
+        for obj, name, value in reversed(self._patched):
+            if obj is sys.modules or obj is os.environ:
+                if value is None:
+                    obj.pop(name, None)
+                else:
+                    obj[name] = value
+            else:
+                setattr(obj, name, value)
+        self._patched = []
+        if self._calibration_dir is not None:
+            shutil.rmtree(self._calibration_dir, ignore_errors=True)
+            self._calibration_dir = None
+
+    def run(self):
+        """
+        Run the script to the end.
+
+        Returns
+        ==========
+        bool
+            Whether it finished without an error.
+        """
+        script_dir = op.dirname(self.script)
+        cwd = os.getcwd()
+        sys.path.insert(0, script_dir)
+        self.install()
+        completed = True
+        try:
+            os.chdir(script_dir)  # the scripts load their images from relative paths
+            runpy.run_path(self.script, run_name='__main__')
+        except SystemExit as e:
+            completed = e.code in (None, 0)
+        except Exception:
+            traceback.print_exc()
+            completed = False
+        finally:
+            os.chdir(cwd)
+            self.uninstall()
+            sys.path.remove(script_dir)
+        for handler in self.handlers:
+            handler.close()
+        return completed
+
+    def output_stem(self, out_dir=None):
+        participant = self.exp_info.get('participant', 'sub-dryrun')
+        if out_dir is None:
+            out_dir = op.join(self.data_root, participant, self.exp_info.get('session', ''), 'beh')
+        os.makedirs(out_dir, exist_ok=True)
+        return op.join(out_dir, f'{participant}_dryrun')
+
+    def write_logs(self, out_dir=None):
+        """Write the marker and frame logs. Returns their filenames."""
+        stem = self.output_stem(out_dir)
+        with open(stem + '_markers.tsv', 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(['time', 'source', 'value'])
+            for timestamp, source, value in self.markers:
+                writer.writerow([f'{timestamp:.6f}', source, value])
+        with open(stem + '_frames.tsv', 'w', newline='') as f:
+            f.write('frame\ttime\tdrawn\n')
+            previous = None
+            for n, (t, drawn) in enumerate(self.frames):
+                f.write(f'{n}\t{t:.6f}\t{"" if drawn == previous else ";".join(drawn) or "-"}\n')
+                previous = drawn
+        return stem + '_markers.tsv', stem + '_frames.tsv'
+
+    def summary(self):
+        sources = {}
+        for _, source, _ in self.markers:
+            sources[source] = sources.get(source, 0) + 1
+        return (f"{len(self.frames)} frames at {self.clock.refresh_rate:g} Hz, {self.clock.now:.1f} s of session time; "
+                f"markers: {', '.join(f'{n} {source}' for source, n in sources.items()) or 'none'}")
+
+
+def main(argv=None):
+    default_script = next((op.abspath(s) for s in SCRIPTS if op.exists(s)), None)
+
+    parser = argparse.ArgumentParser(description='Run a paradigm script on a virtual clock, without hardware')
+    parser.add_argument('script', nargs='?', default=default_script)
+    parser.add_argument('--answer', nargs='+', default=[], metavar='FIELD=VALUE',
+                        help='dialog answers, e.g. condition=Session monitor_name=Alienware')
+    parser.add_argument('--refresh-rate', type=float, default=None,
+                        help="virtual refresh rate (default: the chosen monitor's refresh_rate)")
+    parser.add_argument('--escape-at', type=float, default=None, help='press escape at this virtual time (s)')
+    parser.add_argument('--out', default=None, help='data root of the run (default: a new temporary folder)')
+    args = parser.parse_args(argv)
+    if args.script is None:
+        parser.error(f"no paradigm script ({', '.join(SCRIPTS)}) in this folder; give its path")
+
+    answers = {'participant': 'sub-dryrun'}
+    for answer in args.answer:
+        field, _, value = answer.partition('=')
+        answers[field] = value
+
+    dry_run = DryRun(args.script, answers, refresh_rate=args.refresh_rate, escape_at=args.escape_at, data_root=args.out)
+    t = time.perf_counter()
+    completed = dry_run.run()
+    elapsed = time.perf_counter() - t
+
+    for filename in dry_run.write_logs():
+        print(f'Dry run: wrote {filename}')
+    print(f"Dry run {'completed' if completed else 'FAILED'} in {elapsed:.1f} s: {dry_run.summary()}")
+    print(f'Dry run data: {dry_run.data_root}')
+    return 0 if completed else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
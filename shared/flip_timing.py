@@ -0,0 +1,162 @@
+"""
+Flip-timing instrumentation.
+
+`FlipTimer` wraps `win.flip()` so that every flip timestamp is written into a preallocated NumPy
+buffer (no allocation per frame). At the end of each block it works out the late and dropped
+frames and the flicker frequency that was actually delivered at each location, appends a summary
+row to `<data file>_timing.csv` and saves the raw flip times next to it.
+"""
+import csv
+import os
+
+import numpy as np
+
+
+class FlipTimer:
+    """
+    Record the time of every `win.flip()`.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window for this experiment. Its `flip` method is wrapped until `detach` is called.
+    refresh_rate : float
+        Nominal refresh rate of the monitor in Hz.
+    filename : str
+        Data file stem (`thisExp.dataFileName`); reports are written to `<filename>_timing.csv`
+        and `<filename>_<block>_flips.npy`.
+    capacity : int
+        Maximum number of flips recorded per block. Extra flips are counted but not stored.
+    late_tolerance : float
+        Fraction of a frame an interval may exceed the nominal frame duration before the frame
+        counts as late.
+    """
+    def __init__(self, win, refresh_rate, filename, capacity=100000, late_tolerance=0.2):
+        self.win = win
+        self.frame_dur = 1.0 / refresh_rate
+        self.filename = filename
+        self.late_tolerance = late_tolerance
+        self.times = np.empty(capacity, dtype=np.float64)
+        self.n = 0
+        self.overflow = 0
+        self._win_flip = win.flip
+        win.flip = self.flip
+
+    def flip(self, clearBuffer=True):
+        # Explicit argument instead of *args/**kwargs, which would allocate a dict on every frame
+        t = self._win_flip(clearBuffer)
+        if self.n < self.times.shape[0]:
+            self.times[self.n] = t
+            self.n += 1
+        else:
+            self.overflow += 1
+        return t
+
+    def detach(self):
+        """Give the window its own `flip` back."""
+        self.win.flip = self._win_flip
+
+    def begin_block(self):
+        """Start recording a new block (the first flip after this is frame 0 of the block)."""
+        self.n = 0
+        self.overflow = 0
+
+    def end_block(self, label, on=None, periods=None, target_freqs=None):
+        """
+        Summarise the flips of the block and write them to disk.
+
+        Parameters
+        ==========
+        label : str
+            Name of the block in the report, e.g. `'block_0'`.
+        on : np.ndarray of bool, shape (n_frames, n_locations), or None
+            On/off state of every location on every frame of the block. If None and `periods`
+            is given, continuous flicker counted from frame 1 is assumed.
+        periods : list of float or None
+            Flicker period (frames) of each location.
+        target_freqs : list of float or None
+            Frequency each location is meant to flicker at (as in `stimuli_map.json`).
+
+        Returns
+        ==========
+        dict
+            The summary row written to the timing file.
+        """
+        times = self.times[:self.n]
+        intervals = np.diff(times)
+        frames_per_interval = np.round(intervals / self.frame_dur) if intervals.size else intervals
+
+        report = {'block': label,
+                  'n_flips': self.n + self.overflow,
+                  'mean_interval_ms': float(intervals.mean() * 1000) if intervals.size else np.nan,
+                  'sd_interval_ms': float(intervals.std() * 1000) if intervals.size else np.nan,
+                  'max_interval_ms': float(intervals.max() * 1000) if intervals.size else np.nan,
+                  'n_late': int(np.count_nonzero(intervals > self.frame_dur * (1 + self.late_tolerance))),
+                  'n_dropped': int(np.sum(np.maximum(frames_per_interval - 1, 0))),
+                  }
+
+        if periods is not None:
+            if on is None:
+                frame_count = np.arange(1, self.n + 1)[:, np.newaxis]
+                on = (frame_count % np.asarray(periods)) < (np.asarray(periods) / 2)
+            realised = realised_frequencies(times, on, periods)
+            for loc, period in enumerate(periods):
+                if target_freqs is not None:
+                    report[f'loc_{loc}_target_hz'] = target_freqs[loc]
+                report[f'loc_{loc}_scheduled_hz'] = round(1.0 / (period * self.frame_dur), 3)
+                report[f'loc_{loc}_realised_hz'] = round(float(realised[loc]), 3)
+
+        np.save(f'{self.filename}_{label}_flips.npy', times)
+        self._write_row(report)
+
+        print(f"Timing {label}: {report['n_flips']} flips, {report['n_late']} late, "
+              f"{report['n_dropped']} dropped, max interval {report['max_interval_ms']:.2f} ms")
+        return report
+
+    def _write_row(self, report):
+        path = self.filename + '_timing.csv'
+        new_file = not os.path.exists(path)
+        with open(path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(report))
+            if new_file:
+                writer.writeheader()
+            writer.writerow(report)
+
+
+def realised_frequencies(times, on, periods):
+    """
+    Flicker frequency delivered at each location, measured from the flip times.
+
+    Only consecutive onsets that the schedule places exactly one period apart are used, so
+    static stretches and breaks between trials do not count as flicker cycles.
+
+    Parameters
+    ==========
+    times : np.ndarray
+        Flip time of every frame of the block (seconds).
+    on : np.ndarray of bool, shape (n_frames, n_locations)
+        On/off state of every location on every frame.
+    periods : list of float
+        Flicker period (frames) of each location.
+
+    Returns
+    ==========
+    np.ndarray
+        Frequency in Hz per location (NaN where the location never completed a cycle).
+    """
+    n = min(times.shape[0], on.shape[0])
+    on = on[:n]
+    # A frame is an onset if the location is on and was off on the previous frame
+    onsets = on & ~np.vstack([np.zeros((1, on.shape[1]), dtype=bool), on[:-1]])
+
+    freqs = np.full(on.shape[1], np.nan)
+    for loc, period in enumerate(periods):
+        frames = np.flatnonzero(onsets[:, loc])
+        if frames.size < 2:
+            continue
+        full_cycles = np.diff(frames) == int(round(period))
+        if not full_cycles.any():
+            continue
+        cycle_times = np.diff(times[frames])[full_cycles]
+        freqs[loc] = 1.0 / cycle_times.mean()
+    return freqs
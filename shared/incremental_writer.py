@@ -0,0 +1,246 @@
+"""
+Crash-safe incremental data log.
+
+`data.ExperimentHandler` only writes the `.csv` and `.psydat` at the end of a session, so a crash
+loses every behavioural row. `IncrementalWriter` appends each row to `<file>_rows.jsonl` (one JSON
+object per line) and every marker (LSL or LabJack) to a binary mirror, `<file>_markers.bin`, next to
+the other data files. Rows and markers are only queued by the experiment. A background thread
+serialises and writes them, and fsyncs the files whenever `flush()` is called (at each block
+boundary), so the frame loop never waits on the disk. Whatever is still queued is written when the
+writer is closed, which also happens on interpreter exit.
+
+Both files only ever grow, so a crash can at worst cut off the last record. `recover` (or
+`python incremental_writer.py <file>`) rebuilds `<file>_recovered.csv` and
+`<file>_markers_recovered.tsv` from them.
+"""
+import argparse
+import atexit
+import csv
+import json
+import os
+import os.path as op
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+MARKER_MAGIC = b'MARKERS1'
+MARKER_RECORD = struct.Struct('<dHH')  # timestamp, length of the source, length of the value (UTF-8)
+
+
+def _to_json(value):
+    # numpy scalars/arrays (and anything else) as plain JSON values
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class IncrementalWriter:
+    """
+    Append rows and markers to the `beh/` directory from a background thread.
+
+    Parameters
+    ==========
+    filename : str
+        Data file stem (`thisExp.dataFileName`).
+    info : dict or None
+        Session information (`thisExp.extraInfo`), written as the first line of the row log and
+        added to every recovered row.
+    flush_interval : float or None
+        Also write every `flush_interval` seconds; None only writes on `flush()` and `close()`.
+    """
+    def __init__(self, filename, info=None, flush_interval=None):
+        self.filename = filename
+        self.rows_file = filename + '_rows.jsonl'
+        self.markers_file = filename + '_markers.bin'
+        self.flush_interval = flush_interval
+
+        self._rows = deque()
+        self._markers = deque()
+        self.n_rows = 0
+        self.n_markers = 0
+        self.n_flushes = 0
+        self.max_write_time = 0.0
+
+        self._rows_f = open(self.rows_file, 'a', encoding='utf-8')
+        self._markers_f = open(self.markers_file, 'ab')
+        if self._markers_f.tell() == 0:
+            self._markers_f.write(MARKER_MAGIC)
+        if info is not None:
+            self._rows.append({'info': dict(info)})
+
+        self._wake = threading.Event()
+        self._running = True
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='IncrementalWriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_row(self, row):
+        """Queue a row (a copy of the dict is kept, e.g. `thisExp.entries[-1]`)."""
+        self._rows.append({'row': dict(row)})
+
+    def add_marker(self, timestamp, source, value):
+        """Queue a marker, e.g. `(lsl_timestamp, 'lsl', 'Oddball/block_0/block_start')`."""
+        self._markers.append((timestamp, source, value))
+
+    def flush(self):
+        """Have the thread write and fsync everything queued so far (returns immediately)."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            # Read before writing: if `close` comes in during the write, whatever was queued meanwhile
+            # is written on the next pass instead of being dropped
+            running = self._running
+            self._write()
+            if not running:
+                return
+
+    def _write(self):
+        t = time.perf_counter()
+        lines = []
+        n_rows = 0
+        while self._rows:
+            record = self._rows.popleft()
+            n_rows += 'row' in record
+            lines.append(json.dumps(record, default=_to_json))
+        records = []
+        while self._markers:
+            timestamp, source, value = self._markers.popleft()
+            source, value = str(source).encode('utf-8'), str(value).encode('utf-8')
+            records.append(MARKER_RECORD.pack(timestamp, len(source), len(value)) + source + value)
+        if not lines and not records:
+            return
+        if lines:
+            self._rows_f.write('\n'.join(lines) + '\n')
+            self._rows_f.flush()
+            os.fsync(self._rows_f.fileno())
+        if records:
+            self._markers_f.write(b''.join(records))
+            self._markers_f.flush()
+            os.fsync(self._markers_f.fileno())
+        self.n_rows += n_rows
+        self.n_markers += len(records)
+        self.n_flushes += 1
+        self.max_write_time = max(self.max_write_time, time.perf_counter() - t)
+
+    def close(self, timeout=5.0):
+        """Write whatever is still queued and stop the thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._running = False
+        self._wake.set()
+        self._thread.join(timeout)
+        self._rows_f.close()
+        self._markers_f.close()
+        atexit.unregister(self.close)
+
+    def report(self):
+        return (f"Data log: {self.n_rows} rows, {self.n_markers} markers in {self.n_flushes} writes "
+                f"(longest {self.max_write_time * 1000:.1f} ms, off the frame loop)")
+
+
+def read_rows(rows_file):
+    """
+    Session information and rows from a row log, skipping a line cut off by a crash.
+
+    Returns
+    ==========
+    info : dict
+    rows : list of dict
+    """
+    info, rows = {}, []
+    with open(rows_file, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # the last line of a log that was being written
+            if 'info' in record:
+                info.update(record['info'])
+            else:
+                rows.append(record['row'])
+    return info, rows
+
+
+def read_markers(markers_file):
+    """Markers `(timestamp, source, value)` from a binary mirror, up to the last complete record."""
+    with open(markers_file, 'rb') as f:
+        buffer = f.read()
+    if not buffer.startswith(MARKER_MAGIC):
+        raise ValueError(f'{markers_file} is not a marker log')
+    markers = []
+    pos = len(MARKER_MAGIC)
+    while pos + MARKER_RECORD.size <= len(buffer):
+        timestamp, n_source, n_value = MARKER_RECORD.unpack_from(buffer, pos)
+        end = pos + MARKER_RECORD.size + n_source + n_value
+        if end > len(buffer):
+            break
+        start = pos + MARKER_RECORD.size
+        markers.append((timestamp, buffer[start:start + n_source].decode('utf-8'),
+                        buffer[start + n_source:end].decode('utf-8')))
+        pos = end
+    return markers
+
+
+def recover(filename):
+    """
+    Rebuild the behavioural `.csv` and a marker table from the logs of a (possibly crashed) session.
+
+    Parameters
+    ==========
+    filename : str
+        Data file stem, as passed to `IncrementalWriter`.
+
+    Returns
+    ==========
+    list of str
+        Files written: `<file>_recovered.csv` and/or `<file>_markers_recovered.tsv`.
+    """
+    written = []
+    if op.exists(filename + '_rows.jsonl'):
+        info, rows = read_rows(filename + '_rows.jsonl')
+        # Columns in the order they first appear, then the session information (as ExperimentHandler does)
+        columns = list(dict.fromkeys(key for row in rows for key in row))
+        columns += [key for key in info if key not in columns]
+        with open(filename + '_recovered.csv', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({**info, **row})
+        written.append(filename + '_recovered.csv')
+    if op.exists(filename + '_markers.bin'):
+        with open(filename + '_markers_recovered.tsv', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(['timestamp', 'source', 'value'])
+            for timestamp, source, value in read_markers(filename + '_markers.bin'):
+                writer.writerow([f'{timestamp:.6f}', source, value])
+        written.append(filename + '_markers_recovered.tsv')
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild the data files of a session from its incremental logs')
+    parser.add_argument('filename', nargs='+', help="data file stem, or its '_rows.jsonl'/'_markers.bin' log")
+    args = parser.parse_args(argv)
+    for filename in args.filename:
+        for suffix in ('_rows.jsonl', '_markers.bin'):
+            if filename.endswith(suffix):
+                filename = filename[:-len(suffix)]
+        written = recover(filename)
+        if not written:
+            print(f'{filename}: no logs found')
+        for name in written:
+            print(f'-> {name}')
+
+
+if __name__ == '__main__':
+    main()
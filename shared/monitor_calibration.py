@@ -0,0 +1,224 @@
+"""
+Measured monitor profiles.
+
+The refresh rate in `screens` is the nominal one. A monitor set to 239.96 Hz, or left at 144 Hz,
+would flicker at frequencies other than the ones the markers report. `calibrate` flips a window
+for a few seconds, fits the flip times to get the actual refresh rate and the frame-time jitter,
+and saves them as a versioned JSON profile (`calibration/<monitor>.json`). Later launches load
+the profile, and the flicker periods are worked out from the measured rate.
+
+A profile is measured again if it is missing, from an older format version, for another
+resolution, or older than `max_age_days`; delete it to force a new measurement. A loaded profile
+is used without opening a window, and checked on the experiment window against a short measurement
+of the rate the monitor runs at now (`profile_matches`), so a display switched to another refresh
+rate since is caught.
+"""
+import datetime
+import json
+import os
+import os.path as op
+import platform
+
+import numpy as np
+
+PROFILE_VERSION = 1  # bump when the profile format changes
+
+
+def profile_filename(folder, monitor_name):
+    """Where the profile of a monitor is kept."""
+    return op.join(folder, f'{monitor_name}.json')
+
+
+def measure_refresh_rate(win, n_frames=600, n_warmup=60):
+    """
+    Flip `win` and measure the refresh rate and frame-time jitter.
+
+    The flip times are fitted against the refresh count (dropped frames counted from the interval
+    lengths), so a few dropped frames don't bias the rate.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window on the monitor to measure (`flip()` returns the flip time).
+    n_frames : int
+        Number of flips measured.
+    n_warmup : int
+        Number of flips before measuring.
+
+    Returns
+    ==========
+    dict
+        'refresh_rate' (Hz), 'frame_dur_ms', 'jitter_sd_ms' (residual of the fit), 'interval_p99_ms',
+        'max_interval_ms', 'n_frames' and 'n_dropped'.
+    """
+    for _ in range(n_warmup):
+        win.flip()
+    times = np.empty(n_frames)
+    for n in range(n_frames):
+        times[n] = win.flip()
+
+    intervals = np.diff(times)
+    refreshes = np.maximum(np.round(intervals / np.median(intervals)), 1)
+    refresh_count = np.concatenate([[0], np.cumsum(refreshes)])
+    frame_dur, offset = np.polyfit(refresh_count, times, 1)
+    residuals = times - (offset + frame_dur * refresh_count)
+    return {'refresh_rate': round(float(1.0 / frame_dur), 3),
+            'frame_dur_ms': float(frame_dur * 1000),
+            'jitter_sd_ms': float(residuals.std() * 1000),
+            'interval_p99_ms': float(np.percentile(intervals, 99) * 1000),
+            'max_interval_ms': float(intervals.max() * 1000),
+            'n_frames': int(n_frames),
+            'n_dropped': int(np.sum(refreshes - 1)),
+            }
+
+
+def calibrate(win, filename, monitor_name, resolution, nominal_refresh_rate=None, n_frames=600):
+    """
+    Measure the monitor and save its profile.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window on the monitor.
+    filename : str
+        Profile file (see `profile_filename`).
+    monitor_name : str
+        Name of the monitor in `screens`.
+    resolution : list of int
+        Resolution the window was opened at.
+    nominal_refresh_rate : float or None
+        Refresh rate in `screens`, kept for comparison.
+    n_frames : int
+        Number of flips measured.
+
+    Returns
+    ==========
+    dict
+        The profile.
+    """
+    from psychopy import __version__ as psychopy_version
+
+    profile = {'version': PROFILE_VERSION,
+               'monitor': monitor_name,
+               'resolution': list(resolution),
+               'nominal_refresh_rate': nominal_refresh_rate,
+               **measure_refresh_rate(win, n_frames=n_frames),
+               'measured_at': datetime.datetime.now().isoformat(timespec='seconds'),
+               'host': platform.node(),
+               'psychopy_version': psychopy_version,
+               }
+    save_profile(profile, filename)
+    print(f"Calibration: {monitor_name} measured at {profile['refresh_rate']:.3f} Hz "
+          f"(jitter {profile['jitter_sd_ms']:.3f} ms, {profile['n_dropped']} dropped) -> {filename}")
+    return profile
+
+
+def save_profile(profile, filename):
+    os.makedirs(op.dirname(filename) or '.', exist_ok=True)
+    # Write to a temporary file first so an interrupted launch never leaves a broken profile
+    tmp_file = filename + f'.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(profile, f, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def load_profile(filename, monitor_name, resolution, max_age_days=None):
+    """
+    Load a profile if it is still valid.
+
+    Returns
+    ==========
+    dict or None
+        The profile, or None (with the reason printed) if it has to be measured again.
+    """
+    if not op.exists(filename):
+        print(f'Calibration: no profile for {monitor_name} yet')
+        return None
+    try:
+        with open(filename) as f:
+            profile = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'Calibration: could not read {filename} ({e})')
+        return None
+
+    problem = None
+    if profile.get('version') != PROFILE_VERSION:
+        problem = f"format version {profile.get('version')} (current {PROFILE_VERSION})"
+    elif profile.get('monitor') != monitor_name:
+        problem = f"it is for {profile.get('monitor')}"
+    elif list(profile.get('resolution', [])) != list(resolution):
+        problem = f"it was measured at {profile.get('resolution')}"
+    elif not profile.get('refresh_rate', 0) > 0:
+        problem = 'it has no refresh rate'
+    elif max_age_days is not None:
+        age = datetime.datetime.now() - datetime.datetime.fromisoformat(profile['measured_at'])
+        if age.days > max_age_days:
+            problem = f'it is {age.days} days old'
+    if problem is not None:
+        print(f'Calibration: measuring {monitor_name} again, {problem}')
+        return None
+    return profile
+
+
+def profile_matches(win, profile, tolerance=1.0, n_frames=60):
+    """
+    Check a stored profile against the refresh rate `win` runs at now.
+
+    This is a quick check over `n_frames` flips (a quarter of a second at 240 Hz), to catch a display
+    switched to another mode since the profile was measured, not a new measurement.
+
+    Parameters
+    ==========
+    win : psychopy.visual.Window
+        Window on the monitor.
+    profile : dict
+        Profile from `load_profile`.
+    tolerance : float
+        Largest difference (Hz) from the profile's refresh rate.
+    n_frames : int
+        Number of flips measured.
+
+    Returns
+    ==========
+    bool
+        False (with the reason printed) if the rate is off by more than `tolerance` or too unstable
+        to measure, in which case the monitor should be calibrated again.
+    """
+    rate = win.getActualFrameRate(nMaxFrames=n_frames)
+    if rate is None:
+        print(f"Calibration: measuring {profile['monitor']} again, its frame rate was too unstable to check")
+        return False
+    if abs(rate - profile['refresh_rate']) > tolerance:
+        print(f"Calibration: measuring {profile['monitor']} again, it runs at {rate:.2f} Hz, "
+              f"not the {profile['refresh_rate']:.3f} Hz of its profile")
+        return False
+    return True
+
+
+def check_refresh_rate(profile, tolerance=0.5):
+    """Warn if the measured refresh rate is far from the nominal one (wrong display mode?)."""
+    nominal = profile.get('nominal_refresh_rate')
+    if nominal and abs(profile['refresh_rate'] - nominal) > tolerance:
+        print(f"WARNING: {profile['monitor']} runs at {profile['refresh_rate']:.3f} Hz, not the {nominal} Hz in "
+              f"`screens`. Flicker periods are worked out from the measured rate; check the display settings.")
+
+
+def delivered_frequencies(flicker_freqs, refresh_rate, tolerance=0.05):
+    """
+    Flicker period (frames) of each frequency and the frequency it actually gives at `refresh_rate`.
+
+    Prints a warning for every frequency that is off by more than `tolerance` Hz.
+
+    Returns
+    ==========
+    list of tuple
+        `(frames, delivered_frequency)` per frequency.
+    """
+    delivered = []
+    for freq in flicker_freqs:
+        frames = round(refresh_rate / freq)
+        actual = refresh_rate / frames
+        if abs(actual - freq) > tolerance:
+            print(f'WARNING: {freq} Hz is shown as {actual:.3f} Hz ({frames} frames at {refresh_rate:.3f} Hz)')
+        delivered.append((frames, actual))
+    return delivered
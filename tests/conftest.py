@@ -0,0 +1,15 @@
+"""
+Put the two paradigm folders and `shared/` on `sys.path`, so the tests import their modules the way
+the scripts do.
+"""
+import os.path as op
+import sys
+
+ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+SHARED = op.join(ROOT, 'shared')
+HYBRID = op.join(ROOT, 'Hybrid BCI Paradigm')
+OPM = op.join(ROOT, 'SSVEP Replication Paradigm - Morgan et al. 1996')
+
+for folder in (SHARED, HYBRID, OPM):
+    if folder not in sys.path:
+        sys.path.insert(0, folder)
@@ -0,0 +1,74 @@
+"""Letter sequences of the OPM paradigm and the stimuli that show them."""
+import os.path as op
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from conftest import OPM
+from character_stream import CharacterStream, no_repeat_sequences
+
+CHARACTERS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', '5']
+
+
+def test_no_repeat_sequences_never_repeat_a_letter():
+    sequences = no_repeat_sequences(np.random.default_rng(1), 12, (15, 9, 2, 17))
+    assert sequences.shape == (15, 9, 2, 17)
+    assert sequences.min() >= 0 and sequences.max() < 12
+    assert not np.any(np.diff(sequences, axis=-1) == 0)
+    # Every letter turns up, first and later
+    assert set(np.unique(sequences[..., 0])) == set(range(12))
+    assert set(np.unique(sequences[..., 1:])) == set(range(12))
+
+
+class ImageStim:
+    """Records what is drawn and every texture set after construction."""
+    drawn = []
+
+    def __init__(self, win, image=None, name=None, **kwargs):
+        self._image, self.name, self.image_sets = image, name, 0
+
+    @property
+    def image(self):
+        return self._image
+
+    @image.setter
+    def image(self, value):
+        self._image = value
+        self.image_sets += 1
+
+    def draw(self):
+        ImageStim.drawn.append(self)
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    psychopy = types.ModuleType('psychopy')
+    psychopy.visual = types.SimpleNamespace(ImageStim=ImageStim)
+    monkeypatch.setitem(sys.modules, 'psychopy', psychopy)
+    ImageStim.drawn = []
+    image_paths = {char: op.join(OPM, 'images', 'stimuli', f'{char}.png') for char in CHARACTERS}
+    letter_index = np.arange(1, 31) // 4
+    return CharacterStream(None, image_paths, positions=[(-5, 0), (5, 0)], letter_index=letter_index)
+
+
+def test_letters_are_selected_without_setting_a_texture(stream):
+    assert stream.n_letters == 8
+    sequence = no_repeat_sequences(np.random.default_rng(2), 12, (2, stream.n_letters))
+    stream.start_trial(sequence)
+    for frame in range(30):
+        stream.draw(frame)
+
+    letter_index = np.arange(1, 31) // 4
+    shown = [''.join(stim.name for stim in ImageStim.drawn[field::2]) for field in range(2)]
+    for field in range(2):
+        assert shown[field] == ''.join(CHARACTERS[i] for i in sequence[field, letter_index])
+    assert stream.letters(sequence[0]) == ''.join(CHARACTERS[i] for i in sequence[0])
+    assert all(stim.image_sets == 0 for stims in stream.stims for stim in stims)
+    assert sum(map(len, stream.stims)) == 24
+
+
+def test_short_sequence_is_refused(stream):
+    with pytest.raises(ValueError):
+        stream.start_trial(np.zeros((2, 3), dtype=int))
@@ -0,0 +1,123 @@
+"""
+Dry-run every condition on every monitor profile of both paradigm scripts.
+
+Each run is a separate process with its own temporary data root, as a real dry run would be. The markers
+it sent and the frames it played are compared with the session plan (Hybrid) and the trial rows (OPM).
+"""
+import csv
+import glob
+import os.path as op
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from conftest import HYBRID, OPM, SHARED
+from dry_run import read_screens
+from incremental_writer import read_markers, read_rows
+from frame_schedule import CONDITIONS, FLICKER_CONDITIONS
+from session_plan import ODDBALL_CONDITIONS, load_session_plan
+
+HYBRID_SCRIPT = op.join(HYBRID, 'BCI_Paradigm_24-25.py')
+OPM_SCRIPT = op.join(OPM, 'OPM_SSVEP.py')
+
+RUNS = ([(HYBRID_SCRIPT, monitor, condition) for monitor in read_screens(HYBRID_SCRIPT) for condition in CONDITIONS]
+        + [(OPM_SCRIPT, monitor, 'OPM_SSVEP') for monitor in read_screens(OPM_SCRIPT)])
+
+
+@pytest.mark.parametrize('script, monitor, condition', RUNS,
+                         ids=[f'{op.basename(s)}-{m}-{c}' for s, m, c in RUNS])
+def test_dry_run(tmp_path, script, monitor, condition):
+    field = 'task' if script == OPM_SCRIPT else 'condition'
+    result = subprocess.run([sys.executable, op.join(SHARED, 'dry_run.py'), script, '--out', str(tmp_path),
+                             '--answer', f'monitor_name={monitor}', f'{field}={condition}'],
+                            cwd=op.dirname(script), capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stdout[-3000:] + result.stderr[-3000:]
+    assert 'Dry run completed' in result.stdout
+
+    # Everything went below the temporary data root
+    beh_dirs = glob.glob(str(tmp_path / 'sub-dryrun' / '*' / 'beh'))
+    assert len(beh_dirs) == 1
+    assert not op.exists(op.join(op.dirname(script), 'data', 'sub-dryrun'))
+    stem = op.join(beh_dirs[0], f'sub-dryrun_task-{condition}')
+    with open(stem + '_timing.csv', newline='') as f:
+        timing = list(csv.DictReader(f))
+    markers = read_dry_run_markers(op.join(beh_dirs[0], 'sub-dryrun_dryrun_markers.tsv'))
+    if script == OPM_SCRIPT:
+        check_opm_run(stem, timing, markers)
+    else:
+        check_hybrid_run(stem, timing, markers)
+
+
+def read_dry_run_markers(filename):
+    """`(time, source, value)` of every marker the dry run recorded."""
+    with open(filename, newline='') as f:
+        return [(float(row['time']), row['source'], row['value']) for row in csv.DictReader(f, delimiter='\t')]
+
+
+def check_hybrid_run(stem, timing, markers):
+    plan = load_session_plan(stem + '_plan.npz')
+    refresh_rate = plan.info['refresh_rate']
+
+    # Every frame of each block was played
+    assert [row['block'] for row in timing] == [f'block_{block}' for block in range(plan.n_blocks)]
+    assert [int(row['n_flips']) for row in timing] == np.diff(plan.block_frames).tolist()
+
+    # The markers of the plan, in order: frequencies, then per block the target, start, frame schedule, end
+    # and the flash count form
+    expected = plan.freq_marker_list() if plan.condition in FLICKER_CONDITIONS else []
+    for block in range(plan.n_blocks):
+        expected += [plan.block_marker(block, 'target_marker'), plan.block_marker(block, 'block_start')]
+        expected += plan.event_marker[plan.event_block == block].tolist()
+        expected += [plan.block_marker(block, 'block_end')]
+        if plan.condition in ODDBALL_CONDITIONS:
+            expected += [plan.block_marker(block, 'flash_count_start')]
+    sent = [(t, value) for t, source, value in markers if source == 'lsl:BCIMarkerStream']
+    assert [value for _, value in sent] == expected
+
+    # Each marker of a frame schedule was stamped with its frame, counted from the block start
+    starts = [n for n, (_, value) in enumerate(sent) if value.endswith('/block_start')]
+    for block, start in enumerate(starts):
+        frames = plan.event_frame[plan.event_block == block]
+        times = [t for t, _ in sent[start + 1:start + 1 + len(frames)]]
+        np.testing.assert_allclose(np.subtract(times, sent[start][0]), frames / refresh_rate, atol=1e-5)
+
+
+def check_opm_run(stem, timing, markers):
+    _, rows = read_rows(stem + '_rows.jsonl')
+    blocks = [row['block'] for row in rows]
+    assert sorted(set(blocks)) == list(range(15)) and all(blocks.count(block) == 8 for block in set(blocks))
+    assert [row['block'] for row in timing] == [f"block_{row['block']}_trial_{row['trial']}" for row in rows]
+
+    # Off at the start, then the block start (2.5 V) and per trial the condition trigger and the phase triggers
+    # (fixation, arrow, fixation 2, flicker and off), as the dry run's LabJack converts the voltages
+    expected = [0]
+    for n, row in enumerate(rows):
+        if n == 0 or row['block'] != rows[n - 1]['block']:
+            expected.append(128)
+        expected += [row['trigger'], 26, 51, 76, 102, 0]
+    assert [int(value) for _, source, value in markers if source == 'labjack'] == expected
+
+    # The data log has the same triggers but the first (written at set-up), stamped with the flips the phases
+    # started on (the dry run's LabJack notes when the I/O thread got to the write, which can be later)
+    logged = read_markers(stem + '_markers.bin')
+    assert [int(value) for _, _, value in logged] == expected[1:]
+    phases = ('ready', 'fixation', 'arrow', 'fixation_2', 'flicker', 'fixation_end')
+    expected_onsets = [row[f'{phase}_onset'] for row in rows for phase in phases]
+    np.testing.assert_allclose([t for t, _, value in logged if int(value) != 128], expected_onsets)
+
+
+def test_opm_escape_writes_the_queued_triggers(tmp_path):
+    result = subprocess.run([sys.executable, op.join(SHARED, 'dry_run.py'), OPM_SCRIPT, '--out', str(tmp_path),
+                             '--escape-at', '120'],
+                            cwd=OPM, capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stdout[-3000:] + result.stderr[-3000:]
+    # Escape ends the session through endExperiment: the trigger thread and the data log are closed
+    assert 'Triggers: ' in result.stdout and 'Data log: ' in result.stdout
+    markers_files = glob.glob(str(tmp_path / 'sub-dryrun' / '*' / 'beh' / 'sub-dryrun_task-OPM_SSVEP_markers.bin'))
+    assert len(markers_files) == 1
+    markers = read_markers(markers_files[0])
+    n_writes = int(result.stdout.split('Triggers: ')[1].split(' writes')[0])
+    assert n_writes > 0 and len(markers) == n_writes
+    assert all(source == 'labjack' for _, source, _ in markers)
@@ -0,0 +1,70 @@
+"""Online ERP decoding: model fit and file, and dynamic stopping on synthetic oddball blocks."""
+import numpy as np
+import pytest
+
+from erp_decoder import ERPDecoder, ERPModel, p300_template, simulate, simulate_block
+
+
+@pytest.fixture(scope='module')
+def simulated():
+    return simulate(n_blocks=10, seed=0)
+
+
+def test_blocks_end_early_on_the_attended_location(simulated):
+    decisions, decoder = simulated
+    assert all(decision is not None for decision, _ in decisions)
+    assert np.mean([decision.location == target for decision, target in decisions]) >= 0.9
+    for decision, _ in decisions:
+        assert decision.posterior >= decoder.threshold
+        # Each location flashed at least `min_repeats` times, and before all 60 flashes of the block
+        assert decoder.min_repeats * decoder.n_locations <= decision.n_flashes < 60
+
+
+def test_model_file_round_trip(simulated, tmp_path):
+    model = simulated[1].model
+    model.channels = [0, 2, 4, 6, 1, 3, 5, 7]
+    model.save(str(tmp_path / 'model.npz'))
+    loaded = ERPModel.load(str(tmp_path / 'model.npz'))
+    epochs = np.random.default_rng(0).standard_normal((5, model.n_samples, 8))
+    np.testing.assert_allclose(loaded.score(epochs), model.score(epochs))
+    assert loaded.channels == model.channels
+    assert loaded.score_stats == pytest.approx(model.score_stats)
+
+
+def test_target_scores_are_higher_and_favour_the_target():
+    sfreq, n_channels = 250.0, 4
+    rng = np.random.default_rng(3)
+    gains = np.ones(n_channels)
+    locs = np.tile(np.arange(6), 20)
+    eeg, onsets = simulate_block(rng, sfreq, n_channels, locs, 2, 0.75, 1.0, gains)
+    starts = np.round((onsets - 0.1) * sfreq).astype(int)
+    epochs = np.stack([eeg[s:s + int(0.9 * sfreq)] for s in starts])
+    model = ERPModel.fit(epochs, locs == 2, sfreq, tmin=-0.1)
+    target_mean, _, nontarget_mean, _ = model.score_stats
+    assert target_mean > nontarget_mean
+    assert model.log_likelihood_ratio([target_mean]) > 0 > model.log_likelihood_ratio([nontarget_mean])
+
+
+def test_flashes_are_ignored_once_decided():
+    sfreq = 100.0
+    n_samples = int(0.9 * sfreq)
+    # Scores the mean of the second window after the flash (80-160 ms): a step at the flash is a target
+    model = ERPModel(np.r_[0.0, 1.0, np.zeros(7)], 0.0, sfreq, tmin=-0.1, tmax=0.8, score_stats=(1, 0.2, 0, 0.2))
+    decoder = ERPDecoder(model, n_locations=2, n_channels=1, threshold=0.95, min_repeats=1, filter_length=0.05)
+    assert model.n_samples == n_samples
+    t = np.arange(400) / sfreq
+    eeg = np.zeros((400, 1))
+    eeg[50:, 0] = 1.0  # at the flash of location 1
+    decoder.add_flash(0.1, 0)
+    decoder.add_flash(0.5, 1)
+    decision = None
+    for start in range(0, 400, 10):
+        decision = decoder.push(eeg[start:start + 10], t[start:start + 10]) or decision
+    assert decision is not None and decision.location == 1 and decision.n_flashes == 2
+    decoder.add_flash(3.0, 0)
+    assert not decoder.pending
+
+
+def test_p300_template_peaks_at_300_ms():
+    template = p300_template(1000.0)
+    assert abs(np.argmax(template) - 300) <= 2  # nudged by the negative peak at 200 ms
@@ -0,0 +1,112 @@
+"""Flash count form: captured into a texture only at the start and on release, drawn directly while dragged."""
+import sys
+import types
+
+import numpy as np
+import pytest
+
+from flash_count import FlashCountRoutine
+
+
+class Stim:
+    def __init__(self, name):
+        self.name = name
+        self.n_draws = 0
+
+    def draw(self):
+        self.n_draws += 1
+
+
+class Form(Stim):
+    complete_after = 3  # draws
+
+    def reset(self):
+        self.n_draws = 0
+
+    @property
+    def complete(self):
+        return self.n_draws >= self.complete_after
+
+    def getData(self):
+        return [{'response': 4}]
+
+    def addDataToExp(self, thisExp, how):
+        pass
+
+
+class Button(Stim):
+    def contains(self, mouse):
+        return mouse.over_button
+
+
+class Mouse:
+    """Plays back one `getPressed` state per frame."""
+    def __init__(self, presses):
+        self.presses = iter(presses)
+        self.over_button = False
+
+    def getPressed(self):
+        pressed = next(self.presses)
+        self.over_button = pressed == 2
+        return [int(bool(pressed)), 0, 0]
+
+    def getPos(self):
+        return np.zeros(2)
+
+
+class Window:
+    def __init__(self):
+        self.n_flips = 0
+
+    def flip(self):
+        self.n_flips += 1
+
+
+class Experiment:
+    def addData(self, name, value):
+        pass
+
+    def timestampOnFlip(self, win, name):
+        pass
+
+
+@pytest.fixture
+def captures(monkeypatch):
+    captured = []
+
+    class BufferImageStim(Stim):
+        def __init__(self, win, stim=(), autoLog=True):
+            super().__init__('buffer')
+            for s in stim:
+                s.draw()
+            captured.append([s.name for s in stim])
+
+    class Clock:
+        def reset(self):
+            pass
+
+        def getTime(self):
+            return 0.0
+
+    psychopy = types.ModuleType('psychopy')
+    psychopy.visual = types.SimpleNamespace(BufferImageStim=BufferImageStim)
+    psychopy.core = types.SimpleNamespace(Clock=Clock)
+    psychopy.event = types.SimpleNamespace(Mouse=None)
+    monkeypatch.setitem(sys.modules, 'psychopy', psychopy)
+    return captured
+
+
+def test_form_is_captured_only_at_the_start_and_on_release(captures):
+    # Idle, then the slider is dragged for 5 frames, idle again, then a click on the continue button
+    presses = [0, 0, 0, 1, 1, 1, 1, 1, 0, 0, 0, 2]
+    form, button, win = Form('form'), Button('button'), Window()
+    routine = FlashCountRoutine(win, form, button, mouse=Mouse(presses))
+
+    assert routine.run(Experiment()) == 4
+    # One capture at the start, one on release; the form completed while dragged, so the button
+    # is in the capture on release
+    assert captures == [['form'], ['form', 'button']]
+    assert routine.n_live == 5
+    # The first state is read before the loop, and the click on the button ends it without a flip
+    assert routine.n_frames == win.n_flips == len(presses) - 2
+    assert routine.n_clicks == 2 and routine.click_on_button[:2].tolist() == [False, True]
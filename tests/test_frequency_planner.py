@@ -0,0 +1,53 @@
+"""Flicker frequency planner: best minimum separation, checked against an exhaustive search."""
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from frequency_planner import (arrange_around_circle, candidate_frames, min_separation, plan_frequencies,
+                               planned_freqs, separation_matrix)
+
+
+def test_separation_counts_harmonics():
+    # 8 and 12 Hz are 4 Hz apart, but 3 x 8 = 2 x 12
+    assert min_separation([8, 12], n_harmonics=1) == pytest.approx(4)
+    assert min_separation([8, 12], n_harmonics=3) == pytest.approx(0)
+    assert np.all(np.isinf(np.diag(separation_matrix([8, 10, 12]))))
+
+
+@pytest.mark.parametrize('refresh_rate, band, n_locations', [
+    (240, (10, 12.7), 6), (239.96, (10, 12.7), 6), (144, (8, 15), 4), (60, (6, 15), 3), (240, (10, 12.7), 2)])
+def test_plan_matches_exhaustive_search(refresh_rate, band, n_locations):
+    frames, min_sep = plan_frequencies(refresh_rate, band, n_locations)
+    candidates = candidate_frames(refresh_rate, band)
+    best = max(min_separation(refresh_rate / np.array(chosen)) for chosen in combinations(candidates, n_locations))
+    assert min_sep == pytest.approx(best)
+    assert min_separation(refresh_rate / frames) == pytest.approx(best)
+    assert len(set(frames.tolist())) == n_locations
+    assert set(frames.tolist()) <= set(candidates.tolist())
+    # The rounded frequencies of `screens` still give the planned frames
+    assert np.all(np.round(refresh_rate / np.array(planned_freqs(refresh_rate, frames))).astype(int) == frames)
+
+
+def test_band_edges_allow_a_monitor_slightly_off_its_rate():
+    # 24 frames are 10 Hz at 240 Hz, and 9.998 Hz at 239.96 Hz
+    assert candidate_frames(240, (10, 12.7)).tolist() == [19, 20, 21, 22, 23, 24]
+    assert candidate_frames(239.96, (10, 12.7)).tolist() == [19, 20, 21, 22, 23, 24]
+    assert candidate_frames(239.96, (10, 12.7), tolerance=0).tolist() == [19, 20, 21, 22, 23]
+    # ... but not a frame that is further off
+    assert candidate_frames(240, (10.2, 12.7)).tolist() == [19, 20, 21, 22, 23]
+
+
+@pytest.mark.parametrize('n_locations', [0, 1])
+def test_fewer_than_two_locations_are_refused(n_locations):
+    with pytest.raises(ValueError):
+        plan_frequencies(240, (10, 12.7), n_locations)
+
+
+def test_too_narrow_a_band_is_refused():
+    with pytest.raises(ValueError, match='widen the band'):
+        plan_frequencies(60, (10, 12.7), 6)
+
+
+def test_neighbours_around_the_circle_are_far_apart():
+    assert arrange_around_circle(np.array([24, 20, 22, 19, 23, 21])).tolist() == [19, 22, 20, 23, 21, 24]
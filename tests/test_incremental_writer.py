@@ -0,0 +1,65 @@
+"""Crash-safe data log: rows and markers survive `close` and are recovered as a `.csv` and a marker table."""
+import csv
+import threading
+import time
+
+import incremental_writer
+from incremental_writer import IncrementalWriter, read_markers, read_rows, recover
+
+
+def test_rows_queued_during_the_last_write_are_kept(tmp_path):
+    stem = str(tmp_path / 'sub-test_task-Oddball')
+    writer = IncrementalWriter(stem, info={'participant': 'sub-test'})
+    write = writer._write
+    written, release = threading.Event(), threading.Event()
+
+    def slow_write():
+        # The queue has just been emptied; hold the thread here as if the fsync were slow
+        write()
+        if not written.is_set():
+            written.set()
+            release.wait(5)
+
+    writer._write = slow_write
+    writer.add_row({'block': 0})
+    writer.flush()
+    assert written.wait(5)
+
+    # A row and a marker queued while that write is running, then `close` as at the end of a session
+    writer.add_row({'block': 1})
+    writer.add_marker(1.5, 'lsl', 'Oddball/block_1/block_end')
+    closer = threading.Thread(target=writer.close)
+    closer.start()
+    while writer._running:
+        time.sleep(0.001)
+    release.set()
+    closer.join(5)
+
+    _, rows = read_rows(stem + '_rows.jsonl')
+    assert [row['block'] for row in rows] == [0, 1]
+    assert read_markers(stem + '_markers.bin') == [(1.5, 'lsl', 'Oddball/block_1/block_end')]
+
+
+def test_recover_rebuilds_the_csv_and_marker_table(tmp_path):
+    stem = str(tmp_path / 'sub-test_task-Oddball')
+    writer = IncrementalWriter(stem, info={'participant': 'sub-test', 'session': 'ses-001'})
+    for block in range(3):
+        writer.add_row({'block': block, 'target': block + 2})
+        writer.add_marker(10.0 + block, 'lsl', f'Oddball/block_{block}/block_start')
+        writer.flush()
+    writer.close()
+
+    # A crash in the middle of the next write: a cut-off row and marker at the end of the logs
+    with open(stem + '_rows.jsonl', 'a', encoding='utf-8') as f:
+        f.write('{"row": {"block": 3, "tar')
+    with open(stem + '_markers.bin', 'ab') as f:
+        f.write(incremental_writer.MARKER_RECORD.pack(13.0, 3, 40)[:7])
+
+    assert recover(stem) == [stem + '_recovered.csv', stem + '_markers_recovered.tsv']
+    with open(stem + '_recovered.csv', newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert [(row['block'], row['target'], row['participant']) for row in rows] == [
+        ('0', '2', 'sub-test'), ('1', '3', 'sub-test'), ('2', '4', 'sub-test')]
+    with open(stem + '_markers_recovered.tsv', newline='', encoding='utf-8') as f:
+        markers = list(csv.DictReader(f, delimiter='\t'))
+    assert [marker['value'] for marker in markers] == [f'Oddball/block_{block}/block_start' for block in range(3)]
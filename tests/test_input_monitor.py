@@ -0,0 +1,54 @@
+"""Input monitor: escape is timed from the key press, and the 'event' backend is polled from the frame loop."""
+import threading
+import time
+
+from input_monitor import InputMonitor
+
+
+class Key:
+    def __init__(self, name, tDown):
+        self.name = name
+        self.tDown = tDown
+
+
+class FakeKeyboard:
+    """Returns the queued presses, and notes the thread that read them."""
+    def __init__(self, backend):
+        self._backend = backend
+        self.presses = []
+        self.threads = set()
+
+    def getKeys(self, keyList=None, waitRelease=False, clear=True):
+        self.threads.add(threading.current_thread())
+        keys, self.presses = [key for key in self.presses if key.name in keyList], []
+        return keys
+
+
+def test_abort_latency_is_measured_from_the_key_press():
+    keyboard = FakeKeyboard('ptb')
+    now = [10.0]
+    monitor = InputMonitor(keyboard, clock=lambda: now[0], poll_interval=0.001).start()
+    try:
+        assert not monitor.check()
+        keyboard.presses.append(Key('escape', 9.5))  # picked up 0.5 s after it was pressed
+        for _ in range(1000):
+            if monitor.check():
+                break
+            time.sleep(0.001)
+        assert monitor.aborted and monitor.abort_time == 9.5
+        now[0] = 10.25
+        assert monitor.abort_latency() == 0.75
+    finally:
+        monitor.stop()
+    assert keyboard.threads == {monitor._thread}
+
+
+def test_event_backend_is_polled_from_the_calling_thread():
+    keyboard = FakeKeyboard('event')
+    monitor = InputMonitor(keyboard, backend='ptb', clock=lambda: 0.0).start()
+    assert monitor.backend == 'event' and monitor._thread is None
+    assert not monitor.check()
+    keyboard.presses.append(Key('escape', None))
+    assert monitor.check() and monitor.abort_latency() == 0.0
+    monitor.stop()
+    assert keyboard.threads == {threading.current_thread()}
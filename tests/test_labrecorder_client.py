@@ -0,0 +1,65 @@
+"""
+LabRecorder remote control against the local stand-in: `start` confirms the recording, the client reconnects,
+and `stop` waits only until the file is saved.
+"""
+import os.path as op
+import socket
+import time
+
+import pytest
+
+from labrecorder_client import LabRecorderClient
+from null_backend import NullLabRecorder
+
+
+@pytest.fixture
+def recorder(tmp_path):
+    recorder = NullLabRecorder(str(tmp_path), save_time=0.5)
+    yield recorder
+    recorder.close()
+
+
+def test_stop_returns_once_the_recording_is_saved(recorder, tmp_path):
+    xdf_file = op.join(str(tmp_path), 'sub-999', 'ses-001', 'eeg', 'task-Flicker_eeg.xdf')
+    client = LabRecorderClient(port=recorder.port).connect()
+    try:
+        assert client.set_filename(task='Flicker', participant='999', session='001') == 'OK'
+        assert client.start(watch_dir=str(tmp_path), timeout=5.0) == xdf_file
+        time.sleep(0.2)
+
+        # The next command goes out on a new connection
+        recorder.drop_connections()
+        t = time.monotonic()
+        saved = client.stop(watch_dir=str(tmp_path), settle_time=0.3, timeout=10.0)
+        elapsed = time.monotonic() - t
+    finally:
+        client.close()
+
+    assert saved == xdf_file
+    assert recorder.save_time <= elapsed < 5.0
+    assert client.n_reconnects == 1
+    assert recorder.commands == ['filename', 'start', 'stop']
+
+
+def test_start_reports_a_missing_recording(recorder, tmp_path):
+    # LabRecorder saves somewhere other than the folder that is watched
+    watched = tmp_path / 'elsewhere'
+    watched.mkdir()
+    client = LabRecorderClient(port=recorder.port).connect()
+    try:
+        t = time.monotonic()
+        assert client.start(watch_dir=str(watched), timeout=0.5) is None
+        assert 0.5 <= time.monotonic() - t < 3.0
+    finally:
+        client.close()
+    assert recorder.commands == ['start']
+
+
+def test_missing_labrecorder_is_a_connection_error():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]  # free once the socket is closed
+    client = LabRecorderClient(port=port, connect_timeout=0.3, retry_interval=0.05)
+    with pytest.raises(ConnectionError):
+        client.connect()
+    client.close()
@@ -0,0 +1,65 @@
+"""
+Closed loop on the local LSL network: synthetic EEG -> online SSVEP decoder -> decision outlet.
+
+The streams get unique names, so a running experiment or amplifier on the same network isn't picked up.
+"""
+import threading
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+pylsl = pytest.importorskip('pylsl')
+
+from online_streams import create_marker_outlet, open_inlet
+from ssvep_decoder import OnlineSSVEP, SSVEPDecoder
+from synthetic_eeg import SyntheticEEG, run
+
+FREQS = [12.63, 10, 12, 10.43, 11.43, 10.91]
+SFREQ = 250.0
+N_CHANNELS = 8
+
+
+def connected_inlet(name):
+    inlet = open_inlet(name=name, timeout=5.0)
+    inlet.open_stream(timeout=5.0)
+    return inlet
+
+
+def test_synthetic_eeg_is_decoded_online():
+    tag = uuid.uuid4().hex[:8]
+    eeg_name, marker_name, decision_name = f'SyntheticEEG-{tag}', f'BCIMarkerStream-{tag}', f'BCIDecoderStream-{tag}'
+    markers = pylsl.StreamOutlet(pylsl.StreamInfo(marker_name, 'Markers', 1, 0, 'string', tag))
+    decisions = create_marker_outlet(decision_name, tag)
+
+    generator = SyntheticEEG(N_CHANNELS, SFREQ, FREQS, timing={}, noise_uv=10.0, ssvep_uv=10.0, seed=0)
+    stream = threading.Thread(target=run, args=(generator, N_CHANNELS, SFREQ),
+                              kwargs=dict(name=eeg_name, marker_inlet=connected_inlet(marker_name), duration=6.0),
+                              daemon=True)
+    stream.start()
+
+    decoder = SSVEPDecoder(FREQS, SFREQ, N_CHANNELS, max_duration=2.0)
+    online = OnlineSSVEP(decoder, connected_inlet(eeg_name), connected_inlet(marker_name), decisions)
+    decision_inlet = connected_inlet(decision_name)
+    loop = threading.Thread(target=online.run, kwargs=dict(duration=5.5), daemon=True)
+    loop.start()
+
+    markers.push_sample(['Flicker/block_0/target_marker/loc_2'], pylsl.local_clock())
+    time.sleep(0.3)
+    block_start = pylsl.local_clock()
+    markers.push_sample(['Flicker/block_0/block_start'], block_start)
+    time.sleep(4.5)
+    markers.push_sample(['Flicker/block_0/block_end'], pylsl.local_clock())
+    loop.join(10)
+    stream.join(10)
+
+    assert generator.n_events == 3
+    received, timestamps = decision_inlet.pull_chunk(timeout=1.0)
+    assert received, online.report()
+    assert len(received) == len(online.decisions)
+    assert all(decision == ['Flicker/block_0/decision/loc_2'] for decision in received), received
+    assert all(target == 2 for _, target in online.decisions)
+    # Decisions come after the flicker started, each within the longest window (plus the filter delay)
+    windows = np.diff(np.r_[block_start, [d.timestamp for d, _ in online.decisions]])
+    assert np.all(windows > 0) and np.all(windows < 2.0 + decoder.filter_delay + 0.5)
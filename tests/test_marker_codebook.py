@@ -0,0 +1,63 @@
+"""Integer marker codes: every marker of a session survives encode -> sidecar -> decode."""
+import json
+
+import numpy as np
+import pytest
+
+from frame_schedule import CONDITIONS
+from marker_codebook import MarkerCodebook, decode
+
+FREQS = [12.63, 10, 12, 10.43, 11.43, 10.91]
+
+
+@pytest.fixture
+def codebook():
+    return MarkerCodebook(CONDITIONS, n_blocks=12, n_locations=6, n_repeats=3, frequencies=FREQS)
+
+
+def marker_parts(marker):
+    parts = {'condition': '', 'block': -1, 'status': '', 'location': -1}
+    fields = marker.split('/')
+    if fields[0] in CONDITIONS:
+        parts['condition'] = fields.pop(0)
+    for field in fields:
+        if field.startswith('block_') and field[6:].isdigit():
+            parts['block'] = int(field[6:])
+        elif field.startswith('loc_'):
+            parts['location'] = int(field[4:])
+        else:
+            parts['status'] = field.split('_')[0] if field.startswith('freq_') else field
+    return parts
+
+
+def test_examples_of_the_docstring(codebook):
+    assert codebook.encode('FlickerOddball/block_0/nontarget/loc_5') == 3010606
+    assert codebook.encode('loc_0/freq_12.63') == 701
+
+
+def test_every_code_is_unique_and_decodes_to_its_marker(codebook, tmp_path):
+    codes = np.array(list(codebook.codes.values()))
+    assert np.unique(codes).shape == codes.shape
+    assert codes.max() < 2 ** 31  # int32 marker stream
+
+    # Through the sidecar, as the analysis reads it back
+    sidecar = tmp_path / 'sub-test_task-Flicker_markers.json'
+    codebook.write_sidecar(str(sidecar))
+    with open(sidecar) as f:
+        loaded = json.load(f)
+    assert {int(code): marker for code, marker in loaded['codes'].items()} == \
+        {code: marker for marker, code in codebook.codes.items()}
+
+    parts = decode(codes, loaded)
+    for n, marker in enumerate(codebook.codes):
+        assert {field: parts[field][n].item() for field in parts} == marker_parts(marker), marker
+
+
+def test_repeats_are_block_markers(codebook):
+    parts = decode([codebook.encode('DannyFlicker/block_11/repeat_3')], codebook.to_dict())
+    assert parts['status'][0] == 'repeat_3' and parts['block'][0] == 11 and parts['location'][0] == -1
+
+
+def test_too_many_blocks_are_refused():
+    with pytest.raises(ValueError, match='blocks'):
+        MarkerCodebook(CONDITIONS, n_blocks=100, n_locations=6)
@@ -0,0 +1,49 @@
+"""Monitor profiles: refresh rate fit, saved profiles and the check of a stored profile at launch."""
+import numpy as np
+import pytest
+
+from monitor_calibration import load_profile, measure_refresh_rate, profile_matches, save_profile
+
+
+class Window:
+    """Flips at `refresh_rate`, dropping the frames in `dropped` (flip numbers); `frame_rate` is what a short check sees."""
+    def __init__(self, refresh_rate, dropped=(), frame_rate=None):
+        self.refresh_rate = refresh_rate
+        self.dropped = set(dropped)
+        self.frame_rate = frame_rate
+        self.n_flips = 0
+        self.t = 0.0
+
+    def flip(self):
+        self.t += (2 if self.n_flips in self.dropped else 1) / self.refresh_rate
+        self.n_flips += 1
+        return self.t
+
+    def getActualFrameRate(self, nMaxFrames=100, **kwargs):
+        return self.frame_rate
+
+
+def test_dropped_frames_do_not_bias_the_measured_rate():
+    profile = measure_refresh_rate(Window(239.96, dropped=(30, 100, 300, 301)), n_frames=600, n_warmup=60)
+    assert profile['refresh_rate'] == pytest.approx(239.96, abs=1e-3)
+    assert profile['n_dropped'] == 3  # 30 is still in the warm-up
+    assert profile['jitter_sd_ms'] == pytest.approx(0, abs=1e-6)
+
+
+def test_saved_profile_is_loaded_only_for_the_same_monitor_and_resolution(tmp_path):
+    filename = str(tmp_path / 'calibration' / 'Alienware.json')
+    profile = {'version': 1, 'monitor': 'Alienware', 'resolution': [2560, 1440], 'refresh_rate': 239.96,
+               'measured_at': '2020-01-01T00:00:00'}
+    save_profile(profile, filename)
+    assert load_profile(filename, 'Alienware', [2560, 1440]) == profile
+    assert load_profile(filename, 'Alienware', [1920, 1080]) is None
+    assert load_profile(filename, 'testMonitor', [2560, 1440]) is None
+    assert load_profile(filename, 'Alienware', [2560, 1440], max_age_days=90) is None
+    assert load_profile(str(tmp_path / 'missing.json'), 'Alienware', [2560, 1440]) is None
+
+
+@pytest.mark.parametrize('frame_rate, matches', [(239.9, True), (240.6, True), (144.0, False), (60.0, False),
+                                                 (None, False)])
+def test_stored_profile_is_checked_against_the_current_rate(frame_rate, matches):
+    profile = {'monitor': 'Alienware', 'refresh_rate': 239.96}
+    assert profile_matches(Window(240, frame_rate=frame_rate), profile) is matches
@@ -0,0 +1,73 @@
+"""Online SSVEP decoding: the ring buffer, marker parsing and FBCCA on synthetic EEG."""
+import numpy as np
+import pytest
+
+from frame_schedule import CONDITIONS
+from marker_codebook import MarkerCodebook
+from online_streams import MarkerParser, itr_bits_per_min
+from ring_buffer import RingBuffer
+from ssvep_decoder import SSVEPDecoder, simulate
+
+FREQS = [12.63, 10, 12, 10.43, 11.43, 10.91]
+
+
+def test_ring_buffer_reads_across_the_wrap_around():
+    buffer = RingBuffer(2, capacity=10)
+    stream = np.arange(50, dtype=float)[:, None] * [1, -1]
+    for start, stop in [(0, 7), (7, 13), (13, 14), (14, 31), (31, 50)]:  # the last but one is longer than the buffer
+        buffer.write(stream[start:stop], stream[start:stop, 0] / 100)
+        assert buffer.n_written == stop
+        assert buffer.first_index == max(0, stop - 10)
+        for first in range(buffer.first_index, stop + 1):
+            data, times = buffer.read(first, stop)
+            np.testing.assert_array_equal(data, stream[first:stop])
+            np.testing.assert_array_equal(times, stream[first:stop, 0] / 100)
+
+    assert buffer.index_at(0.455) == 46
+    assert buffer.index_at(1.0) == 50
+    with pytest.raises(IndexError):
+        buffer.read(39, 45)  # already overwritten
+    with pytest.raises(IndexError):
+        buffer.read(45, 51)  # not written yet
+
+
+def test_marker_parser_reads_string_and_integer_markers_alike():
+    codebook = MarkerCodebook(CONDITIONS, n_blocks=12, n_locations=6, n_repeats=3, frequencies=FREQS)
+    parsers = MarkerParser(), MarkerParser(codebook.to_dict())
+    for marker in ['Flicker/block_0/target_marker/loc_3', 'DannyFlicker/block_11/repeat_2',
+                   'FlickerOddball/block_4/block_end', 'Oddball/block_2/nontarget/loc_5']:
+        parsed = parsers[0].parse([marker])
+        assert parsers[1].parse([codebook.encode(marker)]) == parsed
+        assert '/'.join(filter(None, [parsed['condition'], f"block_{parsed['block']}", parsed['status']]
+                               + ([f"loc_{parsed['location']}"] if parsed['location'] >= 0 else []))) == marker
+    assert parsers[0].parse('loc_2/freq_12') == {'condition': '', 'block': -1, 'status': 'freq_12', 'location': 2}
+    with pytest.raises(ValueError):
+        parsers[0].parse([codebook.encode('Flicker/block_0/block_start')])
+
+
+def test_fbcca_decodes_the_attended_frequency():
+    decoder = SSVEPDecoder(FREQS, sfreq=250, n_channels=8, max_duration=3.0)
+    decisions = simulate(decoder, n_trials=12, seed=0)
+    assert len(decisions) == 12
+    assert np.mean([decision.location == target for decision, target in decisions]) >= 0.9
+    for decision, _ in decisions:
+        assert decoder.min_samples / decoder.sfreq <= decision.duration <= 3.0
+        assert decision.frequency == FREQS[decision.location]
+        assert decision.timestamp > decision.onset
+
+
+def test_fbcca_decides_at_the_longest_window_without_a_flicker():
+    decoder = SSVEPDecoder(FREQS, sfreq=250, n_channels=4, max_duration=1.0, threshold=1.01)
+    decoder.start(0.0)
+    rng = np.random.default_rng(1)
+    decision = None
+    for n in range(0, 1000, 25):
+        decision = decoder.push(rng.standard_normal((25, 4)), (np.arange(n, n + 25)) / 250)
+        if decision is not None:
+            break
+    assert decision is not None and decision.duration == pytest.approx(1.0)
+
+
+def test_itr():
+    assert itr_bits_per_min(6, 1.0, 1.0) == pytest.approx(60 * np.log2(6))
+    assert itr_bits_per_min(6, 1 / 6, 1.0) == 0.0
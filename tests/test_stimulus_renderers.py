@@ -0,0 +1,51 @@
+"""Texture atlas of `ElementArrayRenderer`: every element shows its own tile."""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from stimulus_renderers import ElementArrayRenderer, atlas_coordinates
+
+
+def texcoords(sizes, sfs, phases, units):
+    """Texture coordinate rectangle of each element, as PsychoPy computes it: (left, right, bottom, top)."""
+    span = sfs if units in ('norm', 'pix', 'height') else sizes * sfs
+    centre = 0.5 - phases
+    return np.column_stack([centre - span / 2, centre + span / 2])[:, [0, 2, 1, 3]]
+
+
+def tile_rects(n_elements, grid):
+    """Texture coordinates of tile `n`, filled row by row from the top-left of the atlas."""
+    tiles = np.arange(n_elements)
+    col, row = tiles % grid, tiles // grid
+    return np.column_stack([col / grid, (col + 1) / grid, 1 - (row + 1) / grid, 1 - row / grid])
+
+
+@pytest.mark.parametrize('units', ['deg', 'cm', 'norm', 'pix', 'height'])
+@pytest.mark.parametrize('n_elements, grid', [(1, 1), (4, 2), (12, 4), (13, 4)])
+def test_each_element_maps_onto_its_own_tile(units, n_elements, grid):
+    sizes = np.random.default_rng(0).uniform(0.5, 8, size=(n_elements, 2))
+    sfs, phases = atlas_coordinates(sizes, grid, units)
+    np.testing.assert_allclose(texcoords(sizes, sfs, phases, units), tile_rects(n_elements, grid), atol=1e-12)
+
+
+def test_renderer_passes_tile_coordinates_to_the_element_array():
+    colours = ['red', 'green', 'blue', 'white', 'black', 'yellow']
+    layers = [[SimpleNamespace(image=Image.new('RGB', (8, 8), colour), pos=(n, 0), size=(2, 3))
+               for n, colour in enumerate(colours[:3])],
+              [SimpleNamespace(image=Image.new('RGB', (8, 8), colour), pos=(n, 0), size=(2, 3))
+               for n, colour in enumerate(colours[3:])]]
+
+    renderer = ElementArrayRenderer(None, layers, tile_res=4, units='deg',
+                                    stim_class=lambda win, **kwargs: SimpleNamespace(**kwargs))
+    stim = renderer.stim
+    atlas = np.asarray(stim.elementTex)
+    grid = atlas.shape[0] // 4
+    rects = texcoords(stim.sizes, stim.sfs, stim.phases, 'deg')
+    for n, colour in enumerate(colours):
+        # Sample the atlas at the centre of the element's texture coordinates (texture y runs upwards)
+        x = (rects[n, 0] + rects[n, 1]) / 2
+        y = (rects[n, 2] + rects[n, 3]) / 2
+        pixel = atlas[int((1 - y) * grid * 4), int(x * grid * 4)]
+        assert tuple(pixel[:3]) == Image.new('RGB', (1, 1), colour).getpixel((0, 0))
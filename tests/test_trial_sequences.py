@@ -0,0 +1,48 @@
+"""Trial sequences: every location `repeats` times, never twice in a row, reproducible from the seed."""
+import numpy as np
+import pytest
+
+from trial_sequences import block_sequences, no_repeat_sequence, session_sequences, validate_sequences
+
+
+@pytest.mark.parametrize('n_locations, repeats', [(2, 10), (3, 1), (6, 10), (24, 100)])
+def test_sequences_meet_the_constraints(n_locations, repeats):
+    rng = np.random.default_rng(0)
+    sequences = np.array([no_repeat_sequence(list(range(n_locations)), repeats, rng=rng) for _ in range(50)])
+    validate_sequences(sequences, n_locations, repeats)
+
+
+def test_uneven_counts_and_forced_items():
+    # The only valid order of 3 x 'a' and 2 x 'b'
+    assert no_repeat_sequence(['a', 'b'], [3, 2], rng=1) == ['a', 'b', 'a', 'b', 'a']
+    for seed in range(50):
+        sequence = no_repeat_sequence(['a', 'b', 'c'], [5, 2, 2], rng=seed)
+        assert sorted(sequence) == sorted('aaaaabbcc')
+        assert all(x != y for x, y in zip(sequence, sequence[1:]))
+    assert no_repeat_sequence(['a'], 0) == []
+    with pytest.raises(ValueError):
+        no_repeat_sequence(['a', 'b'], [4, 2])
+
+
+def test_first_trial_is_uniform():
+    rng = np.random.default_rng(2)
+    firsts = np.bincount([no_repeat_sequence(list(range(6)), 10, rng=rng)[0] for _ in range(6000)], minlength=6)
+    assert np.all(np.abs(firsts - 1000) < 120)
+
+
+def test_session_is_reproducible_from_its_seed():
+    session = session_sequences(3, 12, 6, 10, seed=42)
+    assert session.shape == (3, 12, 60) and session.dtype == np.int16
+    np.testing.assert_array_equal(session, session_sequences(3, 12, 6, 10, seed=42))
+    validate_sequences(session, 6, 10)
+    assert not np.array_equal(session[0], session[1])
+    np.testing.assert_array_equal(block_sequences(12, 6, 10, seed=7), block_sequences(12, 6, 10, seed=7))
+
+
+def test_validation_lists_the_bad_sequences():
+    sequences = block_sequences(4, 6, 10, seed=0)
+    sequences[1, 5] = sequences[1, 4]
+    sequences[3, 0] = (sequences[3, 0] + 3) % 6
+    with pytest.raises(ValueError,
+                       match=r'consecutive repeats in \[\(1,\)\]; wrong location counts in \[\(1,\), \(3,\)\]'):
+        validate_sequences(sequences, 6, 10)